@@ -0,0 +1,22 @@
+import sys
+
+import pytest
+
+from digitalearthau import dataset_ids
+
+
+@pytest.fixture(autouse=True)
+def no_file_caches(monkeypatch):
+    """
+    Don't cache values read from files (such as dataset ids, or passed validations) during tests.
+
+    They'd otherwise be written wherever the environment points, such as the user's home folder.
+    """
+    monkeypatch.setattr(dataset_ids, 'CACHE_PATH', '')
+    monkeypatch.setattr(dataset_ids, '_CACHE', None)
+    # (Validation loads gdal, so it's only imported by the tests that need it)
+    monkeypatch.setenv('DEA_VALIDATION_CACHE', '')
+    validate = sys.modules.get('digitalearthau.sync.validate')
+    if validate is not None:
+        monkeypatch.setattr(validate, 'CACHE_PATH', '')
+        monkeypatch.setattr(validate, '_CACHE', None)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark finding collection files with glob.iglob() against the threaded scandir walker.
+
+Runs against a synthetic scene-like tree (YYYY/MM/LS*/ga-metadata.yaml) unless a pattern is given.
+Latency-bound filesystems such as Lustre benefit most from more threads: run it there with --pattern.
+"""
+import glob
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from digitalearthau import walk
+
+SCENE_OFFSET = '[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml'
+
+
+def make_tree(root: Path, years: int, months: int, scenes: int):
+    for year in range(2000, 2000 + years):
+        for month in range(1, months + 1):
+            month_dir = root.joinpath('{:04d}'.format(year), '{:02d}'.format(month))
+            for scene in range(scenes):
+                scene_dir = month_dir.joinpath('LS8_SCENE_{:04d}'.format(scene))
+                scene_dir.mkdir(parents=True)
+                scene_dir.joinpath('ga-metadata.yaml').write_text('')
+                scene_dir.joinpath('product.tif').write_text('')
+            # Non-matching siblings that should be pruned.
+            month_dir.joinpath('notes.txt').write_text('')
+
+
+def timed(f):
+    t0 = time.time()
+    result = f()
+    return result, time.time() - t0
+
+
+def run_test(pattern: str, thread_counts):
+    print('Pattern: {}'.format(pattern))
+    expected, took = timed(lambda: set(glob.iglob(pattern)))
+    print(' glob.iglob:          {:8.3f} secs ({} paths)'.format(took, len(expected)))
+
+    for threads in thread_counts:
+        found, took = timed(lambda: set(walk.iter_paths([pattern], threads=threads)))
+        if found != expected:
+            raise RuntimeError('Walker found different paths to glob with {} threads'.format(threads))
+        print(' walk ({:2d} threads):   {:8.3f} secs'.format(threads, took))
+
+
+@click.command()
+@click.option('--pattern', help='Glob pattern to benchmark (default: a synthetic tree)')
+@click.option('--years', type=int, default=10)
+@click.option('--months', type=int, default=12)
+@click.option('--scenes', type=int, default=50, help='Scenes per month')
+@click.option('--threads', 'thread_counts', type=int, multiple=True, default=(1, 4, 8, 16))
+def main(pattern, years, months, scenes, thread_counts):
+    """ Benchmark walking collection file patterns
+    """
+    if pattern:
+        run_test(pattern, thread_counts)
+        return
+
+    root = Path(tempfile.mkdtemp(prefix='bench-walk-'))
+    try:
+        print('Creating {} scenes in {}'.format(years * months * scenes, root))
+        make_tree(root, years, months, scenes)
+        run_test(str(root.joinpath(SCENE_OFFSET)), thread_counts)
+    finally:
+        shutil.rmtree(str(root))
+
+
+if __name__ == '__main__':
+    main()
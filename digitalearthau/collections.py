@@ -7,12 +7,13 @@ that should contain the same set of datasets.
 (Our sync script will compare/"sync" the two)
 """
 import fnmatch
-import glob
-from enum import Enum, auto
+from enum import Enum, IntEnum, auto
 from pathlib import Path
-from typing import Iterable, Optional, List, Dict, NamedTuple, Sequence
+from typing import Iterable, Optional, List, Dict, NamedTuple, Sequence, Tuple
 
 from datacube.index import Index
+from digitalearthau import walk
+from digitalearthau.index import iter_location_uris
 
 
 class Trust(Enum):
@@ -25,6 +26,24 @@ class Trust(Enum):
     DISK = auto()
 
 
+class ValidationLevel(IntEnum):
+    """
+    How thoroughly should the data files of a collection be checked in a sync?
+
+    Each level includes the checks of those below it.
+    """
+    # Not checked
+    NONE = 0
+    # The files and their bands can be opened
+    OPEN = 1
+    # Overviews (or a sample of blocks) of each band can be read
+    SAMPLE = 2
+    # Every pixel of each band can be read (by computing statistics)
+    STATISTICS = 3
+    # ... and NetCDF files pass CF compliance checks
+    COMPLIANCE = 4
+
+
 class Collection(NamedTuple):
     name: str
     # The query args needed to get all of this collection from the datacube index
@@ -42,23 +61,43 @@ class Collection(NamedTuple):
 
     trust: Trust = Trust.NOTHING
 
-    def iter_fs_paths(self):
+    # How thoroughly to check data files when syncing
+    validation_level: ValidationLevel = ValidationLevel.STATISTICS
+
+    def iter_fs_paths(self, threads: int = walk.DEFAULT_THREADS):
+        """
+        Iterate over all filesystem paths of this collection, listing directories with the given number of threads.
+        """
         return (
             Path(path).absolute()
-            for file_pattern in self.file_patterns
-            for path in glob.iglob(file_pattern)
+            for path in walk.iter_paths(self.file_patterns, threads=threads)
         )
 
-    def iter_fs_uris(self):
-        for path in self.iter_fs_paths():
+    def iter_fs_uris(self, threads: int = walk.DEFAULT_THREADS):
+        for path in self.iter_fs_paths(threads=threads):
             yield path.as_uri()
 
-    def iter_index_uris(self):
+    def iter_fs_uris_sorted(self, within_path: Path = None) -> Iterable[str]:
+        """
+        Iterate over the uris of all filesystem paths, in sorted order (without holding them in memory)
+
+        Optionally only those inside the given folder.
+        """
+        patterns = self.constrained_file_patterns(within_path) if within_path else self.file_patterns
+        return walk.iter_sorted_uris(patterns)
+
+    def iter_index_uris(self, uri_prefix: str = None):
         """
         Iter over all uris in the index of this collection.
 
         Both active and archived uris are returned.
+
+        Optionally only those within the given uri prefix (filtered by the index query).
         """
+        if uri_prefix is not None:
+            yield from iter_location_uris(self.index_, self.query, uri_prefix=uri_prefix)
+            return
+
         for uri, in self.index_.datasets.search_returning(['uri'], **self.query):
             yield str(uri)
 
@@ -99,14 +138,13 @@ class Collection(NamedTuple):
 
         return out
 
-    def iter_fs_paths_within(self, p: Path):
+    def iter_fs_paths_within(self, p: Path, threads: int = walk.DEFAULT_THREADS):
         """
         Iterate over all filesystem paths of this collection that are inside the given folder
         """
         return (
             Path(path).absolute()
-            for file_pattern in self.constrained_file_patterns(p)
-            for path in glob.iglob(file_pattern)
+            for path in walk.iter_paths(self.constrained_file_patterns(p), threads=threads)
         )
 
     # Treated as singletons
@@ -117,6 +155,29 @@ class Collection(NamedTuple):
         return hash(self.name)
 
 
+def iter_fs_paths_by_collection(
+        collection_folders: Iterable[Tuple[Collection, Optional[Path]]],
+        threads: int = walk.DEFAULT_THREADS) -> Iterable[Tuple[Tuple[Collection, Optional[Path]], Path]]:
+    """
+    Iterate over the filesystem paths of several collections at once.
+
+    Each collection can optionally be constrained to a folder (or None for the whole collection). Paths are
+    returned with the (collection, folder) that they were found for.
+
+    Collections sharing directories (such as the products of a scene folder) are crawled in a single
+    pass, rather than listing each directory once per collection.
+    """
+    patterns = []
+    owners = []
+    for collection, folder in collection_folders:
+        for pattern in (collection.constrained_file_patterns(folder) if folder else collection.file_patterns):
+            patterns.append(pattern)
+            owners.append((collection, folder))
+
+    for i, path in walk.iter_matches(patterns, threads=threads):
+        yield owners[i], Path(path).absolute()
+
+
 def _constrain_pattern(within_path: Path, pattern: str):
     """
     >>> _constrain_pattern(Path('/tmp/test'), '/tmp/test/[0-9]')
@@ -0,0 +1,189 @@
+# coding=utf-8
+"""
+Read the dataset ids of a metadata file (or NetCDF) without parsing the whole document.
+
+Dataset documents can be large (the full lineage of source datasets is embedded), while tools such as
+sync, move and cleanup only need their ids. Here the YAML/JSON event stream is scanned for the top-level
+``id`` field, without constructing the document, and NetCDF files have their ``dataset`` variable read directly.
+
+Ids can also be cached on disk (see :mod:`digitalearthau.filecache`), so unchanged files are never read
+twice across runs. The cache is off unless a path is set: dea-sync keeps it in its cache folder.
+
+Anything unusual (anchors, merge keys, parse errors...) falls back to a full parse with
+:func:`datacube.utils.read_documents`, so errors are the same as they'd otherwise be.
+"""
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import structlog
+import yaml
+
+from datacube.utils import read_documents, read_strings_from_netcdf, InvalidDocException
+from digitalearthau.filecache import FileCache, file_key
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+_LOG = structlog.get_logger()
+
+# Location of the on-disk id cache, if any. (Empty: no caching)
+CACHE_PATH = os.environ.get('DEA_DATASET_ID_CACHE', '')
+
+_YAML_NULLS = ('', '~', 'null', 'Null', 'NULL')
+
+
+class _NeedsFullParse(Exception):
+    """
+    The document can't be scanned for its id: it needs to be fully parsed.
+    """
+
+
+def _scan_yaml_ids(stream, path) -> Iterable[uuid.UUID]:
+    """
+    Find the top-level 'id' of each document in a yaml (or json) stream, without constructing the documents.
+
+    >>> list(_scan_yaml_ids('id: 9a4aa1a6-5a4a-47bc-9a6d-0c1fd0a6f3f7\\nlineage: {id: x, source_datasets: {}}', 'a'))
+    [UUID('9a4aa1a6-5a4a-47bc-9a6d-0c1fd0a6f3f7')]
+    >>> list(_scan_yaml_ids('{"lineage": {"id": "x"}, "id": "9a4aa1a6-5a4a-47bc-9a6d-0c1fd0a6f3f7"}', 'a.json'))
+    [UUID('9a4aa1a6-5a4a-47bc-9a6d-0c1fd0a6f3f7')]
+    >>> two_docs = 'id: 00000000-0000-0000-0000-000000000001\\n---\\nid: 00000000-0000-0000-0000-000000000002'
+    >>> list(_scan_yaml_ids(two_docs, 'a.yaml'))
+    [UUID('00000000-0000-0000-0000-000000000001'), UUID('00000000-0000-0000-0000-000000000002')]
+    >>> list(_scan_yaml_ids('lineage: {id: 00000000-0000-0000-0000-000000000001}', 'a.yaml'))
+    Traceback (most recent call last):
+    ...
+    datacube.utils.documents.InvalidDocException: No id in path metadata: a.yaml
+    >>> list(_scan_yaml_ids('--- ~', 'a.yaml'))
+    Traceback (most recent call last):
+    ...
+    datacube.utils.documents.InvalidDocException: Empty document from path a.yaml
+    """
+    depth = 0
+    root = id_event = key = None
+    node_count = 0
+
+    for event in yaml.parse(stream, Loader=SafeLoader):
+        if isinstance(event, yaml.DocumentStartEvent):
+            root = id_event = key = None
+            node_count = 0
+        elif isinstance(event, yaml.DocumentEndEvent):
+            yield _document_id(root, id_event, path)
+        elif isinstance(event, yaml.CollectionStartEvent):
+            if depth == 0:
+                root = event
+            depth += 1
+        elif isinstance(event, (yaml.CollectionEndEvent, yaml.ScalarEvent, yaml.AliasEvent)):
+            if isinstance(event, yaml.CollectionEndEvent):
+                depth -= 1
+            elif depth == 0:
+                root = event
+
+            # A whole node (key or value) of the root mapping has been read.
+            if depth == 1 and isinstance(root, yaml.MappingStartEvent):
+                is_key = node_count % 2 == 0
+                if is_key:
+                    key = event.value if isinstance(event, yaml.ScalarEvent) else None
+                    if key == '<<':
+                        raise _NeedsFullParse('Merge key in document')
+                elif key == 'id':
+                    id_event = event
+                node_count += 1
+
+
+def _document_id(root: Optional[yaml.Event], id_event: Optional[yaml.Event], path) -> uuid.UUID:
+    if root is None or (isinstance(root, yaml.ScalarEvent) and root.implicit[0] and root.value in _YAML_NULLS):
+        raise InvalidDocException("Empty document from path {}".format(path))
+
+    if id_event is None:
+        raise InvalidDocException("No id in path metadata: {}".format(path))
+
+    if not isinstance(id_event, yaml.ScalarEvent):
+        raise _NeedsFullParse('Id is not a plain value')
+
+    return uuid.UUID(id_event.value)
+
+
+def _read_ids(path: Path) -> Iterable[uuid.UUID]:
+    if path.suffix == '.nc':
+        for doc in read_strings_from_netcdf(path, variable='dataset'):
+            yield from _scan_yaml_ids(doc, path)
+    elif path.suffix in ('.yaml', '.yml', '.json'):
+        with path.open('rb') as f:
+            yield from _scan_yaml_ids(f, path)
+    else:
+        raise _NeedsFullParse('Unsupported file type')
+
+
+def _read_ids_fully(path: Path) -> Iterable[uuid.UUID]:
+    for _, metadata_doc in read_documents(path):
+        if metadata_doc is None:
+            raise InvalidDocException("Empty document from path {}".format(path))
+
+        if 'id' not in metadata_doc:
+            raise InvalidDocException("No id in path metadata: {}".format(path))
+
+        yield uuid.UUID(metadata_doc['id'])
+
+
+def read_dataset_ids(path: Path) -> List[uuid.UUID]:
+    """
+    Read all dataset ids in the given path (without using the cache).
+
+    :raises InvalidDocException
+    """
+    try:
+        return list(_read_ids(path))
+    except InvalidDocException:
+        raise
+    # Any other failure gets the same error as a normal (full) parse would give.
+    except (_NeedsFullParse, yaml.YAMLError, OSError, ValueError, KeyError, IndexError) as e:
+        _LOG.debug("dataset_ids.full_parse", path=path, reason=str(e))
+        return list(_read_ids_fully(path))
+
+
+_CACHE = None  # type: FileCache
+
+
+def set_cache_path(path: Optional[Path]):
+    """
+    Change where ids are cached (eg. to a sync cache folder). None disables the cache.
+    """
+    global CACHE_PATH, _CACHE  # pylint: disable=global-statement
+    if _CACHE is not None:
+        _CACHE.flush()
+    CACHE_PATH = str(path) if path else ''
+    _CACHE = None
+
+
+def _get_cache() -> Optional[FileCache]:
+    global _CACHE  # pylint: disable=global-statement
+    if _CACHE is None and CACHE_PATH:
+        _CACHE = FileCache(Path(CACHE_PATH), table='dataset_ids')
+    return _CACHE
+
+
+def get_dataset_ids(path: Path) -> List[uuid.UUID]:
+    """
+    Get all dataset ids in the given path, using the cache if the file hasn't changed.
+
+    :raises InvalidDocException
+    """
+    cache = _get_cache()
+    # If it can't be stat-ed, let the read give the usual error.
+    key = file_key(path) if cache else None
+    if key is None:
+        return read_dataset_ids(path)
+
+    path = path.absolute()
+    cached = cache.get(path, key)
+    if cached is not None:
+        return [uuid.UUID(id_) for id_ in json.loads(cached)]
+
+    ids = read_dataset_ids(path)
+    cache.put(path, key, json.dumps([str(id_) for id_ in ids]))
+    return ids
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+On-disk caches of values computed from files (such as their dataset ids, or validation results).
+
+Entries are only valid for the same file size, modification time and inode, so modified (or replaced) files
+are computed again.
+
+Pending entries are written at exit, but pool workers are terminated without running exit hooks: work run
+in them should call :func:`flush_all` when each chunk of it is done.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+# Entries are written to the cache in batches (multiple processes may be sharing it)
+_WRITE_BATCH_SIZE = 100
+_WRITE_INTERVAL_SECS = 10
+
+# The file stat that a cached value is valid for: (size, mtime_ns, inode)
+FileKey = Tuple[int, int, int]
+
+# Every cache created in this process, for flush_all().
+_CACHES = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+def file_key(path: Path) -> Optional[FileKey]:
+    """
+    Get the current cache key of a file, or None if it can't be read.
+    """
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class FileCache:
+    """
+    A cached (text) value for each file path, stored in one table of a sqlite database.
+
+    It can be shared by threads. Writes are batched, and any failure to use the cache (a read-only or locked
+    file) is logged and ignored: the cache is only ever an optimisation.
+    """
+
+    def __init__(self, path: Path, table: str) -> None:
+        self.path = path
+        self.table = table
+        self._db = None  # type: sqlite3.Connection
+        # Connections can't be shared by forked processes: the pid that opened it.
+        self._db_pid = None  # type: int
+        # Entries not yet written, by path.
+        self._pending = {}  # type: Dict[str, tuple]
+        self._last_write = time.time()
+        self._broken = False
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+        _CACHES.add(self)
+        # (A thread may hold the lock when another forks)
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.RLock()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._broken:
+            return None
+
+        if self._db is None or self._db_pid != os.getpid():
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+                self._db.execute(
+                    'create table if not exists {} ('
+                    'path text primary key, size integer, mtime_ns integer, inode integer, value text'
+                    ')'.format(self.table)
+                )
+                self._db.commit()
+            except (sqlite3.Error, OSError) as e:
+                _LOG.warning("file_cache.unusable", path=self.path, table=self.table, error=str(e))
+                self._broken = True
+                return None
+            self._db_pid = os.getpid()
+            # Entries queued by a parent process are theirs to write.
+            self._pending = {}
+        return self._db
+
+    def get(self, path: Path, key: FileKey) -> Optional[str]:
+        with self._lock:
+            db = self._connection()
+            if db is None:
+                return None
+
+            row = self._pending.get(str(path))
+            if row is not None:
+                row = row[1:]
+            else:
+                try:
+                    row = db.execute(
+                        'select size, mtime_ns, inode, value from {} where path = ?'.format(self.table), (str(path),)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    _LOG.warning("file_cache.read_failure", path=self.path, table=self.table, error=str(e))
+                    return None
+
+        if row is None or tuple(row[:3]) != key:
+            return None
+        return row[3]
+
+    def put(self, path: Path, key: FileKey, value: str):
+        with self._lock:
+            if self._connection() is None:
+                return
+            size, mtime_ns, inode = key
+            self._pending[str(path)] = (str(path), size, mtime_ns, inode, value)
+
+            if len(self._pending) >= _WRITE_BATCH_SIZE or (time.time() - self._last_write) > _WRITE_INTERVAL_SECS:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending or self._db is None or self._db_pid != os.getpid():
+                return
+            try:
+                with self._db:
+                    self._db.executemany('insert or replace into {} values (?, ?, ?, ?, ?)'.format(self.table),
+                                         self._pending.values())
+            except sqlite3.Error as e:
+                _LOG.warning("file_cache.write_failure", path=self.path, table=self.table, error=str(e),
+                             entry_count=len(self._pending))
+            self._pending = {}
+            self._last_write = time.time()
+
+
+def flush_all():
+    """
+    Write the pending entries of every cache in this process.
+    """
+    for cache in list(_CACHES):
+        cache.flush()
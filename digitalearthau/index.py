@@ -1,9 +1,17 @@
+import bisect
 import uuid
 import structlog
 
+from collections import defaultdict
 from datetime import datetime
-from typing import Iterable
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, Mapping, Optional, Sequence, Set, Tuple
+from sqlalchemy import select, and_, delete, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+
 from datacube.index import Index
+from datacube.drivers.postgres import _api as pgapi
 from datacube.model import Dataset
 from datacube.utils import uri_to_local_path
 from digitalearthau.utils import simple_object_repr
@@ -22,6 +30,8 @@ class DatasetLite:
     We also, in this script, depend heavily on the __eq__ behaviour of this particular class (by id only), and subtle
     bugs could occur if the core framework made changes to it.
     """
+    # There can be millions of these in a sync.
+    __slots__ = ('id', 'archived_time')
 
     def __init__(self, id_: uuid.UUID, archived_time: datetime = None) -> None:
         # Sanity check of the type, as our equality checks are quietly wrong if the types don't match,
@@ -61,12 +71,14 @@ class DatasetLite:
         return simple_object_repr(self)
 
 
-def add_dataset(index: Index, dataset_id: uuid.UUID, uri: str):
+def add_dataset(index: Index, dataset_id: uuid.UUID, uri: str, ds_resolve: Doc2Dataset = None):
     """
     Index a dataset from a file uri.
 
     A better api should be pushed upstream to core: it currently only has a "scripts" implementation
     intended for cli use.
+
+    A resolver can be given to share between many calls (creating one loads all products from the index).
     """
     yaml_path = uri_to_local_path(uri)
 
@@ -86,7 +98,8 @@ def add_dataset(index: Index, dataset_id: uuid.UUID, uri: str):
 
             yield dataset
 
-    ds_resolve = Doc2Dataset(index)
+    if ds_resolve is None:
+        ds_resolve = Doc2Dataset(index)
 
     for d in load_datasets([yaml_path], ds_resolve):
         if d.id == dataset_id:
@@ -100,7 +113,269 @@ def add_dataset(index: Index, dataset_id: uuid.UUID, uri: str):
         raise RuntimeError('dataset not found at path: %s, %s' % (dataset_id, uri))
 
 
+def update_locations(index: Index,
+                     to_add: Sequence[Tuple[uuid.UUID, str]] = (),
+                     to_remove: Sequence[Tuple[uuid.UUID, str]] = ()) -> Tuple[int, int]:
+    """
+    Add and remove many (dataset id, uri) locations in a single transaction, with one statement for each.
+
+    Returns the number of locations actually (added, removed). Locations that already exist are not added.
+    """
+    # TODO: expand api to support this?
+    # pylint: disable=protected-access
+    location_table = pgapi.DATASET_LOCATION
+    with index.datasets._db.begin() as transaction:
+        connection = transaction._connection
+
+        removed_count = 0
+        if to_remove:
+            removed_count = connection.execute(
+                delete(location_table).where(
+                    tuple_(location_table.c.dataset_ref,
+                           location_table.c.uri_scheme,
+                           location_table.c.uri_body).in_(
+                        [(id_,) + pgapi._split_uri(uri) for id_, uri in to_remove]
+                    )
+                )
+            ).rowcount
+
+        added_count = 0
+        if to_add:
+            added_count = connection.execute(
+                postgres_insert(location_table).values([
+                    dict(dataset_ref=id_, uri_scheme=scheme, uri_body=body)
+                    for id_, (scheme, body) in ((id_, pgapi._split_uri(uri)) for id_, uri in to_add)
+                ]).on_conflict_do_nothing(
+                    index_elements=['uri_scheme', 'uri_body', 'dataset_ref']
+                )
+            ).rowcount
+
+    return added_count, removed_count
+
+
 def get_datasets_for_uri(index: Index, uri: str) -> Iterable[DatasetLite]:
     """Get all datasets at the given uri"""
     for d in index.datasets.get_datasets_for_location(uri=uri):
         yield DatasetLite.from_agdc(d)
+
+
+def get_dataset(index: Index, id_: uuid.UUID) -> Optional[DatasetLite]:
+    """Get the dataset with the given id, if it's indexed"""
+    dataset = index.datasets.get(id_)
+    return DatasetLite.from_agdc(dataset) if dataset else None
+
+
+class IndexSnapshot:
+    """
+    An in-memory copy of the index state needed to sync a collection.
+
+    All (uri, dataset, archived_time) rows are loaded up-front, so that each uri can be compared
+    against the index without any further queries.
+
+    Only the collection's own datasets (and those sharing its locations) are known: callers should
+    look up other ids in the index.
+    """
+
+    def __init__(self,
+                 datasets_by_uri: Mapping[str, Set[DatasetLite]],
+                 known_datasets: Mapping[uuid.UUID, DatasetLite]) -> None:
+        self.datasets_by_uri = datasets_by_uri
+        self.known_datasets = known_datasets
+        self._sorted_uris = sorted(datasets_by_uri)
+
+    def get_datasets_for_uri(self, uri: str) -> Iterable[DatasetLite]:
+        """
+        Get all datasets at the given uri
+
+        As with the index's own lookup, a uri without a fragment ('#') matches every location it's a prefix of
+        (such as the parts of a stacked file).
+
+        >>> a, b, c = (DatasetLite(uuid.UUID(int=i)) for i in range(3))
+        >>> snapshot = IndexSnapshot({'file:///x.nc': {a}, 'file:///x.nc#part=1': {b}, 'file:///y.nc': {c}}, {})
+        >>> sorted(d.id.int for d in snapshot.get_datasets_for_uri('file:///x.nc'))
+        [0, 1]
+        >>> sorted(d.id.int for d in snapshot.get_datasets_for_uri('file:///x.nc#part=1'))
+        [1]
+        """
+        if '#' in uri:
+            return self.datasets_by_uri.get(uri, ())
+
+        datasets = set()  # type: Set[DatasetLite]
+        for i in range(bisect.bisect_left(self._sorted_uris, uri), len(self._sorted_uris)):
+            location = self._sorted_uris[i]
+            if not location.startswith(uri):
+                break
+            datasets.update(self.datasets_by_uri[location])
+        return datasets
+
+    def get(self, id_: uuid.UUID) -> Optional[DatasetLite]:
+        """Get the dataset with the given id, if it's indexed"""
+        return self.known_datasets.get(id_)
+
+    def __len__(self):
+        return len(self.known_datasets)
+
+
+def load_index_snapshot(index: Index, query: dict, uri_prefix: str = 'file:///') -> IndexSnapshot:
+    """
+    Load the locations and known dataset ids of all datasets matching the query (a collection query).
+
+    Only locations within the uri prefix are loaded. Datasets are included whether archived or not.
+
+    Every dataset at those locations is included, even those of other products, so that the datasets of a
+    location are the same as a query for it would return.
+    """
+    product_ids = [p.id for p in index.products.search(**query)]
+
+    known_datasets = {}
+    datasets_by_uri = defaultdict(set)
+
+    for id_, archived_time in _stream_rows(index, _known_datasets_query(product_ids)):
+        known_datasets[id_] = DatasetLite(id_, archived_time=archived_time)
+
+    for uri, id_, archived_time in _stream_rows(index, _locations_query(product_ids, uri_prefix)):
+        dataset = known_datasets.get(id_)
+        if dataset is None:
+            # Another product's dataset, sharing a location with ours.
+            dataset = known_datasets[id_] = DatasetLite(id_, archived_time=archived_time)
+        datasets_by_uri[uri].add(dataset)
+
+    _LOG.info("index.snapshot.loaded",
+              dataset_count=len(known_datasets),
+              location_count=len(datasets_by_uri))
+    return IndexSnapshot(dict(datasets_by_uri), known_datasets)
+
+
+def iter_location_uris(index: Index, query: dict, uri_prefix: str = 'file:///') -> Iterable[str]:
+    """
+    Iterate over the uris of all locations of the query's datasets within the uri prefix.
+
+    Both active and archived datasets are included.
+    """
+    product_ids = [p.id for p in index.products.search(**query)]
+    for uri, _, _ in _stream_rows(index, _locations_query(product_ids, uri_prefix)):
+        yield uri
+
+
+def iter_sorted_locations(index: Index, query: dict, uri_prefix: str = 'file:///') -> Iterable[Tuple[str, DatasetLite]]:
+    """
+    Stream (uri, dataset) for every location of the query's datasets within the uri prefix, ordered by uri.
+
+    A uri with multiple datasets will have consecutive rows. (As with a snapshot, all datasets at the
+    locations are included, whatever their product.)
+    """
+    product_ids = [p.id for p in index.products.search(**query)]
+    for uri, id_, archived_time in _stream_rows(index, _locations_query(product_ids, uri_prefix, ordered=True)):
+        yield uri, DatasetLite(id_, archived_time=archived_time)
+
+
+def iter_grouped_locations(index: Index,
+                           query: dict,
+                           uri_prefix: str = 'file:///') -> Iterable[Tuple[str, Set[DatasetLite], datetime]]:
+    """
+    Stream each location of the query's datasets within the uri prefix once, with all datasets at it and the
+    latest time one of them was added there.
+
+    They're in the database's own order (so it can read them from its index rather than sorting them).
+    """
+    product_ids = [p.id for p in index.products.search(**query)]
+    rows = _stream_rows(index, _locations_query(product_ids, uri_prefix, grouped=True, with_added=True))
+    for uri, uri_rows in groupby(rows, key=itemgetter(0)):
+        datasets = set()
+        latest_added = None
+        for _, id_, archived_time, added in uri_rows:
+            datasets.add(DatasetLite(id_, archived_time=archived_time))
+            if latest_added is None or added > latest_added:
+                latest_added = added
+        yield uri, datasets, latest_added
+
+
+# TODO: expand api to support this?
+# pylint: disable=protected-access
+def _stream_rows(index: Index, query):
+    """Run the query using a server-side cursor, so all rows don't need to be buffered by the driver"""
+    with index.datasets._db.begin() as db:
+        yield from db._connection.execution_options(stream_results=True).execute(query)
+
+
+def _known_datasets_query(product_ids):
+    return select(
+        [pgapi.DATASET.c.id, pgapi.DATASET.c.archived]
+    ).where(
+        pgapi.DATASET.c.dataset_type_ref.in_(product_ids)
+    )
+
+
+def _locations_query(product_ids, uri_prefix: str, ordered=False, grouped=False, with_added=False):
+    """
+    All datasets at the locations (within the prefix) of the products' datasets.
+
+    :param ordered: ordered by uri (byte-wise)
+    :param grouped: the rows of each uri are consecutive (in the database's own order)
+    :param with_added: include the time each location was added
+    """
+    # (The prefixes are matched with LIKE, escaped: '_' is common in paths, and would match any character.)
+    scheme, body = pgapi._split_uri(uri_prefix)
+    location = pgapi.DATASET_LOCATION
+
+    # The locations of the products' datasets...
+    # (aliased, so that it isn't correlated with the outer query's tables)
+    product_location, product_dataset = location.alias(), pgapi.DATASET.alias()
+    product_locations = select(
+        [product_location.c.uri_scheme, product_location.c.uri_body]
+    ).select_from(
+        product_location.join(product_dataset)
+    ).where(
+        and_(
+            product_dataset.c.dataset_type_ref.in_(product_ids),
+            product_location.c.uri_scheme == scheme,
+            product_location.c.uri_body.startswith(body, autoescape=True),
+        )
+    )
+    # ... and every dataset at them, including those of other products.
+    columns = [pgapi._dataset_uri_field(location), pgapi.DATASET.c.id, pgapi.DATASET.c.archived]
+    if with_added:
+        columns.append(location.c.added)
+    query = select(
+        columns
+    ).select_from(
+        location.join(pgapi.DATASET)
+    ).where(
+        and_(
+            location.c.uri_scheme == scheme,
+            location.c.uri_body.startswith(body, autoescape=True),
+            tuple_(location.c.uri_scheme, location.c.uri_body).in_(product_locations),
+        )
+    )
+    if ordered:
+        # Byte-wise "C" collation to match python's ordering of strings, rather than the database's locale.
+        query = query.order_by(location.c.uri_body.collate('C'))
+    elif grouped:
+        # The order of the location table's unique index, so no sort is needed.
+        query = query.order_by(location.c.uri_scheme, location.c.uri_body)
+    return query
+
+
+def iter_locations_added_since(index: Index,
+                               query: dict,
+                               since: datetime,
+                               uri_prefix: str = 'file:///') -> Iterable[Tuple[str, datetime]]:
+    """
+    Stream (uri, time added) for the locations of the query's datasets within the uri prefix that were added to the
+    index after the given time.
+    """
+    product_ids = [p.id for p in index.products.search(**query)]
+    scheme, body = pgapi._split_uri(uri_prefix)
+    location = pgapi.DATASET_LOCATION
+    yield from _stream_rows(index, select(
+        [pgapi._dataset_uri_field(location), location.c.added]
+    ).select_from(
+        location.join(pgapi.DATASET)
+    ).where(
+        and_(
+            pgapi.DATASET.c.dataset_type_ref.in_(product_ids),
+            location.c.uri_scheme == scheme,
+            location.c.uri_body.startswith(body, autoescape=True),
+            location.c.added > since,
+        )
+    ))
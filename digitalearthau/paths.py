@@ -5,13 +5,14 @@ import shutil
 import tempfile
 import uuid
 from pathlib import Path
-from typing import List, Iterable, Union, Tuple
+from typing import List, Union, Tuple
 
 import pathlib
 import structlog
 import logging
 
-from datacube.utils import is_supported_document_type, read_documents, InvalidDocException, uri_to_local_path
+from datacube.utils import is_supported_document_type, read_documents, uri_to_local_path
+from digitalearthau import dataset_ids
 
 _LOG = structlog.getLogger()
 
@@ -210,26 +211,18 @@ def get_path_dataset_id(metadata_path: Path) -> uuid.UUID:
     return ids[0]
 
 
-def _path_dataset_ids(path: Path) -> Iterable[uuid.UUID]:
-    for _, metadata_doc in read_documents(path):
-        if metadata_doc is None:
-            raise InvalidDocException("Empty document from path {}".format(path))
-
-        if 'id' not in metadata_doc:
-            raise InvalidDocException("No id in path metadata: {}".format(path))
-
-        yield uuid.UUID(metadata_doc['id'])
-
-
 def get_path_dataset_ids(path: Path) -> List[uuid.UUID]:
     """
     Get all dataset ids embedded by the given path.
 
     (Either a standalone metadata file or embedded in a given NetCDF)
 
+    Only the ids are read, not the whole documents, and they're cached for unchanged files.
+    (see :mod:`digitalearthau.dataset_ids`)
+
     :raises InvalidDocException
     """
-    return list(_path_dataset_ids(path))
+    return dataset_ids.get_dataset_ids(path)
 
 
 def get_dataset_paths(metadata_path: Path) -> Tuple[Path, List[Path]]:
@@ -4,9 +4,13 @@ Sync a datacube index to a folder of datasets on disk.
 
 Locations will be added/removed according to whether they're on disk, extra datasets will be indexed, etc.
 """
+import os
+import signal
 import sys
+import tempfile
+from functools import partial
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Optional, Tuple
 
 import click
 import structlog
@@ -14,9 +18,13 @@ import structlog
 import digitalearthau.collections as cs
 from datacube.index import Index
 from datacube.ui import click as ui
-from digitalearthau import uiutil
+from digitalearthau import dataset_ids, uiutil
 from digitalearthau.sync import scan
 from . import fixes, differences
+from .checkpoint import Checkpoint
+from .estimate import DEFAULT_SAMPLE_SIZE, estimate_mismatches, format_estimate
+from .pipeline import StageSizes
+from .shards import Shard
 from .differences import Mismatch
 
 _LOG = structlog.get_logger()
@@ -36,9 +44,32 @@ _LOG = structlog.get_logger()
               type=int,
               default=4,
               help="Number of worker processes to use")
+@click.option('--prefetch-index/--no-prefetch-index', default=True,
+              help="Load the index state of each collection in bulk, rather than querying it for every path")
+@click.option('--sorted-merge', is_flag=True, default=False,
+              help="Merge sorted streams of index and filesystem paths, rather than building a (cached) path set. "
+                   "Uses bounded memory regardless of collection size.")
+@click.option('--incremental', is_flag=True, default=False,
+              help="Only re-examine paths whose file or index state changed since the last incremental run "
+                   "(a manifest is kept in the cache folder)")
+@click.option('--index-first', is_flag=True, default=False,
+              help="For collections whose index is trusted: check that the indexed locations exist, and only "
+                   "list the directories that may hold unindexed files, rather than walking the whole tree")
+@click.option('--staged', is_flag=True, default=False,
+              help="Split the work into stages with separate pools: file reads on --read-threads threads, "
+                   "validation on --jobs processes, and index comparison on --index-connections threads")
+@click.option('--read-threads', type=int, default=StageSizes().read_threads,
+              help="Number of threads reading files (with --staged)")
+@click.option('--index-connections', type=int, default=StageSizes().index_connections,
+              help="Number of index connections comparing with the index (with --staged)")
 @click.option('-f', '--format', 'format_',
               type=click.Path(exists=True, readable=True, dir_okay=False),
               help="Input from file instead of scanning collections")
+@click.option('--estimate', is_flag=True, default=False,
+              help="Only estimate the number of mismatches of each type (with confidence intervals), from a "
+                   "stratified sample of each collection's paths. Nothing is fixed.")
+@click.option('--estimate-sample-size', type=int, default=DEFAULT_SAMPLE_SIZE,
+              help="Number of paths to sample from each collection (with --estimate)")
 @click.option('--index-missing', is_flag=True, default=False,
               help="Index on-disk datasets that have never been indexed")
 @click.option('--trash-missing', is_flag=True, default=False,
@@ -49,12 +80,28 @@ _LOG = structlog.get_logger()
               help="Trash any files that were archived at least '--min-trash-age' hours ago")
 @click.option('--min-trash-age-hours', is_flag=True, default=72, type=int,
               help="Minimum allowed archive age to trash a file")
-# TODO
-# @click.option('--validate', is_flag=True, default=False,
-#               help="Run any available checksums or validation checks for the file type")
+@click.option('--fix-batch-size', 'batch_size', type=int, default=None,
+              help="Apply index fixes in batches of this size (location changes in one transaction per batch)")
+@click.option('--fix-workers', type=int, default=1,
+              help="Number of threads applying fixes while the scan continues (1: apply them in line). "
+                   "With --format, the mismatches are partitioned between them by dataset and location")
+@click.option('--fix-queue-size', type=int, default=1000,
+              help="Maximum number of found mismatches waiting for the fix workers")
+@click.option('--validation-level',
+              type=click.Choice([level.name.lower() for level in cs.ValidationLevel]),
+              help="How thoroughly to check data files (default: the collection's own level)")
+@click.option('--shard',
+              callback=lambda ctx, param, value: _parse_shard(value),
+              help="Only sync the uris of one shard 'i/N' (0 <= i < N) of the collections, so that a sync "
+                   "can be split across many jobs. (See dea-sync-merge to combine their outputs)")
+@click.option('--checkpoint', 'checkpoint_file',
+              type=click.Path(writable=True, dir_okay=False),
+              help="Record progress in this file, skipping any work already recorded in it "
+                   "(rerun with the same file to resume a killed sync)")
 @click.option('-o', '--output', 'output_file',
               type=click.Path(writable=True, dir_okay=False),
-              help="Output to file instead of stdout")
+              help="Write the mismatches found to this file, readable with --format (as JSON lines, or "
+                   "in a compact columnar format if it ends with '.npz')")
 @click.argument('collection_specifiers',
                 # help = "Either names of collections or subfolders of collections"
                 nargs=-1, )
@@ -66,6 +113,20 @@ def cli(index: Index,
         output_file: str,
         min_trash_age_hours: bool,
         jobs: int,
+        prefetch_index: bool,
+        sorted_merge: bool,
+        incremental: bool,
+        index_first: bool,
+        staged: bool,
+        read_threads: int,
+        index_connections: int,
+        validation_level: str,
+        checkpoint_file: str,
+        shard: Shard,
+        fix_workers: int,
+        fix_queue_size: int,
+        estimate: bool,
+        estimate_sample_size: int,
         **fix_settings):
     """
     Update a datacube index to the state of the filesystem.
@@ -80,23 +141,124 @@ def cli(index: Index,
         sys.exit(1)
 
     cs.init_nci_collections(index)
+    # Ids read from files (and passed validations) are cached alongside the other sync caches
+    # (the workers inherit the setting).
+    dataset_ids.set_cache_path(Path(cache_folder).joinpath('dataset-ids.db'))
+
+    level = cs.ValidationLevel[validation_level.upper()] if validation_level else None
+    if level is None or level > cs.ValidationLevel.NONE:
+        # Imported here rather than at the top: it loads gdal (so unvalidated syncs don't need it)
+        from digitalearthau.sync import validate
+        validate.set_cache_path(Path(cache_folder).joinpath('validation.db'))
+
+    if estimate:
+        if format_:
+            click.echo('Estimates are sampled from collections: they can\'t be read from a file (-f)', err=True)
+            sys.exit(1)
+
+        for collection, uri_prefix in resolve_collections(collection_specifiers):
+            click.echo(format_estimate(estimate_mismatches(collection, Path(cache_folder),
+                                                           uri_prefix=uri_prefix,
+                                                           sample_size=estimate_sample_size,
+                                                           workers=jobs,
+                                                           validation_level=level)))
+        return
+
+    if checkpoint_file and output_file and output_file.endswith(differences.COLUMNAR_SUFFIX):
+        click.echo("A columnar report can't be resumed by a --checkpoint: it's unreadable if the job is killed. "
+                   "Write the report as JSON lines.", err=True)
+        sys.exit(1)
 
-    mismatches = get_mismatches(cache_folder, collection_specifiers, format_, jobs)
+    checkpoint = None
+    if checkpoint_file:
+        # A checkpoint is only valid for the same work.
+        checkpoint = Checkpoint(Path(checkpoint_file), settings=dict(
+            {name: fix_settings[name]
+             for name in ('index_missing', 'trash_missing', 'trash_archived', 'update_locations')},
+            collection_specifiers=collection_specifiers,
+            input_file=format_,
+            shard=str(shard) if shard else None,
+            min_trash_age_hours=min_trash_age_hours,
+            validation_level=validation_level,
+        ))
+        fix_settings['post_fix'] = checkpoint.applied
+        # PBS sends a TERM before killing a job: exit normally, so the checkpoint is written.
+        signal.signal(signal.SIGTERM, partial(_exit_on_term, os.getpid()))
 
-    out_f = sys.stdout
+    mismatches = get_mismatches(cache_folder, collection_specifiers, format_, jobs,
+                                prefetch_index=prefetch_index,
+                                sorted_merge=sorted_merge,
+                                incremental=incremental,
+                                index_first=index_first,
+                                validation_level=level,
+                                checkpoint=checkpoint,
+                                shard=shard,
+                                stages=StageSizes(read_threads, jobs, index_connections) if staged else None)
+
+    writer = None
     try:
         if output_file:
-            out_f = open(output_file, 'w')
+            # A resumed run adds to its previous output.
+            writer = differences.mismatch_writer(Path(output_file), append=bool(checkpoint))
+            mismatches = _write_mismatches(mismatches, writer)
+            if checkpoint:
+                checkpoint.before_write = writer.flush
 
-        fixes.fix_mismatches(
-            mismatches,
-            index,
-            min_trash_age_hours=min_trash_age_hours,
-            **fix_settings
-        )
+        if fix_workers > 1 and format_:
+            # A saved (finite) mismatch file can be split up between the workers.
+            fixes.fix_mismatches_partitioned(
+                mismatches,
+                index,
+                workers=fix_workers,
+                min_trash_age_hours=min_trash_age_hours,
+                **fix_settings
+            )
+        elif fix_workers > 1:
+            fixes.fix_mismatches_concurrently(
+                mismatches,
+                index,
+                workers=fix_workers,
+                queue_size=fix_queue_size,
+                min_trash_age_hours=min_trash_age_hours,
+                **fix_settings
+            )
+        else:
+            fixes.fix_mismatches(
+                mismatches,
+                index,
+                min_trash_age_hours=min_trash_age_hours,
+                **fix_settings
+            )
     finally:
-        if output_file:
-            out_f.close()
+        if writer:
+            writer.close()
+        if checkpoint:
+            checkpoint.close()
+
+
+def _parse_shard(spec: Optional[str]) -> Optional[Shard]:
+    if not spec:
+        return None
+    try:
+        return Shard.parse(spec)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _write_mismatches(mismatches: Iterable[Mismatch], writer) -> Iterable[Mismatch]:
+    for mismatch in mismatches:
+        writer.write(mismatch)
+        yield mismatch
+
+
+def _exit_on_term(main_pid: int, signum, frame):
+    # (Forked worker processes inherit the handler, but are stopped as usual)
+    if os.getpid() != main_pid:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        return
+    _LOG.warning("sync.terminated")
+    raise SystemExit(128 + signum)
 
 
 def resolve_collections(collection_specifiers: Iterable[str]) -> List[Tuple[cs.Collection, str]]:
@@ -151,17 +313,61 @@ def resolve_collections(collection_specifiers: Iterable[str]) -> List[Tuple[cs.C
 def get_mismatches(cache_folder: str,
                    collection_specifiers: Iterable[str],
                    input_file: str,
-                   job_count: int):
+                   job_count: int,
+                   prefetch_index=True,
+                   sorted_merge=False,
+                   incremental=False,
+                   index_first=False,
+                   validation_level: cs.ValidationLevel = None,
+                   checkpoint: Checkpoint = None,
+                   shard: Shard = None,
+                   stages: StageSizes = None):
     if input_file:
-        yield from differences.mismatches_from_file(Path(input_file))
-    else:
-        for collection, uri_prefix in resolve_collections(collection_specifiers):
-            yield from scan.mismatches_for_collection(
-                collection,
-                Path(cache_folder),
-                uri_prefix=uri_prefix,
-                workers=job_count
-            )
+        for mismatch in differences.mismatches_from_file(Path(input_file)):
+            if shard is not None and not shard.contains(mismatch.uri):
+                continue
+            if checkpoint is not None and checkpoint.was_applied(mismatch):
+                continue
+            yield mismatch
+        return
+
+    collection_prefixes = resolve_collections(collection_specifiers)
+    cache_path = Path(cache_folder)
+
+    with tempfile.TemporaryDirectory(prefix='fs-crawl-', dir=str(cache_path)) as spool_folder:
+        # Collections often share directory trees: crawl the filesystem once for those that do.
+        # Only the (cached) pieces of their path sets that have changed need crawling.
+        # (A sorted merge walks each collection itself, in order, and an index-first scan doesn't walk it at all)
+        # The collections are then scanned in turn, each one's path set built (and, if it shares no trees,
+        # walked) while the previous is scanned.
+        spool_files = {}
+        # (Reused when building each path set, rather than checked again)
+        pathset_checks = {}
+        if not sorted_merge:
+            shared = scan.overlapping_collections([(c, p) for c, p in collection_prefixes
+                                                   if not (index_first and c.trust is cs.Trust.INDEX)])
+            pathset_checks = {(c, p): scan.check_pathset(c, cache_path, p) for c, p in shared}
+            to_crawl = [(c, crawl_prefix)
+                        for (c, _), checked in pathset_checks.items()
+                        for crawl_prefix in checked.crawl_prefixes]
+            if len(set(c for c, _ in to_crawl)) > 1:
+                spool_files = scan.spool_fs_uris(to_crawl, Path(spool_folder))
+
+        yield from scan.mismatches_for_collections(
+            collection_prefixes,
+            cache_path,
+            workers=job_count,
+            prefetch_index=prefetch_index,
+            sorted_merge=sorted_merge,
+            incremental=incremental,
+            index_first=index_first,
+            fs_uris={key: scan.read_spool(spool_file) for key, spool_file in spool_files.items()},
+            pathset_checks=pathset_checks,
+            validation_level=validation_level,
+            checkpoint=checkpoint,
+            shard=shard,
+            stages=stages
+        )
 
 
 if __name__ == '__main__':
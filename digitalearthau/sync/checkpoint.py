@@ -0,0 +1,184 @@
+"""
+A record of a sync's progress, so that a killed sync job can be resumed without repeating completed work.
+
+A uri is complete once it has been scanned and every fix for its mismatches has been applied. Completed uris,
+and each applied fix, are written to the checkpoint file periodically (and at the end). A sync resumed
+with the same checkpoint skips the completed uris (and, when reading mismatches from a file, the fixes that
+were already applied), so a killed job only loses the work since its last checkpoint.
+
+The sync settings are recorded too: a checkpoint written with different settings (other fixes chosen)
+is not reused.
+
+A uri's mismatches must be safely written to the sync's report before the uri is recorded as complete (or
+a resumed job would never report them): the report is flushed before each checkpoint write.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping, Tuple, Any
+
+import structlog
+
+from .differences import Mismatch
+
+_LOG = structlog.get_logger()
+
+# Minimum time between writes of the checkpoint.
+WRITE_INTERVAL_SECS = int(os.environ.get('DEA_SYNC_CHECKPOINT_SECS') or 60)
+
+
+def _fix_key(mismatch: Mismatch) -> Tuple[str, str, str]:
+    d = mismatch.to_dict()
+    return d['name'], d['dataset_id'] or '', d['uri']
+
+
+class Checkpoint:
+    """
+    The progress of a sync, stored in a sqlite file.
+
+    It's used from both the scan and the fix threads, so all access is locked.
+    """
+
+    def __init__(self,
+                 path: Path,
+                 settings: Mapping[str, Any] = None,
+                 write_interval_secs: float = WRITE_INTERVAL_SECS,
+                 before_write: Callable[[], None] = None) -> None:
+        """
+        :param before_write: called before progress is written (eg. to flush the report of the mismatches)
+        """
+        self.path = path
+        self.write_interval_secs = write_interval_secs
+        self.before_write = before_write
+        self._lock = threading.RLock()
+
+        self._db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute('create table if not exists completed_uri (uri text primary key)')
+            self._db.execute('create table if not exists applied_fix ('
+                             'name text, dataset_id text, uri text, primary key (name, dataset_id, uri))')
+            self._db.execute('create table if not exists setting (name text primary key, value text)')
+        self._check_settings(json.dumps(settings or {}, sort_keys=True, default=str))
+
+        # Scanned uris with fixes still waiting to be applied: the number waiting.
+        self._outstanding = {}  # type: Dict[str, int]
+        # Not yet written to the file.
+        self._completed = []  # type: List[str]
+        self._fixes = []  # type: List[Tuple[str, str, str]]
+        self._last_write = time.time()
+
+        self.completed_count = 0
+        self.skipped_count = 0
+
+    def _check_settings(self, settings: str):
+        row = self._db.execute("select value from setting where name = 'settings'").fetchone()
+        if row is not None and row[0] != settings:
+            _LOG.warning("checkpoint.settings_changed", path=self.path, previous=row[0], settings=settings)
+            with self._db:
+                self._db.execute('delete from completed_uri')
+                self._db.execute('delete from applied_fix')
+            row = None
+
+        if row is None:
+            with self._db:
+                self._db.execute("insert or replace into setting values ('settings', ?)", (settings,))
+        else:
+            _LOG.info("checkpoint.resume", path=self.path, completed_uri_count=self.previous_completed_count())
+
+    def previous_completed_count(self) -> int:
+        with self._lock:
+            return self._db.execute('select count(*) from completed_uri').fetchone()[0]
+
+    def previous_completed_uris(self) -> List[str]:
+        """
+        The uris completed by previous runs.
+        """
+        with self._lock:
+            return [uri for uri, in self._db.execute('select uri from completed_uri')]
+
+    def is_complete(self, uri: str) -> bool:
+        """
+        Was the uri completed by a previous run?
+        """
+        with self._lock:
+            done = self._db.execute('select 1 from completed_uri where uri = ?', (uri,)).fetchone() is not None
+            self.skipped_count += done
+            return done
+
+    def was_applied(self, mismatch: Mismatch) -> bool:
+        """
+        Was the fix for this mismatch applied by a previous run?
+        """
+        with self._lock:
+            return self._db.execute(
+                'select 1 from applied_fix where name = ? and dataset_id = ? and uri = ?', _fix_key(mismatch)
+            ).fetchone() is not None
+
+    def scanned(self, uri: str, mismatch_count: int):
+        """
+        A uri has been scanned, and its mismatches are about to be fixed.
+        """
+        with self._lock:
+            if mismatch_count:
+                self._outstanding[uri] = self._outstanding.get(uri, 0) + mismatch_count
+            else:
+                self._complete(uri)
+            self._write_if_due()
+
+    def applied(self, mismatch: Mismatch):
+        """
+        The fixes for a mismatch have been applied.
+        """
+        with self._lock:
+            self._fixes.append(_fix_key(mismatch))
+
+            waiting = self._outstanding.get(mismatch.uri)
+            if waiting is not None:
+                if waiting <= 1:
+                    del self._outstanding[mismatch.uri]
+                    self._complete(mismatch.uri)
+                else:
+                    self._outstanding[mismatch.uri] = waiting - 1
+            self._write_if_due()
+
+    def _complete(self, uri: str):
+        self._completed.append(uri)
+        self.completed_count += 1
+
+    def _write_if_due(self):
+        if (time.time() - self._last_write) > self.write_interval_secs:
+            self.write()
+
+    def write(self):
+        with self._lock:
+            if self._completed or self._fixes:
+                if self.before_write:
+                    self.before_write()
+                with self._db:
+                    self._db.executemany('insert or ignore into completed_uri values (?)',
+                                         ((uri,) for uri in self._completed))
+                    self._db.executemany('insert or ignore into applied_fix values (?, ?, ?)', self._fixes)
+                _LOG.debug("checkpoint.write",
+                           completed_uri_count=len(self._completed), applied_fix_count=len(self._fixes))
+                self._completed = []
+                self._fixes = []
+            self._last_write = time.time()
+
+    def close(self):
+        with self._lock:
+            self.write()
+            self._db.close()
+        _LOG.info("checkpoint.done",
+                  path=self.path,
+                  completed_count=self.completed_count,
+                  skipped_count=self.skipped_count,
+                  incomplete_uri_count=len(self._outstanding))
+
+    def __enter__(self) -> 'Checkpoint':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,182 @@
+"""
+CF compliance checks of NetCDF files, run in a separate (long-lived) checker process.
+
+The compliance checker's plugins are slow to load, and checks of pathological files can take
+unbounded time or memory. So they're only loaded when a check is first needed, and checks run in a child
+process with a time limit per file and a memory limit: a file that exceeds them fails the check, and the
+child is restarted, rather than stalling the calling sync worker.
+
+(A subprocess is used rather than a multiprocessing pool, as sync workers are daemonic pool processes that
+can't have children of their own.)
+"""
+import json
+import os
+import resource
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+# Maximum time to check one file.
+TIMEOUT_SECS = float(os.environ.get('DEA_COMPLIANCE_TIMEOUT_SECS') or 300)
+# Maximum memory (address space) of the checker process. (0: unlimited)
+MEMORY_LIMIT_MB = int(os.environ.get('DEA_COMPLIANCE_MEMORY_LIMIT_MB') or 4096)
+
+CHECKER_COMMAND = [sys.executable, '-m', 'digitalearthau.sync.compliance']
+
+
+def _compliance_check(nc_path: Path, results_path: Path = None):
+    """
+    Run cf and adcc checks with normal strictness, verbose text format to stdout
+    """
+    from compliance_checker.runner import ComplianceChecker
+
+    # Specify a tempfile as a sink, as otherwise it will spew results into stdout.
+    out_file = str(results_path) if results_path else tempfile.mktemp(prefix='compliance-log-')
+
+    try:
+        was_success, errors_occurred = ComplianceChecker.run_checker(
+            ds_loc=str(nc_path),
+            checker_names=['cf'],
+            verbose=0,
+            criteria='lenient',
+            skip_checks=['check_dimension_order'],
+            output_filename=out_file,
+            output_format='text'
+        )
+    finally:
+        if not results_path and os.path.exists(out_file):
+            os.remove(out_file)
+
+    return was_success, errors_occurred
+
+
+class CheckerProcess:
+    """
+    A client of a checker child process, started on first use.
+
+    Checks are sent one at a time (concurrent callers wait their turn).
+    """
+
+    def __init__(self,
+                 timeout_secs: float = TIMEOUT_SECS,
+                 memory_limit_mb: int = MEMORY_LIMIT_MB,
+                 command: List[str] = None) -> None:
+        self.timeout_secs = timeout_secs
+        self.memory_limit_mb = memory_limit_mb
+        self.command = command or CHECKER_COMMAND
+        self._process = None  # type: subprocess.Popen
+        # The pid that started the child (a forked copy of this client must start its own)
+        self._owner_pid = None  # type: int
+        self._lock = threading.Lock()
+
+    def _start(self) -> subprocess.Popen:
+        if self._process is None or self._owner_pid != os.getpid() or self._process.poll() is not None:
+            _LOG.debug("compliance.checker.start", command=self.command)
+            # The child limits its own memory when it starts (a preexec_fn isn't safe in a threaded parent)
+            self._process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                env=dict(os.environ, DEA_COMPLIANCE_MEMORY_LIMIT_MB=str(self.memory_limit_mb)),
+            )
+            self._owner_pid = os.getpid()
+        return self._process
+
+    def stop(self):
+        if self._process is not None and self._owner_pid == os.getpid():
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def check(self, nc_path: Path) -> Tuple[bool, bool]:
+        """
+        Check the file, returning (was_success, errors_occurred).
+
+        A check that times out, or fails in the checker, is returned as unsuccessful.
+        """
+        log = _LOG.bind(path=nc_path)
+        with self._lock:
+            process = self._start()
+            try:
+                process.stdin.write(json.dumps({'path': str(nc_path)}) + '\n')
+                process.stdin.flush()
+
+                readable, _, _ = select.select([process.stdout], [], [], self.timeout_secs)
+                if not readable:
+                    log.warning("compliance.timeout", timeout_secs=self.timeout_secs)
+                    self.stop()
+                    return False, True
+
+                line = process.stdout.readline()
+            except OSError:
+                line = ''
+
+            if not line:
+                # It died: probably the memory limit.
+                log.warning("compliance.checker.died", return_code=process.poll())
+                self.stop()
+                return False, True
+
+        response = json.loads(line)
+        if 'error' in response:
+            log.warning("compliance.error", error=response['error'])
+            return False, True
+        return response['was_success'], response['errors_occurred']
+
+
+_CHECKER = None  # type: CheckerProcess
+
+
+def check_compliance(nc_path: Path) -> Tuple[bool, bool]:
+    """
+    Check the file in this process's checker process, returning (was_success, errors_occurred).
+    """
+    global _CHECKER  # pylint: disable=global-statement
+    if _CHECKER is None:
+        _CHECKER = CheckerProcess()
+    return _CHECKER.check(nc_path)
+
+
+def _limit_memory(memory_limit_mb: int):
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _serve():
+    """
+    Checker process: read a request per line from stdin, write a response line for each.
+    """
+    # Before the checker's plugins are loaded.
+    _limit_memory(MEMORY_LIMIT_MB)
+
+    # Responses go to the original stdout, anything printed by the checker to stderr.
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    from compliance_checker.runner import CheckSuite
+    # The 'load' method actually loads it globally, not on the specific instance.
+    CheckSuite().load_all_available_checkers()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            was_success, errors_occurred = _compliance_check(Path(request['path']))
+            response = dict(was_success=bool(was_success), errors_occurred=bool(errors_occurred))
+        except Exception as e:  # pylint: disable=broad-except
+            response = dict(error=repr(e))
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+
+if __name__ == '__main__':
+    _serve()
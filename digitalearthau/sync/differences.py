@@ -1,13 +1,17 @@
-import sys
+import json
+import os
+import zipfile
 from pathlib import Path
-from typing import Optional
+from typing import Dict, FrozenSet, Iterable, List, Optional, Type
 from uuid import UUID
 
+import numpy
 from boltons import strutils
-from boltons.jsonutils import JSONLIterator
 
 from digitalearthau.index import DatasetLite
-from digitalearthau.utils import simple_object_repr
+
+# Mismatch classes by their (serialised) type name.
+_MISMATCH_TYPES = {}  # type: Dict[str, Type[Mismatch]]
 
 
 class Mismatch:
@@ -16,11 +20,29 @@ class Mismatch:
 
     See the implementations for different types of mismataches.
     """
+    # There can be millions of these in a large sync.
+    __slots__ = ('dataset', 'uri', 'siblings')
+
+    # Name of the type when serialised (set for each subclass)
+    type_name = 'mismatch'
 
-    def __init__(self, dataset: Optional[DatasetLite], uri: str) -> None:
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.type_name = strutils.camel2under(cls.__name__)
+        _MISMATCH_TYPES[cls.type_name] = cls
+
+    def __init__(self,
+                 dataset: Optional[DatasetLite],
+                 uri: str,
+                 siblings: Optional[FrozenSet[DatasetLite]] = None) -> None:
+        """
+        :param siblings: all datasets indexed at the uri when it was scanned (with their archived times),
+            or None if unknown. They're not part of the mismatch's identity, and aren't serialised.
+        """
         super().__init__()
         self.dataset = dataset
         self.uri = uri
+        self.siblings = siblings
 
     def __repr__(self, *args, **kwargs):
         """
@@ -28,7 +50,7 @@ class Mismatch:
         Mismatch(dataset=DatasetLite(archived_time=None, id=UUID('96519c56-e133-11e6-a29f-185e0f80a5c0')), \
 uri='/tmp/test')
         """
-        return simple_object_repr(self)
+        return '{}(dataset={!r}, uri={!r})'.format(self.__class__.__name__, self.dataset, self.uri)
 
     def __eq__(self, other):
         """
@@ -45,23 +67,24 @@ uri='/tmp/test')
         if not isinstance(other, self.__class__):
             return False
 
-        return self.__dict__ == other.__dict__
+        return self.uri == other.uri and self.dataset == other.dataset
 
     def __hash__(self):
-        return hash(tuple(v for k, v in sorted(self.__dict__.items())))
+        return hash((self.dataset, self.uri))
 
     def to_dict(self):
         return dict(
-            name=strutils.camel2under(self.__class__.__name__),
+            name=self.type_name,
             dataset_id=str(self.dataset.id) if self.dataset else None,
             uri=self.uri
         )
 
     @staticmethod
     def from_dict(row: dict):
-
-        mismatch_class = getattr(sys.modules[__name__], strutils.under2camel(row['name']))
-        dataset_id = row['dataset_id'].strip()
+        mismatch_class = _MISMATCH_TYPES.get(row['name'])
+        if mismatch_class is None:
+            raise ValueError("Unknown mismatch type {!r}".format(row['name']))
+        dataset_id = (row['dataset_id'] or '').strip()
 
         dataset = None
         if dataset_id and dataset_id != 'None':
@@ -76,28 +99,28 @@ class LocationMissingOnDisk(Mismatch):
 
     (Note that there may still be a file at the location, but it is not this dataset)
     """
-    pass
+    __slots__ = ()
 
 
 class LocationNotIndexed(Mismatch):
     """
     An existing dataset has been found at a new location.
     """
-    pass
+    __slots__ = ()
 
 
 class DatasetNotIndexed(Mismatch):
     """
     A dataset on the filesystem is not in the index.
     """
-    pass
+    __slots__ = ()
 
 
 class ArchivedDatasetOnDisk(Mismatch):
     """
     A dataset on disk is archived in the index.
     """
-    pass
+    __slots__ = ()
 
 
 class UnreadableDataset(Mismatch):
@@ -106,23 +129,179 @@ class UnreadableDataset(Mismatch):
 
     We can't currently easily separate whether this is a temporary system/disk error or an actual corrupt dataset.
     """
-    pass
+    __slots__ = ()
 
 
 class InvalidDataset(Mismatch):
     """
     An error was returned from validation
     """
-    pass
+    __slots__ = ()
+
 
+# Suffix of the columnar report format (other files are JSON lines).
+COLUMNAR_SUFFIX = '.npz'
 
-def mismatches_from_file(path: Path):
+
+def mismatch_line(mismatch: Mismatch) -> str:
+    """
+    A mismatch as a line of a JSON lines report.
+    """
+    return json.dumps(mismatch.to_dict()) + '\n'
+
+
+class JsonLinesWriter:
+    """
+    Write mismatches as they're found to a JSON lines report (one mismatch per line).
     """
-    Load mismatches from a json lines file
+
+    def __init__(self, path: Path, append: bool = False) -> None:
+        self._f = path.open('a' if append else 'w')
+
+    def write(self, mismatch: Mismatch):
+        self._f.write(mismatch_line(mismatch))
+
+    def flush(self):
+        """
+        Make sure everything written so far is on disk.
+        """
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# A dataset id of zeros in the columnar format means no dataset.
+_NO_DATASET = bytes(16)
+
+
+class ColumnarWriter:
     """
+    Write mismatches to a compact columnar report: blocks of numpy arrays in a (compressed) zip file.
+
+    Each block has a column for each field of the mismatches: their type, dataset id (16 bytes) and uri. Uris
+    are split into their folder, stored once per block, and the file name.
+
+    Blocks are written as they fill, so memory use is bounded.
+
+    The zip's index is only written when it's closed, so a report that wasn't closed (eg. a killed job) can't
+    be read or appended to.
+    """
+
+    def __init__(self, path: Path, append: bool = False, block_size: int = 100000) -> None:
+        self.block_size = block_size
+        self._zip = zipfile.ZipFile(str(path), 'a' if append and path.exists() else 'w',
+                                    compression=zipfile.ZIP_DEFLATED)
+        self._block_count = len(_block_names(self._zip))
+        self._block = []  # type: List[Mismatch]
+
+    def write(self, mismatch: Mismatch):
+        self._block.append(mismatch)
+        if len(self._block) >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._block:
+            return
+        type_names = sorted(set(m.type_name for m in self._block))
+        folders = {}  # type: Dict[str, int]
+        folder_indexes, file_names = [], []
+        for m in self._block:
+            folder, _, file_name = m.uri.rpartition('/')
+            folder_indexes.append(folders.setdefault(folder, len(folders)))
+            file_names.append(file_name)
+
+        columns = dict(
+            types=numpy.array(type_names),
+            type=numpy.array([type_names.index(m.type_name) for m in self._block], dtype='u1'),
+            dataset_id=numpy.array([m.dataset.id.bytes if m.dataset else _NO_DATASET for m in self._block],
+                                   dtype='S16'),
+            folders=numpy.array(list(folders)),
+            folder=numpy.array(folder_indexes, dtype='u4'),
+            file_name=numpy.array(file_names),
+        )
+        block_name = '{:06d}'.format(self._block_count)
+        for name, array in columns.items():
+            with self._zip.open('{}/{}.npy'.format(block_name, name), 'w') as f:
+                numpy.lib.format.write_array(f, array, allow_pickle=False)
+
+        self._block_count += 1
+        self._block = []
+
+    def close(self):
+        self._write_block()
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _block_names(zip_file: zipfile.ZipFile) -> List[str]:
+    return sorted(set(name.split('/', 1)[0] for name in zip_file.namelist()))
+
+
+def mismatch_writer(path: Path, append: bool = False):
+    """
+    Get a writer for a report at the given path: columnar if it has the columnar suffix, otherwise JSON lines.
+    """
+    if path.suffix == COLUMNAR_SUFFIX:
+        return ColumnarWriter(path, append=append)
+    return JsonLinesWriter(path, append=append)
+
+
+def mismatches_from_file(path: Path) -> Iterable[Mismatch]:
+    """
+    Load mismatches from a report: json lines, or the columnar format.
+    """
+    if path.suffix == COLUMNAR_SUFFIX:
+        yield from _mismatches_from_columnar_file(path)
+        return
+
+    # (There may be millions of rows: the per-row work is kept minimal)
+    decode = json.JSONDecoder().raw_decode
+    types = _MISMATCH_TYPES
     with path.open('r') as f:
-        for row in JSONLIterator(f):
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row, _ = decode(line)
             if not row:
                 continue
 
-            yield Mismatch.from_dict(row)
+            mismatch_class = types.get(row['name'])
+            dataset_id = row['dataset_id']
+            if mismatch_class is None or (dataset_id and dataset_id != dataset_id.strip()):
+                # Unusual: leave it to the full checks
+                yield Mismatch.from_dict(row)
+                continue
+
+            dataset = DatasetLite(UUID(dataset_id)) if dataset_id and dataset_id != 'None' else None
+            yield mismatch_class(dataset, row['uri'].strip())
+
+
+def _mismatches_from_columnar_file(path: Path) -> Iterable[Mismatch]:
+    with zipfile.ZipFile(str(path)) as zip_file:
+        for block_name in _block_names(zip_file):
+            def read(name):
+                with zip_file.open('{}/{}.npy'.format(block_name, name)) as f:
+                    return numpy.lib.format.read_array(f, allow_pickle=False)
+
+            types = [_MISMATCH_TYPES[name] for name in read('types').tolist()]
+            folders = read('folders').tolist()
+            for type_, dataset_id, folder, file_name in zip(read('type').tolist(),
+                                                             read('dataset_id').tolist(),
+                                                             read('folder').tolist(),
+                                                             read('file_name').tolist()):
+                dataset = DatasetLite(UUID(bytes=dataset_id.ljust(16, b'\0'))) if dataset_id else None
+                yield types[type_](dataset, folders[folder] + '/' + file_name)
@@ -0,0 +1,164 @@
+"""
+Hand out work to a process pool in chunks sized by how long the work is taking.
+
+The time to check a uri varies widely between collections (and within them): a telemetry folder takes
+milliseconds, a validated NetCDF stack seconds. A fixed chunk size is either too small for the quick ones
+(most time is spent passing messages) or too large for the slow ones (a few workers are left with long chunks
+at the end while the others are idle).
+
+So chunks are instead sized to take roughly a target time, from the average time per item measured so far,
+and only a couple of chunks per worker are queued at once.
+"""
+import os
+import queue
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+import structlog
+
+from digitalearthau import filecache
+
+_LOG = structlog.get_logger()
+
+# Time that each chunk of work should take.
+TARGET_CHUNK_SECS = float(os.environ.get('DEA_SYNC_CHUNK_SECS') or 1.0)
+MAX_CHUNKSIZE = 1000
+# Chunks queued per worker (so that a worker has its next chunk waiting when it finishes one).
+CHUNKS_PER_WORKER = 2
+
+# Weight of the latest chunk in the average time per item.
+_AVERAGE_WEIGHT = 0.3
+
+
+def _run_chunk(function: Callable, items: List) -> Tuple[List, float, int]:
+    """
+    Run in a worker: returns the results, the time taken, and the worker's pid.
+    """
+    start_time = time.time()
+    try:
+        results = [function(item) for item in items]
+    finally:
+        # (The pool's workers are terminated without writing their caches at exit)
+        filecache.flush_all()
+    return results, time.time() - start_time, os.getpid()
+
+
+class AdaptiveDispatcher:
+    """
+    Map a function over items with a pool, yielding the results in the order they complete.
+
+    (Like the pool's own ``imap_unordered``, but with adaptive chunk sizes.)
+
+    A fixed chunk size can be given instead of adapting it.
+    """
+
+    def __init__(self,
+                 pool,
+                 workers: int,
+                 chunksize: int = None,
+                 target_chunk_secs: float = TARGET_CHUNK_SECS,
+                 max_chunksize: int = MAX_CHUNKSIZE) -> None:
+        self.pool = pool
+        self.workers = workers
+        self.fixed_chunksize = chunksize
+        self.target_chunk_secs = target_chunk_secs
+        self.max_chunksize = max_chunksize
+
+        # Measured average time per item.
+        self.item_secs = None  # type: float
+
+        self.chunk_count = 0
+        self.item_count = 0
+        self.chunksize_range = None  # type: Tuple[int, int]
+        # Busy time of each worker (by pid)
+        self.busy_secs = {}  # type: Dict[int, float]
+        self.start_time = None  # type: float
+        self.end_time = None  # type: float
+
+    def next_chunksize(self) -> int:
+        """
+        >>> d = AdaptiveDispatcher(None, workers=2, target_chunk_secs=1.0)
+        >>> d.next_chunksize()
+        1
+        >>> d.item_secs = 0.01
+        >>> d.next_chunksize()
+        100
+        >>> d.item_secs = 5
+        >>> d.next_chunksize()
+        1
+        """
+        if self.fixed_chunksize:
+            return self.fixed_chunksize
+        if self.item_secs is None:
+            # Nothing measured yet.
+            return 1
+        return max(1, min(self.max_chunksize, int(self.target_chunk_secs / max(self.item_secs, 1e-6))))
+
+    def _record(self, chunk_size: int, secs: float, pid: int):
+        self.busy_secs[pid] = self.busy_secs.get(pid, 0.0) + secs
+
+        item_secs = secs / chunk_size
+        if self.item_secs is None:
+            self.item_secs = item_secs
+        else:
+            self.item_secs = _AVERAGE_WEIGHT * item_secs + (1 - _AVERAGE_WEIGHT) * self.item_secs
+
+    def imap_unordered(self, function: Callable, items: Iterable) -> Iterator[Any]:
+        self.start_time = time.time()
+        items = iter(items)
+        done = queue.Queue()  # type: queue.Queue
+        outstanding = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and outstanding < self.workers * CHUNKS_PER_WORKER:
+                size = self.next_chunksize()
+                chunk = [item for _, item in zip(range(size), items)]
+                if not chunk:
+                    exhausted = True
+                    break
+                self.pool.apply_async(
+                    _run_chunk, (function, chunk),
+                    callback=lambda result, size=len(chunk): done.put((size, result, None)),
+                    error_callback=lambda e: done.put((0, None, e)),
+                )
+                outstanding += 1
+                self.chunk_count += 1
+                self.item_count += len(chunk)
+                low, high = self.chunksize_range or (len(chunk), len(chunk))
+                self.chunksize_range = (min(low, len(chunk)), max(high, len(chunk)))
+
+            if not outstanding:
+                break
+
+            size, result, error = done.get()
+            outstanding -= 1
+            if error is not None:
+                raise error
+
+            results, secs, pid = result
+            self._record(size, secs, pid)
+            yield from results
+
+        self.end_time = time.time()
+
+    def utilisation(self) -> float:
+        """
+        The fraction of the workers' time that was spent working.
+        """
+        end_time = self.end_time or time.time()
+        available = (end_time - (self.start_time or end_time)) * self.workers
+        if not available:
+            return 0.0
+        return min(1.0, sum(self.busy_secs.values()) / available)
+
+    def log_summary(self, log=_LOG):
+        busy = sorted(self.busy_secs.values())
+        log.info("scan.dispatch",
+                 workers=self.workers,
+                 utilisation=round(self.utilisation(), 3),
+                 chunk_count=self.chunk_count,
+                 item_count=self.item_count,
+                 chunksize_range=self.chunksize_range,
+                 item_secs=round(self.item_secs, 4) if self.item_secs is not None else None,
+                 worker_busy_secs_range=(round(busy[0], 1), round(busy[-1], 1)) if busy else None)
@@ -0,0 +1,234 @@
+"""
+Estimate how out of sync a collection is, from a sample of its uris, before committing to a full sync.
+
+The uris of the collection's path set are split into strata by the folder above their dataset entries (eg. each
+year/month folder), and a random sample is drawn from each, in proportion to its size. The sampled uris are
+compared as in a normal sync, and the total of each type of mismatch is estimated with a confidence interval
+(the usual stratified estimator of a total, with the finite population correction).
+
+A rare type of mismatch may not be sampled at all: its estimate is then zero, with no interval.
+"""
+import math
+import random
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Tuple
+
+import structlog
+
+from digitalearthau import walk
+from digitalearthau.collections import Collection, ValidationLevel
+from digitalearthau.sync import scan
+
+_LOG = structlog.get_logger()
+
+# Default number of uris to sample from a collection.
+DEFAULT_SAMPLE_SIZE = 2000
+
+# Standard normal quantile of a two-sided 95% confidence interval.
+_Z_95 = 1.96
+
+
+class TypeEstimate(NamedTuple):
+    """
+    The estimated total of one type of mismatch, with its 95% confidence interval.
+    """
+    type_name: str
+    # Number of the type found in the sample.
+    sample_count: int
+    estimate: float
+    low: float
+    high: float
+
+
+class CollectionEstimate(NamedTuple):
+    collection_name: str
+    uri_prefix: str
+    uri_count: int
+    stratum_count: int
+    sample_size: int
+    mismatches: List[TypeEstimate]
+
+
+def estimate_mismatches(collection: Collection,
+                        cache_path: Path,
+                        uri_prefix: str = scan.ROOT_URI,
+                        sample_size: int = DEFAULT_SAMPLE_SIZE,
+                        workers: int = 2,
+                        validation_level: ValidationLevel = None,
+                        seed: int = None) -> CollectionEstimate:
+    """
+    Estimate the number of mismatches of each type in the collection (within the uri prefix) from a stratified
+    sample of its path set.
+    """
+    log = _LOG.bind(collection=collection.name, uri_prefix=uri_prefix)
+    path_set = scan.build_pathset(collection, cache_path, log=log, uri_prefix=uri_prefix)
+
+    samples = stratified_sample(lambda: path_set.iterkeys(uri_prefix),
+                                stratifier(collection.file_patterns),
+                                sample_size,
+                                rng=random.Random(seed))
+    sampled_uris = [uri for _, uris in samples.values() for uri in uris]
+    log.info("estimate.sample.drawn",
+             uri_count=sum(population for population, _ in samples.values()),
+             stratum_count=len(samples),
+             sample_size=len(sampled_uris))
+
+    mismatches = iter(scan.compare_uris(collection, sampled_uris, workers=workers,
+                                        validation_level=validation_level))
+    counts = {
+        stratum: (population, [Counter(m.__class__.__name__ for m in next(mismatches)) for _ in uris])
+        for stratum, (population, uris) in samples.items()
+    }
+    return CollectionEstimate(
+        collection_name=collection.name,
+        uri_prefix=uri_prefix,
+        uri_count=sum(population for population, _ in samples.values()),
+        stratum_count=len(samples),
+        sample_size=len(sampled_uris),
+        mismatches=estimate_totals(counts),
+    )
+
+
+def stratifier(file_patterns: Iterable[str]) -> Callable[[str], str]:
+    """
+    Get a function giving the stratum of a uri: its folder above the dataset entries of the file patterns.
+
+    >>> stratum = stratifier(['/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml'])
+    >>> stratum('file:///g/data/v10/reprocess/ls8/level1/2016/04/LS8_SCENE/ga-metadata.yaml')
+    'file:///g/data/v10/reprocess/ls8/level1/2016/04'
+    >>> # Index locations outside of the patterns are stratified by their own folder.
+    >>> stratum('file:///elsewhere/LS8_SCENE/ga-metadata.yaml')
+    'file:///elsewhere/LS8_SCENE'
+    """
+    # The uri of each pattern's base, and the number of levels from its dataset entries to the end of a uri.
+    levels = []  # type: List[Tuple[str, int]]
+    for pattern in file_patterns:
+        base, matchers = walk.split_pattern(pattern)
+        wildcard_levels = [i for i, m in enumerate(matchers) if not m.is_literal]
+        levels.append((Path(base).as_uri().rstrip('/') + '/',
+                       len(matchers) - (wildcard_levels[-1] if wildcard_levels else len(matchers) - 1)))
+
+    def stratum(uri: str) -> str:
+        for base_uri, entry_levels in levels:
+            if uri.startswith(base_uri):
+                return uri.rsplit('/', entry_levels)[0]
+        return uri.rsplit('/', 1)[0]
+
+    return stratum
+
+
+def stratified_sample(iter_uris: Callable[[], Iterable[str]],
+                      stratum: Callable[[str], str],
+                      sample_size: int,
+                      rng: random.Random = None) -> Dict[str, Tuple[int, List[str]]]:
+    """
+    Draw a random sample of the uris, stratified and allocated in proportion to the size of each stratum
+    (at least two from each, so that its variance can be estimated).
+
+    If there are too many strata for the sample size, they're merged into their parent folders.
+
+    The uris are read twice (to count the strata, then to draw from them), rather than held in memory.
+
+    Returns the population size and sampled uris of each stratum.
+    """
+    rng = rng or random.Random()
+
+    populations = Counter(stratum(uri) for uri in iter_uris())
+    # Coarser strata, until there are few enough to sample at least two from each.
+    parent_levels = 0
+    while len(populations) > max(sample_size // 2, 1):
+        parents = Counter()  # type: Counter
+        for name, population in populations.items():
+            parents[name.rsplit('/', 1)[0]] += population
+        if len(parents) == len(populations):
+            break
+        populations = parents
+        parent_levels += 1
+
+    def coarse_stratum(uri: str) -> str:
+        name = stratum(uri)
+        return name.rsplit('/', parent_levels)[0] if parent_levels else name
+
+    total = sum(populations.values())
+    chosen = {
+        name: set(rng.sample(range(population),
+                             min(population, max(2, round(sample_size * population / total)))))
+        for name, population in populations.items()
+    }
+
+    # The population and sampled uris of each stratum.
+    samples = {
+        name: (population, []) for name, population in populations.items()
+    }  # type: Dict[str, Tuple[int, List[str]]]
+    positions = Counter()  # type: Counter
+    for uri in iter_uris():
+        name = coarse_stratum(uri)
+        if positions[name] in chosen[name]:
+            samples[name][1].append(uri)
+        positions[name] += 1
+    return samples
+
+
+def estimate_totals(samples: Mapping[str, Tuple[int, List[Counter]]]) -> List[TypeEstimate]:
+    """
+    Estimate the total number of each type of mismatch from a stratified sample.
+
+    :param samples: the population size of each stratum, and the mismatch counts (by type) of each of its
+        sampled uris.
+
+    >>> estimate_totals({
+    ...     '2016/01': (100, [Counter(), Counter(LocationMissingOnDisk=1)]),
+    ...     '2016/02': (10, [Counter(), Counter()]),
+    ... })
+    [TypeEstimate(type_name='LocationMissingOnDisk', sample_count=1, estimate=50.0, low=0.0, high=147.0)]
+    """
+    type_names = sorted(set(name for _, uri_counts in samples.values() for c in uri_counts for name in c))
+
+    estimates = []
+    for type_name in type_names:
+        total = variance = 0.0
+        sample_count = 0
+        for population, uri_counts in samples.values():
+            values = [c[type_name] for c in uri_counts]
+            n = len(values)
+            if not n:
+                continue
+            sample_count += sum(values)
+            mean = sum(values) / n
+            total += population * mean
+            if n > 1:
+                sample_variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+                variance += population ** 2 * (1 - n / population) * sample_variance / n
+
+        margin = _Z_95 * math.sqrt(variance)
+        estimates.append(TypeEstimate(
+            type_name=type_name,
+            sample_count=sample_count,
+            estimate=round(total, 1),
+            low=round(max(total - margin, 0.0), 1),
+            high=round(total + margin, 1),
+        ))
+    return estimates
+
+
+def format_estimate(estimate: CollectionEstimate) -> str:
+    """
+    A readable report of a collection's estimate.
+
+    >>> print(format_estimate(CollectionEstimate('ls8_level1_scene', 'file:///', 123456, 40, 2001,
+    ...                                          [TypeEstimate('LocationMissingOnDisk', 3, 185.1, 0.0, 395.2)])))
+    ls8_level1_scene (file:///): 123,456 uris in 40 strata, 2,001 sampled
+               LocationMissingOnDisk          185 (95% CI 0 - 395, 3 sampled)
+    """
+    lines = ['{} ({}): {:,} uris in {:,} strata, {:,} sampled'.format(
+        estimate.collection_name, estimate.uri_prefix, estimate.uri_count, estimate.stratum_count,
+        estimate.sample_size
+    )]
+    if not estimate.mismatches:
+        lines.append('    No mismatches sampled')
+    for e in estimate.mismatches:
+        lines.append('    {:>28} {:>12,.0f} (95% CI {:,.0f} - {:,.0f}, {:,} sampled)'.format(
+            e.type_name, e.estimate, e.low, e.high, e.sample_count
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,112 @@
+"""
+Sort more uris than fit in memory, by spilling sorted runs to disk and merging them.
+
+A large collection has tens of millions of uris (in the index and on disk). Sorting them all in memory
+takes gigabytes, so instead they're sorted in runs of a fixed size, each written to its own file,
+and the runs are then merged as a stream. Memory use is bounded by the run size, whatever the collection size.
+"""
+import heapq
+import os
+import tempfile
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+# Number of uris sorted in memory at once (roughly 150 bytes each, plus python's overhead).
+RUN_SIZE = int(os.environ.get('DEA_SYNC_SORT_RUN_SIZE') or 500000)
+# Most files merged (and so open) at once.
+MAX_MERGE_FILES = int(os.environ.get('DEA_SYNC_SORT_MAX_MERGE_FILES') or 256)
+
+
+def sorted_unique(items: Iterable[str], spool_folder: Path = None, run_size: int = RUN_SIZE) -> Iterator[str]:
+    """
+    Sort the strings (by code point, the same order as their utf-8 bytes), removing duplicates.
+
+    If there are more than run_size, the sorted runs are spilled to files in the spool folder
+    (or the system's temp folder), which are removed once the result has been read.
+
+    >>> list(sorted_unique(['b', 'a', 'c', 'a', 'b']))
+    ['a', 'b', 'c']
+    >>> list(sorted_unique([]))
+    []
+    """
+    items = iter(items)
+    run = list(islice(items, run_size))
+    if len(run) < run_size:
+        # It all fits in memory.
+        yield from sorted(set(run))
+        return
+
+    with tempfile.TemporaryDirectory(prefix='sort-runs-', dir=str(spool_folder) if spool_folder else None) as folder:
+        run_files = []  # type: List[Path]
+        while run:
+            run_file = Path(folder).joinpath('run-{:05d}.txt'.format(len(run_files)))
+            with run_file.open('w', encoding='utf-8') as f:
+                write_lines(sorted(set(run)), f)
+            run_files.append(run_file)
+            run = list(islice(items, run_size))
+
+        _LOG.debug("sort.runs.spilled", run_count=len(run_files), run_size=run_size)
+        yield from merge_unique_files(run_files, spool_folder=Path(folder))
+
+
+def merge_unique(sorted_items: Iterable[Iterable[str]]) -> Iterator[str]:
+    """
+    Merge already-sorted streams into one sorted stream, removing duplicates.
+
+    >>> list(merge_unique([['a', 'c'], ['b', 'c', 'd']]))
+    ['a', 'b', 'c', 'd']
+    """
+    return _unique(heapq.merge(*sorted_items))
+
+
+def merge_unique_files(paths: List[Path],
+                       spool_folder: Path = None,
+                       max_files: int = MAX_MERGE_FILES) -> Iterator[str]:
+    """
+    Merge sorted files (written by this module) into one sorted stream, removing duplicates.
+
+    If there are more than max_files, they're first merged in groups into intermediate files (in the spool folder),
+    so that no more than max_files are open at once.
+    """
+    if len(paths) <= max_files:
+        yield from merge_unique(read_lines(path) for path in paths)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='sort-merge-', dir=str(spool_folder) if spool_folder else None) as folder:
+        merged_count = 0
+        while len(paths) > max_files:
+            merged = []  # type: List[Path]
+            for i in range(0, len(paths), max_files):
+                merged_file = Path(folder).joinpath('merged-{:05d}.txt'.format(merged_count))
+                with merged_file.open('w', encoding='utf-8') as f:
+                    write_lines(merge_unique(read_lines(path) for path in paths[i:i + max_files]), f)
+                merged.append(merged_file)
+                merged_count += 1
+            paths = merged
+        yield from merge_unique(read_lines(path) for path in paths)
+
+
+def read_lines(path: Path) -> Iterator[str]:
+    """
+    The lines of a (sorted) file written by this module.
+    """
+    with path.open('r', encoding='utf-8') as f:
+        for line in f:
+            yield line[:-1]
+
+
+def write_lines(items: Iterable[str], f):
+    f.writelines(item + '\n' for item in items)
+
+
+def _unique(sorted_items: Iterable[str]) -> Iterator[str]:
+    last = None
+    for item in sorted_items:
+        if item != last:
+            yield item
+            last = item
@@ -1,12 +1,23 @@
+import contextlib
+import heapq
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import singledispatch
-from typing import Iterable, Callable
+from typing import Iterable, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+from uuid import UUID
 
 import structlog
 from dateutil import tz
 
 from datacube.index import Index
-from digitalearthau.index import add_dataset, get_datasets_for_uri
+from datacube.index.hl import Doc2Dataset
+from digitalearthau.index import DatasetLite, add_dataset, get_datasets_for_uri, \
+    update_locations as update_index_locations
 from digitalearthau.paths import trash_uri
 from digitalearthau.sync.differences import UnreadableDataset
 from .differences import DatasetNotIndexed, Mismatch, ArchivedDatasetOnDisk, LocationNotIndexed, LocationMissingOnDisk
@@ -17,6 +28,8 @@ _LOG = structlog.get_logger()
 # underscore function names are the norm with singledispatch
 # pylint: disable=function-redefined
 
+# The index fixes return True if they changed the index at the mismatch's location.
+
 
 @singledispatch
 def do_index_missing(mismatch: Mismatch, index: Index):
@@ -27,6 +40,7 @@ def do_index_missing(mismatch: Mismatch, index: Index):
 def _add_missing(mismatch: DatasetNotIndexed, index: Index):
     _LOG.info("index_dataset", mismatch=mismatch)
     add_dataset(index, mismatch.dataset.id, mismatch.uri)
+    return True
 
 
 @singledispatch
@@ -38,16 +52,22 @@ def do_update_locations(mismatch: Mismatch, index: Index):
 def _remove_location(mismatch: LocationMissingOnDisk, index: Index):
     _LOG.info("remove_location", mismatch=mismatch)
     index.datasets.remove_location(mismatch.dataset.id, mismatch.uri)
+    return True
 
 
 @do_update_locations.register(LocationNotIndexed)
 def _add_location(mismatch: LocationNotIndexed, index: Index):
     _LOG.info("add_location", mismatch=mismatch)
     index.datasets.add_location(mismatch.dataset.id, mismatch.uri)
+    return True
+
 
+# The trash fixes check the datasets at the location. Siblings given (as found by the scan) can rule out a trash
+# without a query, but they may be hours old: the index's current ones are always checked before trashing.
 
 @singledispatch
-def do_trash_archived(mismatch: Mismatch, index: Index, min_age_hours: int):
+def do_trash_archived(mismatch: Mismatch, index: Index, min_age_hours: int,
+                      siblings: Optional[FrozenSet[DatasetLite]] = None):
     pass
 
 
@@ -59,41 +79,221 @@ def _as_utc(d):
 
 
 @do_trash_archived.register(ArchivedDatasetOnDisk)
-def _trash_archived_dataset(mismatch: ArchivedDatasetOnDisk, index: Index, min_age_hours: int):
+def _trash_archived_dataset(mismatch: ArchivedDatasetOnDisk, index: Index, min_age_hours: int,
+                            siblings: Optional[FrozenSet[DatasetLite]] = None):
     latest_archived_time = datetime.utcnow().replace(tzinfo=tz.tzutc()) - timedelta(hours=min_age_hours)
 
+    if siblings is not None and not _all_archived_before(siblings, latest_archived_time, mismatch):
+        return
+    if not _all_archived_before(get_datasets_for_uri(index, mismatch.uri), latest_archived_time, mismatch):
+        return
+
+    trash_uri(mismatch.uri)
+
+
+def _all_archived_before(siblings: Iterable[DatasetLite], latest_archived_time: datetime, mismatch: Mismatch):
     # all datasets at location must have been archived to trash.
-    for dataset in index.datasets.get_datasets_for_location(mismatch.uri):
+    for dataset in siblings:
         # Must be archived
         if dataset.archived_time is None:
             _LOG.warning("do_trash_archived.active_siblings", dataset_id=mismatch.dataset.id)
-            return
+            return False
         # Archived more than min_age_hours ago
         if _as_utc(dataset.archived_time) > latest_archived_time:
             _LOG.info("do_trash_archived.too_young", dataset_id=mismatch.dataset.id)
-            return
-
-    trash_uri(mismatch.uri)
+            return False
+    return True
 
 
 @singledispatch
-def do_trash_missing(mismatch: Mismatch, index: Index):
+def do_trash_missing(mismatch: Mismatch, index: Index, siblings: Optional[FrozenSet[DatasetLite]] = None):
     pass
 
 
 @do_trash_missing.register(DatasetNotIndexed)
 # An unreadable dataset that passes the below sibling check should be considered missing from the index.
 @do_trash_missing.register(UnreadableDataset)
-def _trash_missing_dataset(mismatch: DatasetNotIndexed, index: Index):
+def _trash_missing_dataset(mismatch: DatasetNotIndexed, index: Index,
+                           siblings: Optional[FrozenSet[DatasetLite]] = None):
     # If any (other) indexed datasets exist at the same location we can't trash it.
-    datasets_at_location = list(get_datasets_for_uri(index, mismatch.uri))
-    if datasets_at_location:
+    if siblings or any(True for _ in get_datasets_for_uri(index, mismatch.uri)):
         _LOG.warning("do_trash_missing.indexed_siblings_exist", uri=mismatch.uri)
         return
 
     trash_uri(mismatch.uri)
 
 
+class _ForkGuard:
+    """
+    Pauses fix threads while the process forks (such as when the scan starts its worker pool).
+
+    Otherwise a lock held by a fix thread at that moment (eg. stdout's, while logging) would be inherited
+    held by the child, and never released.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        # Threads currently applying a fix
+        self._active = set()  # type: Set[int]
+        self._forking = False
+
+    @contextlib.contextmanager
+    def fixing(self):
+        with self._condition:
+            while self._forking:
+                self._condition.wait()
+            self._active.add(threading.get_ident())
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active.discard(threading.get_ident())
+                self._condition.notify_all()
+
+    def before_fork(self):
+        with self._condition:
+            self._forking = True
+            # (The forking thread may itself be fixing)
+            while self._active - {threading.get_ident()}:
+                self._condition.wait()
+
+    def after_fork_in_parent(self):
+        with self._condition:
+            self._forking = False
+            self._condition.notify_all()
+
+    def after_fork_in_child(self):
+        self.__init__()
+
+
+_FORK_GUARD = _ForkGuard()
+os.register_at_fork(before=_FORK_GUARD.before_fork,
+                    after_in_parent=_FORK_GUARD.after_fork_in_parent,
+                    after_in_child=_FORK_GUARD.after_fork_in_child)
+
+
+class _FixBatch:
+    """
+    Index fixes waiting to be applied together.
+
+    All location changes of a batch are applied in one transaction. Missing datasets are indexed
+    sharing one dataset resolver.
+    """
+
+    def __init__(self, index: Index, batch_size: int, post_fix: Callable[[Mismatch], None] = None) -> None:
+        self.index = index
+        self.batch_size = batch_size
+        self.post_fix = post_fix
+
+        self.locations_to_add = []  # type: List[Tuple[UUID, str]]
+        self.locations_to_remove = []  # type: List[Tuple[UUID, str]]
+        self.datasets_to_add = []  # type: List[Tuple[UUID, str]]
+        # The uris with changes waiting.
+        self.pending_uris = set()  # type: Set[str]
+        # Mismatches handled since the last flush (their fixes are only complete once it's applied).
+        self.handled = []  # type: List[Mismatch]
+
+    def add_location(self, mismatch: Mismatch):
+        self.locations_to_add.append((mismatch.dataset.id, mismatch.uri))
+        self.pending_uris.add(mismatch.uri)
+        self._flush_full()
+
+    def remove_location(self, mismatch: Mismatch):
+        self.locations_to_remove.append((mismatch.dataset.id, mismatch.uri))
+        self.pending_uris.add(mismatch.uri)
+        self._flush_full()
+
+    def add_dataset(self, mismatch: Mismatch):
+        self.datasets_to_add.append((mismatch.dataset.id, mismatch.uri))
+        self.pending_uris.add(mismatch.uri)
+        self._flush_full()
+
+    def before_fs_change(self, uri: str):
+        """
+        Apply any pending index changes for the uri, as filesystem fixes check the index state.
+        """
+        if uri in self.pending_uris:
+            self.flush()
+
+    def _flush_full(self):
+        if max(len(self.locations_to_add) + len(self.locations_to_remove),
+               len(self.datasets_to_add)) >= self.batch_size:
+            self.flush()
+
+    def flush_locations(self):
+        if not (self.locations_to_add or self.locations_to_remove):
+            return
+        start_time = time.time()
+        added_count, removed_count = update_index_locations(self.index,
+                                                            to_add=self.locations_to_add,
+                                                            to_remove=self.locations_to_remove)
+        _LOG.info("fix.batch.locations",
+                  add_count=len(self.locations_to_add), added_count=added_count,
+                  remove_count=len(self.locations_to_remove), removed_count=removed_count,
+                  secs=round(time.time() - start_time, 3))
+        self.locations_to_add = []
+        self.locations_to_remove = []
+
+    def flush_datasets(self):
+        if not self.datasets_to_add:
+            return
+        start_time = time.time()
+        ds_resolve = Doc2Dataset(self.index)
+        added_count = 0
+        while self.datasets_to_add:
+            dataset_id, uri = self.datasets_to_add[0]
+            add_dataset(self.index, dataset_id, uri, ds_resolve=ds_resolve)
+            # Dropped as each is applied, so a failed batch can be flushed again from the one that failed.
+            self.datasets_to_add.pop(0)
+            added_count += 1
+        _LOG.info("fix.batch.datasets", added_count=added_count, secs=round(time.time() - start_time, 3))
+
+    def flush(self):
+        try:
+            self.flush_locations()
+            self.flush_datasets()
+        finally:
+            # Whatever is still queued (after a failure) remains pending.
+            self.pending_uris = {uri for _, uri in self.locations_to_add + self.locations_to_remove +
+                                 self.datasets_to_add}
+
+        if self.post_fix:
+            for mismatch in self.handled:
+                self.post_fix(mismatch)
+        self.handled = []
+
+
+@singledispatch
+def batch_update_locations(mismatch: Mismatch, batch: _FixBatch):
+    pass
+
+
+@batch_update_locations.register(LocationMissingOnDisk)
+def _batch_remove_location(mismatch: LocationMissingOnDisk, batch: _FixBatch):
+    _LOG.info("remove_location", mismatch=mismatch)
+    batch.remove_location(mismatch)
+    return True
+
+
+@batch_update_locations.register(LocationNotIndexed)
+def _batch_add_location(mismatch: LocationNotIndexed, batch: _FixBatch):
+    _LOG.info("add_location", mismatch=mismatch)
+    batch.add_location(mismatch)
+    return True
+
+
+@singledispatch
+def batch_index_missing(mismatch: Mismatch, batch: _FixBatch):
+    pass
+
+
+@batch_index_missing.register(DatasetNotIndexed)
+def _batch_add_missing(mismatch: DatasetNotIndexed, batch: _FixBatch):
+    _LOG.info("index_dataset", mismatch=mismatch)
+    batch.add_dataset(mismatch)
+    return True
+
+
 def fix_mismatches(mismatches: Iterable[Mismatch],
                    index: Index,
                    index_missing=False,
@@ -101,23 +301,284 @@ def fix_mismatches(mismatches: Iterable[Mismatch],
                    trash_archived=False,
                    min_trash_age_hours=72,
                    update_locations=False,
-                   pre_fix: Callable[[Mismatch], None] = None):
+                   pre_fix: Callable[[Mismatch], None] = None,
+                   post_fix: Callable[[Mismatch], None] = None,
+                   batch_size: int = None):
+    """
+    Apply the chosen fixes for each mismatch.
+
+    post_fix is called for each mismatch once all of its fixes have been applied (for batched fixes:
+    once their batch has been).
+
+    With a batch size, index fixes are queued and applied in batches: location changes in one transaction
+    (and statement) per batch, and missing datasets sharing one dataset resolver. Filesystem fixes (trashing)
+    are still applied immediately, after any queued changes to their location.
+
+    The trash fixes skip a location without querying the index if the siblings the scan attached to the
+    mismatch already rule it out (unless this run has since changed the index there). Otherwise the index's
+    current datasets at the location are checked before it's trashed: the scan's may be out of date.
+    """
     if index_missing and trash_missing:
         raise RuntimeError("Datasets missing from the index can either be indexed or trashed, but not both.")
 
+    batch = _FixBatch(index, batch_size, post_fix=post_fix) if batch_size else None
+    # Locations whose index state we've changed, so the siblings found by the scan are out of date.
+    changed_uris = set()  # type: Set[str]
+
+    for mismatch in mismatches:
+        with _FORK_GUARD.fixing():
+            _fix_mismatch(mismatch, index, batch, changed_uris,
+                          index_missing=index_missing,
+                          trash_missing=trash_missing,
+                          trash_archived=trash_archived,
+                          min_trash_age_hours=min_trash_age_hours,
+                          update_locations=update_locations,
+                          pre_fix=pre_fix)
+            if batch:
+                batch.handled.append(mismatch)
+            elif post_fix:
+                post_fix(mismatch)
+
+    if batch:
+        with _FORK_GUARD.fixing():
+            batch.flush()
+
+
+def _fix_mismatch(mismatch: Mismatch,
+                  index: Index,
+                  batch: Optional[_FixBatch],
+                  changed_uris: Set[str],
+                  index_missing: bool,
+                  trash_missing: bool,
+                  trash_archived: bool,
+                  min_trash_age_hours: int,
+                  update_locations: bool,
+                  pre_fix: Optional[Callable[[Mismatch], None]]):
+    _LOG.info('mismatch.found', mismatch=mismatch)
+
+    if pre_fix:
+        pre_fix(mismatch)
+
+    if update_locations:
+        if batch:
+            changed = batch_update_locations(mismatch, batch)
+        else:
+            changed = do_update_locations(mismatch, index)
+        if changed:
+            changed_uris.add(mismatch.uri)
+
+    if index_missing:
+        if batch:
+            changed = batch_index_missing(mismatch, batch)
+        else:
+            changed = do_index_missing(mismatch, index)
+        if changed:
+            changed_uris.add(mismatch.uri)
+    elif trash_missing:
+        if batch:
+            batch.before_fs_change(mismatch.uri)
+        do_trash_missing(mismatch, index, siblings=_current_siblings(mismatch, changed_uris))
+
+    if trash_archived:
+        if batch:
+            batch.before_fs_change(mismatch.uri)
+        do_trash_archived(mismatch, index, min_age_hours=min_trash_age_hours,
+                          siblings=_current_siblings(mismatch, changed_uris))
+
+
+def _current_siblings(mismatch: Mismatch, changed_uris: Set[str]) -> Optional[FrozenSet[DatasetLite]]:
+    """
+    The mismatch's siblings, if they're still the index state of its location (otherwise None: query the index).
+    """
+    if mismatch.uri in changed_uris:
+        return None
+    return mismatch.siblings
+
+
+# Marks the end of a fix worker's queue.
+_END_OF_QUEUE = object()
+
+
+def fix_mismatches_concurrently(mismatches: Iterable[Mismatch],
+                                index: Index,
+                                workers: int = 2,
+                                queue_size: int = 1000,
+                                **fix_settings):
+    """
+    Apply fixes on a pool of threads while mismatches are still being found.
+
+    The mismatches are read (ie. the scan runs) in this thread, and queued for the fix threads. The queues are
+    bounded, so a scan that's faster than its fixes will wait for them, rather than accumulating mismatches.
+
+    Mismatches are routed to fix threads by uri, so all fixes of one location are applied in order by the same
+    thread. (The safety checks before trashing a location rely on seeing the index changes to it.)
+
+    Other arguments are as for :func:`fix_mismatches`.
+    """
+    if fix_settings.get('index_missing') and fix_settings.get('trash_missing'):
+        raise RuntimeError("Datasets missing from the index can either be indexed or trashed, but not both.")
+
+    queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+    errors = []  # type: List[BaseException]
+
+    def iter_queue(q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is _END_OF_QUEUE:
+                return
+            yield item
+
+    def work(q: queue.Queue):
+        try:
+            fix_mismatches(iter_queue(q), index, **fix_settings)
+        except BaseException as e:  # pylint: disable=broad-except
+            _LOG.exception("fix.worker.failure")
+            errors.append(e)
+            # Keep taking items so the scan isn't left blocked on a full queue.
+            for _ in iter_queue(q):
+                pass
+
+    threads = [threading.Thread(target=work, args=(q,), name='sync-fix-{}'.format(i), daemon=True)
+               for i, q in enumerate(queues)]
+    for thread in threads:
+        thread.start()
+
+    mismatch_count = 0
+    # Time that the scan was held up waiting for fixes.
+    blocked_secs = 0.0
+    try:
+        for mismatch in mismatches:
+            if errors:
+                break
+            start_time = time.time()
+            queues[hash(mismatch.uri) % workers].put(mismatch)
+            blocked_secs += time.time() - start_time
+            mismatch_count += 1
+    finally:
+        for q in queues:
+            q.put(_END_OF_QUEUE)
+        for thread in threads:
+            thread.join()
+
+    _LOG.info("fix.concurrent.done",
+              mismatch_count=mismatch_count,
+              fix_workers=workers,
+              scan_blocked_secs=round(blocked_secs, 3))
+    if errors:
+        raise errors[0]
+
+
+def partition_mismatches(mismatches: Iterable[Mismatch], partition_count: int) -> List[List[Mismatch]]:
+    """
+    Split mismatches into partitions that can be fixed independently.
+
+    Mismatches of the same dataset, or of the same location, are always in the same partition: connected
+    mismatches (sharing a dataset with one, a location with another...) are grouped together.
+
+    >>> from digitalearthau.index import DatasetLite
+    >>> a, b, c = (DatasetLite(UUID(int=i)) for i in (1, 2, 3))
+    >>> partitions = partition_mismatches([LocationNotIndexed(a, 'file:///1'), DatasetNotIndexed(b, 'file:///1'),
+    ...                                    LocationMissingOnDisk(b, 'file:///2'), DatasetNotIndexed(c, 'file:///3')], 2)
+    >>> sorted(len(p) for p in partitions)
+    [1, 3]
+    """
+    # Union-find of datasets and locations.
+    parents = {}  # type: Dict[object, object]
+
+    def find(node):
+        parents.setdefault(node, node)
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    mismatches = list(mismatches)
+    for mismatch in mismatches:
+        location = find(mismatch.uri)
+        if mismatch.dataset is not None:
+            dataset = find(mismatch.dataset.id)
+            if dataset != location:
+                parents[dataset] = location
+
+    group_sizes = Counter(find(mismatch.uri) for mismatch in mismatches)
+
+    # Largest groups first, each to the least loaded partition, so a few big groups don't end up together.
+    loads = [(0, i) for i in range(partition_count)]
+    group_partitions = {}  # type: Dict[object, int]
+    for group, size in group_sizes.most_common():
+        load, partition = heapq.heappop(loads)
+        group_partitions[group] = partition
+        heapq.heappush(loads, (load + size, partition))
+
+    partitions = [[] for _ in range(partition_count)]  # type: List[List[Mismatch]]
     for mismatch in mismatches:
-        _LOG.info('mismatch.found', mismatch=mismatch)
+        partitions[group_partitions[find(mismatch.uri)]].append(mismatch)
+    return [p for p in partitions if p]
 
-        if pre_fix:
-            pre_fix(mismatch)
 
-        if update_locations:
-            do_update_locations(mismatch, index)
+# How often to log the progress of each partition.
+_PROGRESS_INTERVAL_SECS = 60
 
-        if index_missing:
-            do_index_missing(mismatch, index)
-        elif trash_missing:
-            do_trash_missing(mismatch, index)
 
-        if trash_archived:
-            do_trash_archived(mismatch, index, min_age_hours=min_trash_age_hours)
+def fix_mismatches_partitioned(mismatches: Iterable[Mismatch],
+                               index: Index,
+                               workers: int = 4,
+                               partition_count: int = None,
+                               post_fix: Callable[[Mismatch], None] = None,
+                               **fix_settings):
+    """
+    Apply fixes to a (finite) set of mismatches, such as a reviewed mismatch file, on a pool of threads.
+
+    The mismatches are split into partitions where no two touch the same dataset or location
+    (see :func:`partition_mismatches`), which are fixed concurrently. Each partition logs its progress.
+
+    A failing partition doesn't stop the others: the failures are raised together at the end, after the summary.
+
+    Other arguments are as for :func:`fix_mismatches`.
+    """
+    if fix_settings.get('index_missing') and fix_settings.get('trash_missing'):
+        raise RuntimeError("Datasets missing from the index can either be indexed or trashed, but not both.")
+
+    partitions = partition_mismatches(mismatches, partition_count or workers * 4)
+    total_count = sum(len(p) for p in partitions)
+    _LOG.info("fix.partitioned.start", mismatch_count=total_count, partition_count=len(partitions), workers=workers)
+
+    done_counts = Counter()  # type: Counter
+    counts_lock = threading.Lock()
+
+    def fix_partition(number: int, partition: List[Mismatch]):
+        log = _LOG.bind(partition=number)
+        start_time = last_log_time = time.time()
+        done_count = 0
+
+        def progress(mismatch: Mismatch):
+            nonlocal done_count, last_log_time
+            done_count += 1
+            with counts_lock:
+                done_counts[mismatch.type_name] += 1
+            if post_fix:
+                post_fix(mismatch)
+            if time.time() - last_log_time > _PROGRESS_INTERVAL_SECS:
+                log.info("fix.partition.progress", done_count=done_count, mismatch_count=len(partition))
+                last_log_time = time.time()
+
+        fix_mismatches(partition, index, post_fix=progress, **fix_settings)
+        log.info("fix.partition.done", mismatch_count=len(partition), secs=round(time.time() - start_time, 1))
+
+    start_time = time.time()
+    failures = []  # type: List[Tuple[int, BaseException]]
+    with ThreadPoolExecutor(workers, thread_name_prefix='sync-apply') as executor:
+        futures = [executor.submit(fix_partition, i, partition) for i, partition in enumerate(partitions)]
+        for i, future in enumerate(futures):
+            error = future.exception()
+            if error is not None:
+                _LOG.error("fix.partition.failure", partition=i, error=repr(error))
+                failures.append((i, error))
+
+    _LOG.info("fix.partitioned.done",
+              mismatch_count=total_count,
+              done_counts=dict(done_counts),
+              failed_partitions=[i for i, _ in failures],
+              secs=round(time.time() - start_time, 1))
+    if failures:
+        raise failures[0][1]
@@ -0,0 +1,226 @@
+"""
+Index-first scans, for collections whose index is authoritative (Trust.INDEX).
+
+A normal scan walks the collection's whole directory tree. For tiled products, with millions of files in a few
+directories, that's a lot of listing for little news. Instead, the index's locations are streamed (with a
+server-side cursor) and checked for existence in batches on a pool of threads, and only the directories that may
+hold unindexed files are listed:
+
+- those modified since a location was last indexed within them (less a margin for clock differences), and
+- those with nothing indexed within them at all.
+
+Directories are only examined down to those holding the dataset entries (the files, or for patterns like
+'LS*/ga-metadata.yaml', the dataset folders): adding a dataset changes the mtime of the directory it's added to.
+
+An unindexed file in a directory that's been indexed into since the file was written isn't found: it's a
+trade-off for collections where unindexed files are the exception. (A normal scan will still find them)
+"""
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+import structlog
+
+from datacube.utils import uri_to_local_path
+from digitalearthau import walk
+from digitalearthau.collections import Collection
+from digitalearthau.index import DatasetLite, iter_grouped_locations, iter_location_uris
+from digitalearthau.sync.pathsets import ROOT_URI
+
+_LOG = structlog.get_logger()
+
+# Number of threads checking that locations exist (on Lustre, a stat is bound by metadata latency, not cpu).
+STAT_THREADS = int(os.environ.get('DEA_SYNC_STAT_THREADS') or 32)
+# Number of locations checked by a thread at a time.
+STAT_BATCH_SIZE = int(os.environ.get('DEA_SYNC_STAT_BATCH_SIZE') or 1000)
+
+# Allowance for differences between the filesystem's clock and the database's.
+_CLOCK_MARGIN_SECS = 10 * 60
+
+# A work item: an indexed location as (uri, indexed datasets, on disk), or the uri of a file found on disk
+# that isn't one.
+WorkItem = Union[Tuple[str, Set[DatasetLite], bool], str]
+
+
+def iter_work_items(collection: Collection,
+                    uri_prefix: str,
+                    threads: int = STAT_THREADS,
+                    batch_size: int = STAT_BATCH_SIZE,
+                    log=_LOG) -> Iterable[WorkItem]:
+    """
+    Every location of the collection within the uri prefix, with whether it exists, followed by the
+    unindexed files found in the directories suspected of holding them.
+    """
+    patterns = (collection.file_patterns if uri_prefix == ROOT_URI
+                else collection.constrained_file_patterns(uri_to_local_path(uri_prefix)))
+    tracker = DirectoryTracker(patterns)
+
+    def tracked(locations):
+        for uri, datasets, added in locations:
+            tracker.add(str(uri_to_local_path(uri)), added.timestamp())
+            yield uri, datasets
+
+    location_count = missing_count = 0
+    locations = iter_grouped_locations(collection.index_, collection.query, uri_prefix=uri_prefix)
+    for (uri, datasets), exists in _check_exists(tracked(locations), threads, batch_size):
+        location_count += 1
+        missing_count += not exists
+        yield uri, datasets, exists
+
+    suspects = list(tracker.suspect_directories())
+    log.info("index_first.locations.checked",
+             location_count=location_count,
+             missing_count=missing_count,
+             directory_count=len(tracker.latest_added),
+             suspect_count=len(suspects))
+
+    found_count = 0
+    for directory in suspects:
+        directory_uri = Path(directory).as_uri() + '/'
+        indexed = set(iter_location_uris(collection.index_, collection.query, uri_prefix=directory_uri))
+        for path in collection.iter_fs_paths_within(Path(directory)):
+            uri = path.as_uri()
+            if uri.startswith(uri_prefix) and uri not in indexed:
+                found_count += 1
+                yield uri
+    log.info("index_first.unindexed.found", uri_count=found_count)
+
+
+def _check_exists(locations: Iterable[Tuple[str, Set[DatasetLite]]],
+                  threads: int,
+                  batch_size: int) -> Iterable[Tuple[Tuple[str, Set[DatasetLite]], bool]]:
+    """
+    Check whether each location exists, in batches on a pool of threads, keeping their order.
+    """
+
+    def exist(batch):
+        return [os.path.exists(uri_to_local_path(uri)) for uri, _ in batch]
+
+    locations = iter(locations)
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='sync-stat') as executor:
+        # A few batches queued for each thread.
+        in_flight = collections.deque()
+        while True:
+            batch = list(islice(locations, batch_size))
+            if batch:
+                in_flight.append((batch, executor.submit(exist, batch)))
+            if in_flight and (not batch or len(in_flight) >= threads * 2):
+                done_batch, future = in_flight.popleft()
+                yield from zip(done_batch, future.result())
+            elif not batch:
+                return
+
+
+class _PatternLevels(NamedTuple):
+    base: str
+    matchers: List
+    # Number of levels below the base of the directories holding the dataset entries
+    # (None if the pattern has no wildcards, so there's nothing to list).
+    entry_depth: Optional[int]
+
+
+class DirectoryTracker:
+    """
+    The latest time a location was indexed within each directory of the collection's patterns, down to
+    those holding the dataset entries.
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self._patterns = []  # type: List[_PatternLevels]
+        for pattern in patterns:
+            base, matchers = walk.split_pattern(pattern)
+            wildcard_levels = [i for i, m in enumerate(matchers) if not m.is_literal]
+            self._patterns.append(_PatternLevels(base, matchers, wildcard_levels[-1] if wildcard_levels else None))
+
+        self.latest_added = {}  # type: Dict[str, float]
+        self._children = collections.defaultdict(set)  # type: Dict[str, Set[str]]
+
+    def add(self, path: str, added: float):
+        """
+        Record a location indexed at the given time.
+        """
+        for base, matchers, entry_depth in self._patterns:
+            if entry_depth is None or not path.startswith(base.rstrip('/') + '/'):
+                continue
+            parts = path[len(base):].strip('/').split('/')
+            if len(parts) != len(matchers) or not all(m.matches(part) for m, part in zip(matchers, parts)):
+                continue
+
+            directory = base
+            self._update(directory, added)
+            for part in parts[:entry_depth]:
+                child = os.path.join(directory, part)
+                self._children[directory].add(child)
+                directory = child
+                self._update(directory, added)
+
+    def _update(self, directory: str, added: float):
+        if added > self.latest_added.get(directory, 0):
+            self.latest_added[directory] = added
+
+    def suspect_directories(self) -> Iterable[str]:
+        """
+        The directories that may hold datasets that aren't indexed. (The whole tree within each may need listing)
+
+        >>> import time
+        >>> from digitalearthau.paths import write_files
+        >>> d = write_files({'x1': {'a.nc': ''}, 'x2': {'b.nc': ''}, 'x3': {'c.nc': ''}})
+        >>> tracker = DirectoryTracker([str(d) + '/*/*.nc'])
+        >>> # x1 hasn't been modified since it was indexed, x2 has, and nothing in x3 is indexed.
+        >>> two_hours_ago = time.time() - 7200
+        >>> os.utime(str(d / 'x1'), (two_hours_ago, two_hours_ago))
+        >>> tracker.add(str(d / 'x1' / 'a.nc'), two_hours_ago + 3600)
+        >>> tracker.add(str(d / 'x2' / 'b.nc'), two_hours_ago)
+        >>> [s[len(str(d)):] for s in tracker.suspect_directories()]
+        ['/x3', '/x2']
+        """
+        seen = set()
+        for base, matchers, entry_depth in self._patterns:
+            if entry_depth is None:
+                suspects = [base]
+            else:
+                suspects = self._suspects_within(base, matchers[:entry_depth])
+            for directory in suspects:
+                if directory not in seen:
+                    seen.add(directory)
+                    yield directory
+
+    def _suspects_within(self, directory: str, matchers: List) -> Iterable[str]:
+        latest_added = self.latest_added.get(directory)
+        if latest_added is None:
+            # Nothing indexed within it.
+            yield directory
+            return
+
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            # Gone: its locations have already been found missing.
+            return
+
+        modified = mtime > latest_added - _CLOCK_MARGIN_SECS
+        if not matchers:
+            # It holds the dataset entries.
+            if modified:
+                yield directory
+            return
+
+        if modified:
+            # Subdirectories may have been added.
+            for name in _list_directories(directory, matchers[0]):
+                child = os.path.join(directory, name)
+                if child not in self.latest_added:
+                    yield child
+        for child in sorted(self._children[directory]):
+            yield from self._suspects_within(child, matchers[1:])
+
+
+def _list_directories(directory: str, matcher) -> List[str]:
+    try:
+        with os.scandir(directory) as it:
+            return sorted(entry.name for entry in it if matcher.matches(entry.name) and entry.is_dir())
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
@@ -0,0 +1,237 @@
+"""
+A record of each path's state at the last sync, so that later syncs can skip the paths that haven't changed.
+
+For each uri we record the file's stat (size, mtime, inode), the datasets that were indexed there (and the
+index state of the file's datasets that weren't: whether they were indexed elsewhere), the dataset ids in the
+file, and the mismatches that were found (the "verdict").
+
+If neither the file stat nor the index state of a uri has changed since, its recorded verdict is reused
+without reading the file again.
+
+(Only the stat of the metadata file itself is compared: changes to other files of a packaged
+dataset aren't noticed unless the metadata file changes too.)
+"""
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional, Iterable, Tuple, List
+from uuid import UUID
+
+import structlog
+
+from digitalearthau.index import DatasetLite
+from .differences import Mismatch
+
+_LOG = structlog.get_logger()
+
+# Number of entries to insert per transaction when writing a manifest.
+_WRITE_BATCH_SIZE = 1000
+
+
+class PathState(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def of(cls, path: Path) -> Optional['PathState']:
+        """
+        Get the current state of the given path, or None if it doesn't exist.
+        """
+        try:
+            st = os.stat(str(path))
+        except FileNotFoundError:
+            return None
+        return PathState(st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def index_state(datasets: Iterable[DatasetLite]) -> str:
+    """
+    A string summary of the index state of a location: its dataset ids and their archived times.
+
+    >>> from datetime import datetime
+    >>> index_state([DatasetLite(UUID(int=2), archived_time=datetime(2017, 1, 2)), DatasetLite(UUID(int=1))])
+    '00000000-0000-0000-0000-000000000001:,00000000-0000-0000-0000-000000000002:2017-01-02T00:00:00'
+    >>> index_state([])
+    ''
+    """
+    return ','.join(sorted(
+        '{}:{}'.format(d.id, d.archived_time.isoformat() if d.archived_time else '')
+        for d in datasets
+    ))
+
+
+def file_index_state(location_datasets: Iterable[DatasetLite],
+                     dataset_ids: Iterable[UUID],
+                     get_indexed_dataset: Callable[[UUID], Optional[DatasetLite]]) -> str:
+    """
+    A string summary of the index state that a file's verdict depends on: that of its location, and of the
+    file's datasets that aren't indexed there (whether they're indexed elsewhere, and their archived times).
+
+    >>> at_location = DatasetLite(UUID(int=1))
+    >>> file_index_state([at_location], [UUID(int=1)], lambda id_: None)
+    '00000000-0000-0000-0000-000000000001:'
+    >>> file_index_state([at_location], [UUID(int=1), UUID(int=2)], lambda id_: None)
+    '00000000-0000-0000-0000-000000000001:;00000000-0000-0000-0000-000000000002:unindexed'
+    >>> file_index_state([], [UUID(int=2)], DatasetLite)
+    ';00000000-0000-0000-0000-000000000002:'
+    """
+    location_datasets = list(location_datasets)
+    at_location = set(d.id for d in location_datasets)
+
+    elsewhere = []
+    for id_ in sorted(set(dataset_ids) - at_location):
+        dataset = get_indexed_dataset(id_)
+        if dataset is None:
+            elsewhere.append('{}:unindexed'.format(id_))
+        else:
+            elsewhere.append(index_state([dataset]))
+
+    state = index_state(location_datasets)
+    if elsewhere:
+        state += ';' + ','.join(elsewhere)
+    return state
+
+
+class ManifestEntry(NamedTuple):
+    uri: str
+    # None if the path didn't exist.
+    path_state: Optional[PathState]
+    # See file_index_state()
+    index_state: str
+    # The dataset ids within the file
+    dataset_ids: Tuple[UUID, ...]
+    # The mismatches found at this uri.
+    mismatches: Tuple[Mismatch, ...]
+
+    def is_unchanged(self, path_state: Optional[PathState], index_state_: str) -> bool:
+        return self.path_state == path_state and self.index_state == index_state_
+
+
+class Manifest:
+    """
+    Read access to a saved manifest.
+
+    A connection is opened lazily on first use, so that an instance can be handed to forked worker processes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._db = None  # type: sqlite3.Connection
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect('{}?mode=ro'.format(self.path.absolute().as_uri()), uri=True)
+        return self._db
+
+    def get(self, uri: str) -> Optional[ManifestEntry]:
+        if not self.path.exists():
+            return None
+
+        row = self._connection().execute(
+            'select size, mtime_ns, inode, index_state, dataset_ids, mismatches from path where uri = ?',
+            (uri,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, inode, index_state_, dataset_ids, mismatches = row
+        return ManifestEntry(
+            uri=uri,
+            path_state=PathState(size, mtime_ns, inode) if size is not None else None,
+            index_state=index_state_,
+            dataset_ids=tuple(UUID(id_) for id_ in json.loads(dataset_ids)),
+            mismatches=tuple(Mismatch.from_dict(m) for m in json.loads(mismatches)),
+        )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class ManifestWriter:
+    """
+    Write a new manifest.
+
+    It's written beside the old one, and only replaces it if the writer exits without error (so an
+    interrupted sync will not lose the previous run's state).
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._tmp_path = path.with_name(path.name + '.tmp')
+        self._db = None  # type: sqlite3.Connection
+        self._pending = []  # type: List[tuple]
+        self.count = 0
+
+    def __enter__(self) -> 'ManifestWriter':
+        if self._tmp_path.exists():
+            self._tmp_path.unlink()
+        self._db = sqlite3.connect(str(self._tmp_path))
+        self._db.execute(
+            'create table path ('
+            'uri text primary key, size integer, mtime_ns integer, inode integer, '
+            'index_state text, dataset_ids text, mismatches text'
+            ')'
+        )
+        return self
+
+    def add(self, entry: ManifestEntry):
+        state = entry.path_state
+        self._pending.append((
+            entry.uri,
+            state.size if state else None,
+            state.mtime_ns if state else None,
+            state.inode if state else None,
+            entry.index_state,
+            json.dumps([str(id_) for id_ in entry.dataset_ids]),
+            json.dumps([m.to_dict() for m in entry.mismatches]),
+        ))
+        self.count += 1
+        if len(self._pending) >= _WRITE_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        with self._db:
+            self._db.executemany('insert or replace into path values (?, ?, ?, ?, ?, ?, ?)', self._pending)
+        self._pending = []
+
+    def copy_previous(self, previous: Manifest, uris: Iterable[str]):
+        """
+        Copy the previous manifest's entries for the given uris, unless they've been added to this one.
+
+        (A resumed sync skips the uris completed before it was interrupted, so their entries are carried over)
+        """
+        if not previous.path.exists():
+            return
+        self._flush()
+        with self._db:
+            self._db.execute('create temporary table copied_uri (uri text primary key)')
+            self._db.executemany('insert or ignore into copied_uri values (?)', ((uri,) for uri in uris))
+        self._db.execute('attach database ? as previous', (str(previous.path),))
+        try:
+            with self._db:
+                copied = self._db.execute(
+                    'insert or ignore into path '
+                    'select p.* from previous.path p join copied_uri c on p.uri = c.uri'
+                ).rowcount
+        finally:
+            self._db.execute('detach database previous')
+        self._db.execute('drop table copied_uri')
+        self.count += copied
+        _LOG.info("manifest.previous_copied", path=self.path, entry_count=copied)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self._flush()
+        finally:
+            self._db.close()
+
+        if exc_type is None:
+            os.replace(str(self._tmp_path), str(self.path))
+            _LOG.info("manifest.written", path=self.path, entry_count=self.count)
+        else:
+            self._tmp_path.unlink()
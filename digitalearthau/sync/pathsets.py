@@ -0,0 +1,401 @@
+"""
+A collection's path set (the uris of all of its datasets, in the index and on disk), cached in pieces.
+
+The cache is split into a piece for each top-level subdirectory of the collection's file patterns (eg.
+each year's folder, or each tile's), plus a piece for the index locations outside of them. Each piece is a
+sorted file of its uris. A piece is only rebuilt when:
+
+- the mtime of one of its directories down to those holding the dataset entries has changed (an entry, such
+  as a dataset folder or a tile file, was added or removed: see :func:`walk.entry_depth`),
+- a location was added to the index within it since it was built, or
+- it's older than PIECE_MAX_AGE_SECS (as changes within an existing dataset folder aren't otherwise seen).
+
+Locations removed from the index (or datasets archived) don't make a piece stale: their uris stay in the
+path set until it's rebuilt for another reason. That's harmless, as the scan compares each uri with the
+index's current state: an extra uri is only an extra check.
+
+The pieces, rebuilt or not, are then merged into the path set.
+
+The cache folder is keyed on the collection's query and file patterns, so changing either starts a new cache.
+Pieces are shared by syncs of any uri prefix within the collection.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional
+
+import structlog
+from boltons import fileutils
+from boltons import strutils
+from dateutil import tz
+
+from datacube.utils import uri_to_local_path
+from digitalearthau import walk
+from digitalearthau.collections import Collection
+from digitalearthau.index import iter_location_uris, iter_locations_added_since
+from digitalearthau.sync import extsort
+
+_LOG = structlog.get_logger()
+
+# Root folder of all file uris.
+ROOT_URI = 'file:///'
+
+# The longest that a piece is used before it's rebuilt regardless. (Well over the sync interval: otherwise
+# every piece of a nightly sync would be rebuilt every night)
+PIECE_MAX_AGE_SECS = float(os.environ.get('DEA_SYNC_PATHSET_MAX_AGE_HOURS') or 7 * 24) * 60 * 60
+
+# Allowance for differences between our clock and the database's, when comparing index activity to build times.
+_CLOCK_MARGIN_SECS = 10 * 60
+
+
+class PathsetCheck(NamedTuple):
+    """
+    The state of a path set cache: which pieces need rebuilding.
+    """
+    # The pieces that need rebuilding (by name, including the rest piece), with the reason why.
+    stale: Dict[str, str]
+    # The directory signature of each piece, when checked.
+    signatures: Dict[str, str]
+    # The uri prefixes of the stale pieces' directories (those that need walking).
+    crawl_prefixes: List[str]
+
+
+class Piece(NamedTuple):
+    """
+    A top-level subdirectory of a collection's file patterns.
+    """
+    name: str
+    directory: str
+    # Uri prefix of the directory (with a trailing slash)
+    uri_prefix: str
+
+
+def collection_cache_folder(collection: Collection, cache_path: Path) -> Path:
+    """
+    The pathset cache folder of the collection: named by its query, and keyed on its query and file patterns.
+
+    >>> collection_cache_folder(Collection('ls8', {'product': 'ls8_level1_scene'}, ['/g/data/*/ga-metadata.yaml']),
+    ...                         Path('/tmp/cache'))
+    PosixPath('/tmp/cache/pathsets/product_ls8_level1_scene-572ff40014')
+    """
+    key = json.dumps([collection.query, list(collection.file_patterns)], sort_keys=True, default=str)
+    return cache_path.joinpath('pathsets', '{}-{}'.format(query_name(collection.query), _digest(key)))
+
+
+def query_name(query: Mapping[str, Any]) -> str:
+    """
+    Get a string name for the given query args.
+
+    >>> query_name({'product': 'ls8_level1_scene'})
+    'product_ls8_level1_scene'
+    >>> query_name({'metadata_type': 'telemetry'})
+    'metadata_type_telemetry'
+    >>> query_name({'a': '1', 'b': 2, 'c': '"3"'})
+    'a_1-b_2-c_3'
+    """
+    return "-".join(
+        '{}_{}'.format(k, strutils.slugify(str(v)))
+        for k, v in sorted(query.items())
+    )
+
+
+def find_pieces(collection: Collection, uri_prefix: str = ROOT_URI) -> List[Piece]:
+    """
+    Split the collection's file patterns (within the uri prefix) by the top-level subdirectories they match.
+
+    Patterns whose dataset entries are directly in their base directory are a single piece.
+
+    >>> from digitalearthau.paths import write_files
+    >>> d = write_files({'2016': {'01': {}}, '2017': {}, 'notes.txt': ''})
+    >>> c = Collection('c', {}, [str(d) + '/[0-9]*/[0-9][0-9]/LS*/ga-metadata.yaml'])
+    >>> [p.directory[len(str(d)):] for p in find_pieces(c)]
+    ['/2016', '/2017']
+    >>> [p.directory[len(str(d)):] for p in find_pieces(c, (d / '2016' / '01').as_uri())]
+    ['/2016/01']
+    """
+    patterns = (collection.file_patterns if uri_prefix == ROOT_URI
+                else collection.constrained_file_patterns(uri_to_local_path(uri_prefix)))
+
+    directories = set()
+    for pattern in patterns:
+        base, matchers = walk.split_pattern(pattern)
+        if not walk.entry_depth(matchers):
+            directories.add(base)
+        else:
+            directories.update(os.path.join(base, name) for name in _list_directories(base, matchers[0]))
+
+    return [
+        Piece(name=_name(directory), directory=directory, uri_prefix=Path(directory).as_uri().rstrip('/') + '/')
+        for directory in sorted(directories)
+    ]
+
+
+def _list_directories(directory: str, matcher) -> List[str]:
+    try:
+        with os.scandir(directory) as it:
+            return sorted(entry.name for entry in it if matcher.matches(entry.name) and entry.is_dir())
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _digest(s: str) -> str:
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:10]
+
+
+def _name(directory: str) -> str:
+    """
+    A file name for a directory's piece (readable, but unique)
+
+    >>> _name('/g/data/v10/reprocess/ls8/level1/2016')
+    '2016-8880abe7d1'
+    """
+    return '{}-{}'.format(strutils.slugify(Path(directory).name), _digest(directory))
+
+
+def directory_signature(collection: Collection, piece: Piece) -> str:
+    """
+    A digest of the mtimes of the piece's directories, down to those holding its dataset entries.
+
+    (Adding or removing an entry, such as a dataset folder or a tile file, changes the mtime of the directory
+    containing it.)
+
+    >>> from digitalearthau.paths import write_files
+    >>> d = write_files({'15_-40': {'LS5_FC_1.nc': ''}})
+    >>> c = Collection('fc', {}, [str(d) + '/*_*/LS5*FC*.nc'])
+    >>> piece, = find_pieces(c)
+    >>> before = directory_signature(c, piece)
+    >>> # A new tile file (with its folder's mtime set, in case the clock hasn't moved on)
+    >>> _ = write_files({'LS5_FC_2.nc': ''}, containing_dir=d / '15_-40')
+    >>> os.utime(str(d / '15_-40'), ns=(0, 0))
+    >>> directory_signature(c, piece) == before
+    False
+    """
+    digest = hashlib.sha1()
+
+    def visit(directory: str, matchers):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime = None
+        digest.update('{}:{}\n'.format(directory, mtime).encode('utf-8'))
+        if mtime is None or not matchers:
+            return
+        for name in _list_directories(directory, matchers[0]):
+            visit(os.path.join(directory, name), matchers[1:])
+
+    for pattern in collection.constrained_file_patterns(Path(piece.directory)):
+        base, matchers = walk.split_pattern(pattern)
+        visit(base, matchers[:walk.entry_depth(matchers) or 0])
+    return digest.hexdigest()
+
+
+class _PieceRouter:
+    """
+    Find the piece that a uri is within (the deepest, if they're nested).
+    """
+
+    def __init__(self, pieces: Iterable[Piece]) -> None:
+        # Pieces by the number of slashes in their uri prefix (deepest first)
+        by_depth = defaultdict(dict)  # type: Dict[int, Dict[str, Piece]]
+        for piece in pieces:
+            by_depth[piece.uri_prefix.count('/')][piece.uri_prefix] = piece
+        self._by_depth = sorted(by_depth.items(), reverse=True)
+
+    def route(self, uri: str) -> Optional[Piece]:
+        for depth, pieces in self._by_depth:
+            parts = uri.split('/', depth)
+            if len(parts) > depth:
+                piece = pieces.get('/'.join(parts[:depth]) + '/')
+                if piece is not None:
+                    return piece
+        return None
+
+
+class PathsetCache:
+    """
+    The cached pieces of a collection's path set, within a uri prefix.
+    """
+
+    def __init__(self, collection: Collection, cache_path: Path, uri_prefix: str = ROOT_URI) -> None:
+        self.collection = collection
+        self.uri_prefix = uri_prefix
+        self.folder = collection_cache_folder(collection, cache_path)
+
+        self.pieces = find_pieces(collection, uri_prefix)
+        self._router = _PieceRouter(self.pieces)
+        # The index locations outside of the pieces' directories, and the combined path set, of this prefix.
+        prefix_name = 'all' if uri_prefix == ROOT_URI else _name(str(uri_to_local_path(uri_prefix)))
+        self.rest_name = 'rest-{}'.format(prefix_name)
+        self.pathset_name = 'pathset-{}'.format(prefix_name)
+
+    def _read_meta(self, name: str) -> Optional[dict]:
+        meta_file = self.folder.joinpath(name + '.json')
+        if not (meta_file.exists() and self.folder.joinpath(name + '.txt').exists()):
+            return None
+        return json.loads(meta_file.read_text())
+
+    def check(self) -> PathsetCheck:
+        """
+        Find the pieces that need rebuilding.
+
+        (It stats every piece's directories: the result can be given to :meth:`build`, rather than checked again)
+        """
+        now = time.time()
+        stale = {}  # type: Dict[str, str]
+        signatures = {}  # type: Dict[str, str]
+        built_times = {}  # type: Dict[str, float]
+
+        for piece in self.pieces:
+            meta = self._read_meta(piece.name)
+            signatures[piece.name] = directory_signature(self.collection, piece)
+            if meta is None:
+                stale[piece.name] = 'missing'
+            elif now - meta['built_time'] > PIECE_MAX_AGE_SECS:
+                stale[piece.name] = 'expired'
+            elif meta['signature'] != signatures[piece.name]:
+                stale[piece.name] = 'directories'
+            else:
+                built_times[piece.name] = meta['built_time']
+
+        meta = self._read_meta(self.rest_name)
+        if meta is None:
+            stale[self.rest_name] = 'missing'
+        elif now - meta['built_time'] > PIECE_MAX_AGE_SECS:
+            stale[self.rest_name] = 'expired'
+        elif meta['pieces'] != [p.name for p in self.pieces]:
+            stale[self.rest_name] = 'pieces'
+        else:
+            built_times[self.rest_name] = meta['built_time']
+
+        # Pieces with locations added to the index since they were built.
+        if built_times:
+            since = min(built_times.values()) - _CLOCK_MARGIN_SECS
+            for uri, added in iter_locations_added_since(self.collection.index_, self.collection.query,
+                                                         since=_utc_datetime(since), uri_prefix=self.uri_prefix):
+                piece = self._router.route(uri)
+                name = piece.name if piece else self.rest_name
+                if name in built_times and added.timestamp() > built_times[name] - _CLOCK_MARGIN_SECS:
+                    stale[name] = 'index'
+                    del built_times[name]
+
+        return PathsetCheck(
+            stale=stale,
+            signatures=signatures,
+            crawl_prefixes=[piece.uri_prefix for piece in self.pieces if piece.name in stale],
+        )
+
+    def build(self,
+              fs_uris: Mapping[str, Iterable[str]] = None,
+              log=_LOG,
+              checked: PathsetCheck = None) -> 'dawg.CompletionDAWG':
+        """
+        Rebuild any stale pieces, and return the combined path set.
+
+        :param fs_uris: the filesystem uris already crawled for pieces (by their uri prefix), or for the whole
+            uri prefix. Other pieces are walked as needed.
+        :param checked: the result of an earlier :meth:`check` (such as the one that chose what to crawl).
+        """
+        import dawg
+
+        log = log.bind(uri_prefix=self.uri_prefix)
+        fileutils.mkdir_p(str(self.folder))
+        stale, signatures, _ = checked or self.check()
+        fs_uris = dict(fs_uris or {})
+
+        if self.uri_prefix in fs_uris:
+            # Crawled as a whole: split it up.
+            fs_uris.update(self._split_by_piece(fs_uris.pop(self.uri_prefix),
+                                                [p for p in self.pieces if p.name in stale]))
+
+        for piece in self.pieces:
+            if piece.name in stale:
+                log.info("paths.piece.build", piece=piece.name, reason=stale[piece.name],
+                         fs_uris_given=piece.uri_prefix in fs_uris)
+                self._build_piece(piece, signatures[piece.name], fs_uris.get(piece.uri_prefix))
+        if self.rest_name in stale:
+            log.info("paths.piece.build", piece=self.rest_name, reason=stale[self.rest_name])
+            self._build_rest()
+
+        names = [p.name for p in self.pieces] + [self.rest_name]
+        versions = {name: self._read_meta(name)['built_time'] for name in names}
+
+        pathset_file = self.folder.joinpath(self.pathset_name + '.dawg')
+        pathset_meta = self.folder.joinpath(self.pathset_name + '.json')
+        if pathset_file.exists() and pathset_meta.exists() and json.loads(pathset_meta.read_text()) == versions:
+            log.debug("paths.trie.cache.load", file=pathset_file)
+            path_set = dawg.CompletionDAWG()
+            path_set.load(str(pathset_file))
+            return path_set
+
+        log.info("paths.trie.build", piece_count=len(names), rebuilt_count=len(stale))
+        path_set = dawg.CompletionDAWG(
+            extsort.merge_unique_files([self.folder.joinpath(name + '.txt') for name in names],
+                                       spool_folder=self.folder),
+            input_is_sorted=True
+        )
+        log.info("paths.trie.done")
+        with fileutils.atomic_save(str(pathset_file)) as f:
+            path_set.write(f)
+        self._write_meta(self.pathset_name, versions)
+        return path_set
+
+    def _split_by_piece(self, uris: Iterable[str], pieces: List[Piece]) -> Dict[str, Iterable[str]]:
+        """
+        Route uris crawled for the whole prefix to the (stale) pieces they're within, spooling them to disk.
+        """
+        spool_files = {piece.uri_prefix: self.folder.joinpath(piece.name + '.crawled') for piece in pieces}
+        spools = {prefix: path.open('w') for prefix, path in spool_files.items()}
+        try:
+            for uri in uris:
+                piece = self._router.route(uri)
+                if piece is not None and piece.uri_prefix in spools:
+                    spools[piece.uri_prefix].write(uri + '\n')
+        finally:
+            for f in spools.values():
+                f.close()
+        return {prefix: _read_once(path) for prefix, path in spool_files.items()}
+
+    def _build_piece(self, piece: Piece, signature: str, fs_uris: Optional[Iterable[str]]):
+        # Recorded before reading anything, so any changes while reading will be seen next time.
+        built_time = time.time()
+        if fs_uris is None:
+            fs_uris = (path.as_uri() for path in self.collection.iter_fs_paths_within(Path(piece.directory)))
+        uris = chain(
+            iter_location_uris(self.collection.index_, self.collection.query, uri_prefix=piece.uri_prefix),
+            fs_uris,
+        )
+        self._write_piece(piece.name, uris, dict(built_time=built_time, signature=signature))
+
+    def _build_rest(self):
+        built_time = time.time()
+        uris = (
+            uri for uri in self.collection.iter_index_uris(uri_prefix=None if self.uri_prefix == ROOT_URI
+                                                           else self.uri_prefix)
+            if self._router.route(uri) is None
+        )
+        self._write_piece(self.rest_name, uris, dict(built_time=built_time, pieces=[p.name for p in self.pieces]))
+
+    def _write_piece(self, name: str, uris: Iterable[str], meta: dict):
+        with fileutils.atomic_save(str(self.folder.joinpath(name + '.txt')), text_mode=True) as f:
+            extsort.write_lines(extsort.sorted_unique(uris, spool_folder=self.folder), f)
+        self._write_meta(name, meta)
+
+    def _write_meta(self, name: str, meta: dict):
+        with fileutils.atomic_save(str(self.folder.joinpath(name + '.json')), text_mode=True) as f:
+            json.dump(meta, f)
+
+
+def _read_once(path: Path) -> Iterable[str]:
+    try:
+        yield from extsort.read_lines(path)
+    finally:
+        path.unlink()
+
+
+def _utc_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=tz.tzutc())
@@ -0,0 +1,147 @@
+"""
+Run work through a chain of stages, each with its own pool of workers.
+
+A sync scan's work for a uri is a mix of: filesystem reads (latency-bound, so many threads help), data
+validation (CPU-bound, so it needs processes), and index queries (each worker needs a database connection,
+so we want few of them). A stage for each lets them be sized separately, rather than one pool being sized
+for all of them.
+
+Each stage records how long items waited for a worker and how long they took, to show which stage
+is the bottleneck.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+
+class StageSizes(NamedTuple):
+    # Threads reading files
+    read_threads: int = 16
+    # Processes validating data
+    validate_processes: int = 4
+    # Threads (each with an index connection) comparing with the index
+    index_connections: int = 2
+
+
+def _timed(function: Callable, item: Any, submitted_time: float):
+    """
+    Run in a worker: returns the result, the time the item waited, and the time it took.
+    """
+    start_time = time.time()
+    result = function(item)
+    return result, start_time - submitted_time, time.time() - start_time
+
+
+class Stage:
+    """
+    A pool of workers for one step of the work, with metrics of its queue.
+
+    Items are submitted with a callback for their result (called on a pool thread).
+    """
+
+    def __init__(self, name: str, workers: int, submit_async: Callable) -> None:
+        self.name = name
+        self.workers = workers
+        self._submit_async = submit_async
+        self._lock = threading.Lock()
+
+        self.item_count = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.wait_secs = 0.0
+        self.busy_secs = 0.0
+
+    @classmethod
+    def on_executor(cls, name: str, executor: Executor, workers: int) -> 'Stage':
+        def submit_async(function, args, callback, error_callback):
+            def done(future):
+                error = future.exception()
+                if error is not None:
+                    error_callback(error)
+                else:
+                    callback(future.result())
+
+            executor.submit(function, *args).add_done_callback(done)
+
+        return cls(name, workers, submit_async)
+
+    @classmethod
+    def on_pool(cls, name: str, pool, workers: int) -> 'Stage':
+        """A stage on a multiprocessing pool (the function must be picklable)"""
+        return cls(name, workers,
+                   lambda function, args, callback, error_callback: pool.apply_async(
+                       function, args, callback=callback, error_callback=error_callback
+                   ))
+
+    def submit(self, function: Callable, item: Any, on_done: Callable, on_error: Callable):
+        with self._lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+        def done(timed_result):
+            result, wait_secs, busy_secs = timed_result
+            with self._lock:
+                self.pending -= 1
+                self.item_count += 1
+                self.wait_secs += wait_secs
+                self.busy_secs += busy_secs
+            on_done(result)
+
+        self._submit_async(_timed, (function, item, time.time()), done, on_error)
+
+    def log_summary(self, elapsed_secs: float, log=_LOG):
+        log.info("scan.stage",
+                 stage=self.name,
+                 workers=self.workers,
+                 item_count=self.item_count,
+                 max_queued=self.max_pending,
+                 mean_wait_secs=round(self.wait_secs / self.item_count, 4) if self.item_count else None,
+                 mean_busy_secs=round(self.busy_secs / self.item_count, 4) if self.item_count else None,
+                 utilisation=round(min(1.0, self.busy_secs / (elapsed_secs * self.workers)), 3)
+                 if elapsed_secs else None)
+
+
+def run_pipeline(items: Iterable,
+                 start: Callable[[Any, Callable[[Any], None], Callable[[BaseException], None]], None],
+                 max_in_flight: int) -> Iterator[Any]:
+    """
+    Start each item through the stages, yielding the final results as they're completed.
+
+    :param start: called with an item, a callback for its final result, and a callback for an error.
+        (It submits the item to its first stage, whose callback submits it to the next...)
+    :param max_in_flight: limit of items started but whose results haven't been consumed.
+    """
+    done = queue.Queue()  # type: queue.Queue
+    in_flight = 0
+
+    def on_error(e: BaseException):
+        done.put((None, e))
+
+    items = iter(items)
+    exhausted = False
+    while True:
+        while not exhausted and in_flight < max_in_flight:
+            item = next(items, _END)
+            if item is _END:
+                exhausted = True
+                break
+            start(item, lambda result: done.put((result, None)), on_error)
+            in_flight += 1
+
+        if not in_flight:
+            return
+
+        result, error = done.get()
+        in_flight -= 1
+        if error is not None:
+            raise error
+        yield result
+
+
+_END = object()
@@ -1,128 +1,377 @@
 
-import logging
+import contextlib
 import multiprocessing
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from itertools import chain
+from itertools import chain, groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import Iterable, Any, Mapping, List, Set
+from typing import Iterable, Any, Mapping, List, Set, Callable, Optional, Tuple, Dict, TextIO, NamedTuple, Type
+from uuid import UUID
 
 import structlog
-from boltons import fileutils
 from boltons import strutils
 
 from datacube.index.index import Index  # DEA index
 from datacube.drivers.postgres import PostgresDb
 
 from datacube.utils import uri_to_local_path, InvalidDocException
-from digitalearthau import paths
-from digitalearthau.collections import Collection
-from digitalearthau.index import DatasetLite, get_datasets_for_uri
-from digitalearthau.sync import validate
+from digitalearthau import filecache, paths, walk
+from digitalearthau.collections import Collection, Trust, ValidationLevel, iter_fs_paths_by_collection
+from digitalearthau.index import DatasetLite, IndexSnapshot, get_datasets_for_uri, get_dataset, load_index_snapshot, \
+    iter_sorted_locations
+from digitalearthau.sync import extsort, indexfirst, manifest, pathsets
+from digitalearthau.sync.pathsets import query_name
+from digitalearthau.sync.checkpoint import Checkpoint
+from digitalearthau.sync.dispatch import AdaptiveDispatcher
+from digitalearthau.sync.pipeline import Stage, StageSizes, run_pipeline
+from digitalearthau.sync.shards import Shard
+from digitalearthau.sync.manifest import Manifest, ManifestEntry, ManifestWriter, PathState
 from digitalearthau.sync.differences import UnreadableDataset, InvalidDataset
 from .differences import ArchivedDatasetOnDisk, Mismatch, LocationMissingOnDisk, LocationNotIndexed, \
     DatasetNotIndexed
 
 _LOG = structlog.get_logger()
 
-# 23 hours (roughly the same day)
-CACHE_TIMEOUT_SECS = 60 * 60 * 23
-
-
-def cache_is_too_old(path):
-    if not path.exists():
-        return True
-
-    oldest_valid_time = time.time() - CACHE_TIMEOUT_SECS
-    return path.stat().st_mtime < oldest_valid_time
+# Root folder of all file uris.
+ROOT_URI = 'file:///'
 
 
 def build_pathset(
         collection: Collection,
         cache_path: Path = None,
-        log=_LOG) -> 'dawg.CompletionDAWG':
+        log=_LOG,
+        uri_prefix: str = ROOT_URI,
+        fs_uris: Mapping[str, Iterable[str]] = None,
+        checked: pathsets.PathsetCheck = None) -> 'dawg.CompletionDAWG':
     """
     Build a combined set (in dawg form) of all dataset paths in the given index and filesystem.
 
-    Optionally use the given cache directory to cache repeated builds.
+    Only paths within the uri prefix are searched for: the index query and filesystem patterns are
+    both constrained to it.
+
+    Optionally use the given cache directory to cache repeated builds. The cache is kept in pieces (a piece for
+    each top-level subdirectory of the collection), and only pieces that have changed are rebuilt.
+    (See the pathsets module)
+
+    The filesystem uris can be given if they're already known (such as from a crawl shared with other
+    collections: see :func:`spool_fs_uris`), by uri prefix: the whole prefix, or some of the pieces.
+    Otherwise the collection's file patterns are walked.
+
+    The cache's check can be given if it's already been done (see :func:`check_pathset`).
+
+    Memory use is bounded by the sort's run size (see the extsort module), not the collection size.
     """
+    log = log.bind(collection_name=collection.name, uri_prefix=uri_prefix)
+    if cache_path:
+        return pathsets.PathsetCache(collection, cache_path, uri_prefix).build(fs_uris, log=log, checked=checked)
+
     import dawg
-    locations_cache = cache_path.joinpath(query_name(collection.query), 'locations.dawg') if cache_path else None
-    if locations_cache:
-        fileutils.mkdir_p(str(locations_cache.parent))
-
-    log = log.bind(collection_name=collection.name)
-    if locations_cache and not cache_is_too_old(locations_cache):
-        path_set = dawg.CompletionDAWG()
-        log.debug("paths.trie.cache.load", file=locations_cache)
-        path_set.load(str(locations_cache))
-    else:
-        log.info("paths.trie.build")
-        path_set = dawg.CompletionDAWG(
-            chain(
-                collection.iter_index_uris(),
-                collection.iter_fs_uris()
-            )
-        )
-        log.info("paths.trie.done")
-        if locations_cache is not None:
-            log.debug("paths.trie.cache.create", file=locations_cache)
-            with fileutils.atomic_save(str(locations_cache)) as f:
-                path_set.write(f)
+    fs_uris = (fs_uris or {}).get(uri_prefix)
+    log.info("paths.trie.build", fs_uris_given=fs_uris is not None)
+    if fs_uris is None:
+        if uri_prefix == ROOT_URI:
+            fs_uris = collection.iter_fs_uris()
+        else:
+            fs_uris = (path.as_uri() for path in collection.iter_fs_paths_within(uri_to_local_path(uri_prefix)))
+
+    uris = chain(
+        collection.iter_index_uris(uri_prefix=None if uri_prefix == ROOT_URI else uri_prefix),
+        fs_uris
+    )
+    # Sorted (spilling to disk) before it's given to the builder, which would otherwise hold all of them at once.
+    path_set = dawg.CompletionDAWG(extsort.sorted_unique(uris), input_is_sorted=True)
+    log.info("paths.trie.done")
     return path_set
 
 
-# Suppress "Serializing PostgresDb engine" warning. It's triggered due to using index as a multiprocessing argument.
-# It's usually warned against to prevent datacube clients hitting the index from every worker, but it's a valid
-# use case with this sync tool, where we have a handful of small workers.
-# TODO: Push only the connection setup information? Or have a dedicated process for index info.
-logging.getLogger('datacube.drivers.postgres._connections').setLevel(logging.ERROR)
+def check_pathset(collection: Collection, cache_path: Path, uri_prefix: str = ROOT_URI) -> pathsets.PathsetCheck:
+    """
+    Check which pieces of the collection's cached path set have changed: their uri prefixes are those
+    build_pathset() would need to walk. (Give the result to build_pathset() rather than it checking again)
+    """
+    return pathsets.PathsetCache(collection, cache_path, uri_prefix).check()
+
+
+def overlapping_collections(collection_prefixes: List[Tuple[Collection, str]]) -> List[Tuple[Collection, str]]:
+    """
+    The (collection, uri prefix) pairs whose directory trees overlap another's: a base directory of their file
+    patterns is the same as (or within) one of another collection's. Only these gain from a shared crawl.
+
+    >>> nbar = Collection('nbar', {}, ['/g/data/rs0/scenes/*/nbar/LS*/ga-metadata.yaml'])
+    >>> nbart = Collection('nbart', {}, ['/g/data/rs0/scenes/2016/nbart/LS*/ga-metadata.yaml'])
+    >>> ls8 = Collection('ls8', {}, ['/g/data/v10/reprocess/ls8/level1/*/*/LS*/ga-metadata.yaml'])
+    >>> ls7 = Collection('ls7', {}, ['/g/data/v10/reprocess/ls7/level1/*/*/LS*/ga-metadata.yaml'])
+    >>> [c.name for c, _ in overlapping_collections([(nbar, ROOT_URI), (nbart, ROOT_URI), (ls8, ROOT_URI),
+    ...                                             (ls7, ROOT_URI)])]
+    ['nbar', 'nbart']
+    """
+
+    def base_directories(collection: Collection, uri_prefix: str) -> List[str]:
+        patterns = (collection.file_patterns if uri_prefix == ROOT_URI
+                    else collection.constrained_file_patterns(uri_to_local_path(uri_prefix)))
+        return [walk.split_pattern(pattern)[0].rstrip('/') + '/' for pattern in patterns]
+
+    def overlap(a: List[str], b: List[str]) -> bool:
+        return any(x.startswith(y) or y.startswith(x) for x in a for y in b)
+
+    bases = [(key, base_directories(*key)) for key in dict.fromkeys(collection_prefixes)]
+    return [
+        key for key, key_bases in bases
+        if any(other[0] is not key[0] and overlap(key_bases, other_bases) for other, other_bases in bases)
+    ]
+
+
+def spool_fs_uris(collection_prefixes: List[Tuple[Collection, str]],
+                  spool_folder: Path) -> Dict[Tuple[Collection, str], Path]:
+    """
+    Crawl the filesystem for several (collection, uri prefix) pairs in one pass, writing each one's
+    uris to its own file in the spool folder.
+
+    Collections often share directory trees (eg. the nbar/nbart products of a scene folder), so this lists each
+    directory once, rather than once per collection. Uris are spooled to disk so that the collections can then
+    be scanned one at a time without holding every collection's paths in memory.
+
+    Returns the spool file of each (collection, uri prefix).
+    """
+    collection_prefixes = list(dict.fromkeys(collection_prefixes))
+    spool_files = {
+        key: spool_folder.joinpath('fs-uris-{}.txt'.format(i))
+        for i, key in enumerate(collection_prefixes)
+    }
+
+    folders = [(c, None if prefix == ROOT_URI else uri_to_local_path(prefix)) for c, prefix in collection_prefixes]
+    _LOG.info("fs.crawl.start", collections=[c.name for c, _ in collection_prefixes])
+    with contextlib.ExitStack() as stack:
+        spools = {
+            folder: stack.enter_context(spool_files[key].open('w'))
+            for folder, key in zip(folders, collection_prefixes)
+        }  # type: Dict[Tuple[Collection, Optional[Path]], TextIO]
+
+        path_count = 0
+        for folder, path in iter_fs_paths_by_collection(folders):
+            spools[folder].write(path.as_uri() + '\n')
+            path_count += 1
+    _LOG.info("fs.crawl.done", path_count=path_count)
+
+    return spool_files
+
+
+def read_spool(spool_file: Path) -> Iterable[str]:
+    with spool_file.open('r') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
 
+def _cache_file(collection_cache: Path, uri_prefix: str, name: str) -> Path:
+    """
+    The named cache file of a collection, for the given uri prefix
 
-def _find_uri_mismatches(index_url: str, uri: str, validate_data=True) -> Iterable[Mismatch]:
+    >>> _cache_file(Path('/tmp/cache'), 'file:///', 'locations.dawg')
+    PosixPath('/tmp/cache/locations.dawg')
+    >>> _cache_file(Path('/tmp/cache'), 'file:///g/data/v10/reprocess/ls8/level1/2016/04', 'locations.dawg')
+    PosixPath('/tmp/cache/locations-g_data_v10_reprocess_ls8_level1_2016_04.dawg')
+    """
+    if uri_prefix == ROOT_URI:
+        return collection_cache.joinpath(name)
+    stem, extension = name.split('.', 1)
+    return collection_cache.joinpath(
+        '{}-{}.{}'.format(stem, strutils.slugify(str(uri_to_local_path(uri_prefix))), extension)
+    )
+
+
+# The index connection (or prefetched index state) of the current pool worker process.
+# Created once by _init_worker().
+_WORKER_INDEX = None  # type: Index
+_WORKER_SNAPSHOT = None  # type: IndexSnapshot
+# The previous run's manifest, for incremental syncs.
+_WORKER_MANIFEST = None  # type: Manifest
+_WORKER_VALIDATION_LEVEL = ValidationLevel.STATISTICS
+
+
+class _LazyIndex:
+    """
+    An index connection that's only opened when it's first used.
+
+    (With a snapshot, it's usually never needed: only to look up datasets that aren't in the snapshot)
+    """
+
+    def __init__(self, index_url: str, connection_counter) -> None:
+        self._index_url = index_url
+        self._connection_counter = connection_counter
+        self._index = None  # type: Index
+
+    def __getattr__(self, name):
+        if self._index is None:
+            # pylint: disable=protected-access
+            self._index = Index(PostgresDb(PostgresDb._create_engine(self._index_url)))
+            with self._connection_counter.get_lock():
+                self._connection_counter.value += 1
+        return getattr(self._index, name)
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+
+
+def _init_worker(index_url: str,
+                 connection_counter,
+                 snapshot: IndexSnapshot = None,
+                 previous_manifest: Manifest = None,
+                 validation_level: ValidationLevel = ValidationLevel.STATISTICS):
+    """
+    Pool initializer: one index connection per worker process, to be reused for every uri it is given.
+
+    (Only the url is sent to the workers: it's usually warned against to share datacube index engines
+    between processes.)
+
+    The connection is opened on first use: if the index state was already prefetched into a snapshot,
+    it's only needed for datasets outside of it.
+    """
+    # pylint: disable=global-statement
+    global _WORKER_INDEX, _WORKER_SNAPSHOT, _WORKER_MANIFEST, _WORKER_VALIDATION_LEVEL
+    _WORKER_SNAPSHOT = snapshot
+    _WORKER_MANIFEST = previous_manifest
+    _WORKER_VALIDATION_LEVEL = validation_level
+    _WORKER_INDEX = _LazyIndex(index_url, connection_counter)
+
+
+def _find_uri_mismatches(index: Index,
+                         uri: str,
+                         validation_level: ValidationLevel = ValidationLevel.STATISTICS,
+                         snapshot: IndexSnapshot = None) -> Iterable[Mismatch]:
     """
     Compare the index and filesystem contents for the given uris,
     yielding Mismatches of any differences.
+
+    Data files are checked to the given validation level (usually that of the collection).
+
+    If a snapshot of the index is given it's used instead of querying the index.
+    """
+    indexed_datasets, get_indexed_dataset = _index_lookups(index, uri, snapshot)
+    return _compare_uri(uri, indexed_datasets, get_indexed_dataset, validation_level=validation_level)
+
+
+def _index_lookups(index: Index, uri: str, snapshot: IndexSnapshot = None):
     """
+    Get the datasets indexed at the uri, and a lookup function for other indexed datasets.
+    """
+    if snapshot is not None:
+        def get_indexed_dataset(id_: UUID) -> Optional[DatasetLite]:
+            # The snapshot only has the collection's datasets (and those at its locations): a file's dataset
+            # may have been indexed as another product.
+            dataset = snapshot.get(id_)
+            return dataset if dataset is not None else get_dataset(index, id_)
+
+        return set(snapshot.get_datasets_for_uri(uri)), get_indexed_dataset
+
+    _LOG.debug("index.get_dataset_ids_for_uri", uri=uri)
+    return set(get_datasets_for_uri(index, uri)), partial(get_dataset, index)
 
-    # pylint: disable=protected-access
-    index = Index(PostgresDb(PostgresDb._create_engine(index_url)))
+
+def _find_uri_mismatches_incremental(index: Index,
+                                     uri: str,
+                                     previous_manifest: Manifest,
+                                     validation_level: ValidationLevel = ValidationLevel.STATISTICS,
+                                     snapshot: IndexSnapshot = None) -> Tuple[ManifestEntry, bool]:
+    """
+    Compare the index and filesystem contents for the given uri, reusing the previous result if neither
+    the file nor the index have changed since (at the uri, or for the file's datasets elsewhere).
+
+    Returns the new manifest entry for the uri (containing its mismatches), and whether it was unchanged.
+    """
+    path = uri_to_local_path(uri)
+    path_state = PathState.of(path)
+    indexed_datasets, get_indexed_dataset = _index_lookups(index, uri, snapshot)
+
+    previous = previous_manifest.get(uri)
+    # (The file is unchanged if the path is, so its dataset ids are those recorded)
+    if previous is not None and previous.is_unchanged(
+            path_state,
+            manifest.file_index_state(indexed_datasets, previous.dataset_ids, get_indexed_dataset)
+    ):
+        # The index state is unchanged, so the current datasets are the (unserialised) siblings too.
+        siblings = frozenset(indexed_datasets)
+        for mismatch in previous.mismatches:
+            mismatch.siblings = siblings
+        return previous, True
+
+    datasets_in_file = None
+    if path_state is not None:
+        try:
+            datasets_in_file = set(map(DatasetLite, paths.get_path_dataset_ids(path)))
+        except InvalidDocException:
+            # Leave it to the comparison to report.
+            pass
+
+    mismatches = tuple(_compare_uri(uri, indexed_datasets, get_indexed_dataset,
+                                    validation_level=validation_level,
+                                    datasets_in_file=datasets_in_file))
+    dataset_ids = tuple(sorted(d.id for d in datasets_in_file or ()))
+    return ManifestEntry(
+        uri=uri,
+        path_state=path_state,
+        index_state=manifest.file_index_state(indexed_datasets, dataset_ids, get_indexed_dataset),
+        dataset_ids=dataset_ids,
+        mismatches=mismatches,
+    ), False
+
+
+def _compare_uri(uri: str,
+                 indexed_datasets: Set[DatasetLite],
+                 get_indexed_dataset: Callable[[UUID], Optional[DatasetLite]],
+                 validation_level: ValidationLevel = ValidationLevel.STATISTICS,
+                 datasets_in_file: Set[DatasetLite] = None) -> Iterable[Mismatch]:
+    """
+    Compare the datasets indexed at the given uri with the file contents, yielding Mismatches of any differences.
+
+    :param get_indexed_dataset: lookup of an indexed dataset by id, for file datasets that aren't at this location.
+    :param datasets_in_file: the datasets in the file, if the caller has already read them.
+
+    The mismatches carry the datasets indexed at the uri as their siblings, so that fixes they already rule out
+    can be skipped without querying the index again.
+    """
 
     def ids(datasets):
         return [d.id for d in datasets]
 
     path = uri_to_local_path(uri)
     log = _LOG.bind(path=path)
-    log.debug("index.get_dataset_ids_for_uri")
-    indexed_datasets = set(get_datasets_for_uri(index, uri))
-
-    datasets_in_file = set()  # type: Set[DatasetLite]
-    if path.exists():
-        try:
-            datasets_in_file = set(map(DatasetLite, paths.get_path_dataset_ids(path)))
-        except InvalidDocException as e:
-            # Should we do something with indexed_datasets here? If there's none, we're more willing to trash.
-            log.info("invalid_path", error_args=e.args)
-            yield UnreadableDataset(None, uri)
-            return
+    siblings = frozenset(indexed_datasets)
+
+    if datasets_in_file is not None or path.exists():
+        if datasets_in_file is None:
+            try:
+                datasets_in_file = set(map(DatasetLite, paths.get_path_dataset_ids(path)))
+            except InvalidDocException as e:
+                # Should we do something with indexed_datasets here? If there's none, we're more willing to trash.
+                log.info("invalid_path", error_args=e.args)
+                yield UnreadableDataset(None, uri, siblings)
+                return
 
         log.info("dataset_ids",
                  indexed_dataset_ids=ids(indexed_datasets),
                  file_ids=ids(datasets_in_file))
 
-        if validate_data:
-            validation_success = validate.validate_dataset(path, log=log)
+        if validation_level > ValidationLevel.NONE:
+            # Imported on first use: it loads gdal (so unvalidated syncs don't need it)
+            from digitalearthau.sync import validate
+            validation_success = validate.validate_dataset(path, log=log, level=validation_level)
             if not validation_success:
-                yield InvalidDataset(None, uri)
+                yield InvalidDataset(None, uri, siblings)
                 return
+    else:
+        datasets_in_file = set()
 
     for indexed_dataset in indexed_datasets:
         # Does the dataset exist in the file?
         if indexed_dataset in datasets_in_file:
             if indexed_dataset.is_archived:
-                yield ArchivedDatasetOnDisk(indexed_dataset, uri)
+                yield ArchivedDatasetOnDisk(indexed_dataset, uri, siblings)
         else:
-            yield LocationMissingOnDisk(indexed_dataset, uri)
+            yield LocationMissingOnDisk(indexed_dataset, uri, siblings)
 
     # For all file ids not in the index.
     file_ds_not_in_index = datasets_in_file.difference(indexed_datasets)
@@ -132,62 +381,589 @@ def _find_uri_mismatches(index_url: str, uri: str, validate_data=True) -> Iterab
 
     for dataset in file_ds_not_in_index:
         # If it's already indexed, we just need to add the location.
-        indexed_dataset = index.datasets.get(dataset.id)
+        indexed_dataset = get_indexed_dataset(dataset.id)
         if indexed_dataset:
             log.info("location_not_indexed", indexed_dataset=indexed_dataset)
-            yield LocationNotIndexed(DatasetLite.from_agdc(indexed_dataset), uri)
+            yield LocationNotIndexed(indexed_dataset, uri, siblings)
         else:
             log.info("dataset_not_index", dataset=dataset, uri=uri)
-            yield DatasetNotIndexed(dataset, uri)
+            yield DatasetNotIndexed(dataset, uri, siblings)
+
+
+def merge_sorted_uris(index_locations: Iterable[Tuple[str, DatasetLite]],
+                      fs_uris: Iterable[str]) -> Iterable[Tuple[str, Set[DatasetLite], bool]]:
+    """
+    Merge-join sorted index locations with sorted filesystem uris.
+
+    Yields each uri once, with the datasets indexed there and whether it was found on disk.
+
+    >>> a, b = DatasetLite(UUID(int=1)), DatasetLite(UUID(int=2))
+    >>> merged = merge_sorted_uris(
+    ...     [('file:///a', a), ('file:///b', a), ('file:///b', b)],
+    ...     ['file:///b', 'file:///c']
+    ... )
+    >>> [(uri, sorted(d.id.int for d in datasets), on_disk) for uri, datasets, on_disk in merged]
+    [('file:///a', [1], False), ('file:///b', [1, 2], True), ('file:///c', [], True)]
+    >>> list(merge_sorted_uris([], ['file:///b', 'file:///a']))
+    Traceback (most recent call last):
+    ...
+    RuntimeError: filesystem uris are not sorted: 'file:///a' after 'file:///b'
+    """
+
+    def check_sorted(items, side_name):
+        last_uri = None
+        for uri, value in items:
+            if last_uri is not None and uri <= last_uri:
+                raise RuntimeError("{} uris are not sorted: {!r} after {!r}".format(side_name, uri, last_uri))
+            last_uri = uri
+            yield uri, value
+
+    index_side = check_sorted(
+        ((uri, {d for _, d in rows}) for uri, rows in groupby(index_locations, key=itemgetter(0))),
+        'index'
+    )
+    fs_side = check_sorted(((uri, None) for uri in fs_uris), 'filesystem')
+
+    indexed, on_disk = next(index_side, None), next(fs_side, None)
+    while indexed is not None or on_disk is not None:
+        if on_disk is None or (indexed is not None and indexed[0] < on_disk[0]):
+            yield indexed[0], indexed[1], False
+            indexed = next(index_side, None)
+        elif indexed is None or on_disk[0] < indexed[0]:
+            yield on_disk[0], set(), True
+            on_disk = next(fs_side, None)
+        else:
+            yield indexed[0], indexed[1], True
+            indexed, on_disk = next(index_side, None), next(fs_side, None)
 
 
 def mismatches_for_collection(collection: Collection,
                               cache_folder: Path,
-                              # Root folder of all file uris.
-                              uri_prefix="file:///",
+                              uri_prefix=ROOT_URI,
                               workers=2,
-                              work_chunksize=30) -> Iterable[Mismatch]:
+                              work_chunksize: int = None,
+                              prefetch_index=True,
+                              sorted_merge=False,
+                              incremental=False,
+                              index_first=False,
+                              fs_uris: Iterable[str] = None,
+                              validation_level: ValidationLevel = None,
+                              checkpoint: Checkpoint = None,
+                              shard: Shard = None,
+                              stages: StageSizes = None) -> Iterable[Mismatch]:
     """
     Compare the given index and filesystem contents, yielding Mismatches of any differences.
+
+    With prefetch_index, the index state of the whole collection (within the uri prefix) is loaded in bulk
+    up-front, rather than the workers querying the index for each uri.
+
+    With sorted_merge, sorted index locations and filesystem paths are streamed and merge-joined instead of
+    building a path set. Memory use is bounded regardless of collection size, and only uris that
+    disagree need further index lookups. (prefetch_index and the cache folder are not used)
+
+    With incremental, a manifest of each path's state is kept in the cache folder, and paths whose file and
+    index state haven't changed since the last run reuse their previous result. (See the manifest module)
+
+    With index_first, a collection whose index is trusted (Trust.INDEX) has its index locations checked for
+    existence, and only the directories suspected of holding unindexed files are listed, rather than walking
+    its whole tree. Files that are indexed aren't opened unless they're validated. (See the indexfirst module.
+    Other collections are scanned as usual)
+
+    The filesystem uris can be given if they've already been crawled (they're otherwise found from the
+    collection's file patterns). They're not used by a sorted merge, which walks them in sorted order itself.
+
+    Uris are handed to the workers in chunks sized from the measured time per uri, unless a fixed
+    work_chunksize is given.
+
+    With stage sizes, the work is instead split into stages with their own pools: file reads, validation and
+    index comparison. (See :func:`_staged_mismatches`. Not available for incremental or sorted merge syncs.)
+
+    Data files are validated at the collection's own validation level, unless another is given.
+
+    With a shard, only the uris within it are compared.
+
+    With a checkpoint, uris completed by a previous run are skipped, and each uri is recorded as scanned
+    (with its number of mismatches) before its mismatches are yielded.
     """
-    log = _LOG.bind(collection=collection.name)
+    return mismatches_for_collections(
+        [(collection, uri_prefix)],
+        cache_folder,
+        workers=workers,
+        work_chunksize=work_chunksize,
+        prefetch_index=prefetch_index,
+        sorted_merge=sorted_merge,
+        incremental=incremental,
+        index_first=index_first,
+        fs_uris=None if fs_uris is None else {(collection, uri_prefix): fs_uris},
+        validation_level=validation_level,
+        checkpoint=checkpoint,
+        shard=shard,
+        stages=stages,
+    )
+
 
-    path_dawg = build_pathset(collection, cache_folder, log=log)
+def mismatches_for_collections(collection_prefixes: List[Tuple[Collection, str]],
+                               cache_folder: Path,
+                               workers=2,
+                               work_chunksize: int = None,
+                               prefetch_index=True,
+                               sorted_merge=False,
+                               incremental=False,
+                               index_first=False,
+                               fs_uris: Mapping[Tuple[Collection, str], Iterable[str]] = None,
+                               pathset_checks: Mapping[Tuple[Collection, str], pathsets.PathsetCheck] = None,
+                               validation_level: ValidationLevel = None,
+                               checkpoint: Checkpoint = None,
+                               shard: Shard = None,
+                               stages: StageSizes = None) -> Iterable[Mismatch]:
+    """
+    Compare the index and filesystem contents of each (collection, uri prefix), yielding Mismatches of any
+    differences.
+
+    The collections share the worker budget: each is scanned in turn with all of the workers, while the next
+    is prepared (its path set built and index snapshot loaded) on a thread. So the workers aren't left idle
+    while a collection's path set is built, except for the first.
+
+    (Worker pools are only started when no preparation thread is running: forking while another
+    thread holds a lock, such as the log's, would leave it held forever in the child.)
+
+    A summary of each collection's timings is logged at the end.
+
+    The filesystem uris can be given for each (collection, uri prefix) that's already been crawled (the prefixes
+    can be pieces of a collection's path set, as chosen by the given checks of each: see :func:`check_pathset`).
+    Other arguments are as for :func:`mismatches_for_collection`.
+    """
+    if incremental and sorted_merge:
+        raise ValueError("Incremental syncs use a path set: they can't be combined with a sorted merge")
+    if incremental and not cache_folder:
+        raise ValueError("Incremental syncs need a cache folder to store their manifest")
+    if stages is not None and (incremental or sorted_merge):
+        raise ValueError("Staged syncs can't be combined with incremental or sorted merge syncs")
+    if index_first and (incremental or sorted_merge or stages is not None):
+        raise ValueError("Index-first syncs can't be combined with incremental, sorted merge or staged syncs")
+
+    fs_uris = fs_uris or {}
+    pathset_checks = pathset_checks or {}
+    summaries = []  # type: List[dict]
+    start_time = time.time()
+
+    with ThreadPoolExecutor(1, thread_name_prefix='sync-prepare') as executor:
+        def prepare(i: int):
+            collection, uri_prefix = collection_prefixes[i]
+            return executor.submit(_prepare_scan, collection, cache_folder,
+                                   uri_prefix=uri_prefix,
+                                   prefetch_index=prefetch_index,
+                                   sorted_merge=sorted_merge,
+                                   incremental=incremental,
+                                   index_first=index_first,
+                                   fs_uris={prefix: uris for (c, prefix), uris in fs_uris.items() if c is collection},
+                                   pathset_check=pathset_checks.get((collection, uri_prefix)),
+                                   validation_level=validation_level,
+                                   checkpoint=checkpoint,
+                                   shard=shard)
+
+        next_prepared = None
+        for i, (collection, uri_prefix) in enumerate(collection_prefixes):
+            wait_start_time = time.time()
+            prepared = (next_prepared or prepare(i)).result()
+            next_prepared = None
+            scan_start_time = time.time()
+
+            def prepare_next(i=i):
+                nonlocal next_prepared
+                if i + 1 < len(collection_prefixes):
+                    next_prepared = prepare(i + 1)
+
+            counts = yield from _run_scan(collection, prepared,
+                                          workers=workers,
+                                          work_chunksize=work_chunksize,
+                                          checkpoint=checkpoint,
+                                          stages=stages,
+                                          on_started=prepare_next)
+            summaries.append(dict(
+                collection=collection.name,
+                uri_prefix=uri_prefix,
+                prepare_secs=round(prepared.prepare_secs, 1),
+                # Time spent waiting for the preparation: the part that wasn't overlapped with another scan.
+                prepare_wait_secs=round(scan_start_time - wait_start_time, 1),
+                scan_secs=round(time.time() - scan_start_time, 1),
+                **counts
+            ))
+
+    _LOG.info("scan.summary",
+              collections=summaries,
+              secs=round(time.time() - start_time, 1))
+
+
+def compare_uris(collection: Collection,
+                 uris: List[str],
+                 workers=2,
+                 validation_level: ValidationLevel = None) -> List[List[Mismatch]]:
+    """
+    Compare the given uris of the collection (such as a sample of it), returning the mismatches of each, in order.
+
+    The workers query the index for each uri, rather than loading the index state of the whole collection.
+    """
+    if validation_level is None:
+        validation_level = collection.validation_level
 
     # Clean up any open connections before we fork.
     collection.index_.close()
-    index_url = collection.index_.url
+    connection_counter = multiprocessing.Value('i', 0)
+    with multiprocessing.Pool(processes=workers,
+                              initializer=_init_worker,
+                              initargs=(collection.index_.url, connection_counter, None, None,
+                                        validation_level)) as pool:
+        return pool.map(partial(_with_cache_flush, _find_uri_mismatches_eager), uris, chunksize=1)
+
+
+class _PreparedScan(NamedTuple):
+    """
+    The work of a collection's scan, ready to hand to the workers.
+    """
+    log: Any
+    work_items: Iterable
+    find_mismatches: Callable
+    validation_level: ValidationLevel
+    snapshot: Optional[IndexSnapshot]
+    previous_manifest: Optional[Manifest]
+    manifest_path: Optional[Path]
+    prepare_secs: float
+
+
+def _prepare_scan(collection: Collection,
+                  cache_folder: Path,
+                  uri_prefix=ROOT_URI,
+                  prefetch_index=True,
+                  sorted_merge=False,
+                  incremental=False,
+                  index_first=False,
+                  fs_uris: Mapping[str, Iterable[str]] = None,
+                  pathset_check: pathsets.PathsetCheck = None,
+                  validation_level: ValidationLevel = None,
+                  checkpoint: Checkpoint = None,
+                  shard: Shard = None) -> _PreparedScan:
+    """
+    Build the collection's path set and load its index snapshot (as configured), and set up the stream of its
+    work items.
 
-    with multiprocessing.Pool(processes=workers) as pool:
-        result = pool.imap_unordered(
-            partial(_find_uri_mismatches_eager, index_url),
-            path_dawg.iterkeys(uri_prefix),
-            chunksize=work_chunksize
+    This doesn't start any processes, so it's safe to run on a thread.
+    """
+    start_time = time.time()
+    log = _LOG.bind(collection=collection.name)
+    if validation_level is None:
+        validation_level = collection.validation_level
+
+    if sorted_merge:
+        log.info("scan.sorted_merge", uri_prefix=uri_prefix)
+        snapshot = None
+        work_items = merge_sorted_uris(
+            iter_sorted_locations(collection.index_, collection.query, uri_prefix=uri_prefix),
+            (uri for uri in collection.iter_fs_uris_sorted(uri_to_local_path(uri_prefix))
+             if uri.startswith(uri_prefix))
         )
+        find_mismatches = _find_merged_uri_mismatches_eager
+    elif index_first and collection.trust is Trust.INDEX:
+        log.info("scan.index_first", uri_prefix=uri_prefix)
+        snapshot = None
+        work_items = indexfirst.iter_work_items(collection, uri_prefix, log=log)
+        find_mismatches = _find_index_first_mismatches_eager
+    else:
+        path_dawg = build_pathset(collection, cache_folder, log=log, uri_prefix=uri_prefix, fs_uris=fs_uris,
+                                  checked=pathset_check)
+
+        snapshot = None
+        if prefetch_index:
+            log.info("index.snapshot.load", uri_prefix=uri_prefix)
+            snapshot = load_index_snapshot(collection.index_, collection.query, uri_prefix=uri_prefix)
+
+        work_items = path_dawg.iterkeys(uri_prefix)
+        find_mismatches = _find_uri_mismatches_eager
+
+    previous_manifest = manifest_path = None
+    if incremental:
+        # Each shard has its own manifest (shard jobs run at once, and each only scans its own uris).
+        manifest_name = 'manifest-shard{}of{}.db'.format(shard.index, shard.count) if shard else 'manifest.db'
+        manifest_path = _cache_file(cache_folder.joinpath(query_name(collection.query)), uri_prefix, manifest_name)
+        log.info("manifest.use", path=manifest_path, exists=manifest_path.exists())
+        previous_manifest = Manifest(manifest_path)
+        find_mismatches = _find_uri_mismatches_incremental_eager
+
+    if shard is not None:
+        log = log.bind(shard=str(shard))
+        work_items = (item for item in work_items if shard.contains(_work_item_uri(item)))
+    if checkpoint is not None:
+        work_items = (item for item in work_items if not checkpoint.is_complete(_work_item_uri(item)))
+        find_mismatches = partial(_find_with_uri, find_mismatches)
+
+    return _PreparedScan(
+        log=log,
+        work_items=work_items,
+        find_mismatches=find_mismatches,
+        validation_level=validation_level,
+        snapshot=snapshot,
+        previous_manifest=previous_manifest,
+        manifest_path=manifest_path,
+        prepare_secs=time.time() - start_time,
+    )
 
-        for r in result:
-            yield from r
 
-        pool.close()
-        pool.join()
+def _run_scan(collection: Collection,
+              prepared: _PreparedScan,
+              workers=2,
+              work_chunksize: int = None,
+              checkpoint: Checkpoint = None,
+              stages: StageSizes = None,
+              on_started: Callable[[], None] = None) -> Iterable[Mismatch]:
+    """
+    Scan the prepared work on a pool of workers, yielding the mismatches found.
+
+    on_started is called once the workers are started (it's then safe to start other threads).
+
+    Returns the number of uris scanned and mismatches found.
+    """
+    log = prepared.log
+    find_mismatches = prepared.find_mismatches
+    manifest_writer = contextlib.nullcontext()
+    if prepared.manifest_path is not None:
+        manifest_writer = ManifestWriter(prepared.manifest_path)
+
+    # Clean up any open connections before we fork.
+    collection.index_.close()
+    index_url = collection.index_.url
+
+    # Number of index connections opened by the workers (one per worker process).
+    connection_counter = multiprocessing.Value('i', 0)
+    uri_count = 0
+    mismatch_count = 0
+    unchanged_count = 0
+
+    if stages is not None:
+        for uri, r in _staged_mismatches(prepared.work_items, index_url, prepared.snapshot,
+                                         prepared.validation_level, stages, connection_counter, log,
+                                         on_started=on_started):
+            uri_count += 1
+            mismatch_count += len(r)
+            if checkpoint is not None:
+                checkpoint.scanned(uri, len(r))
+            yield from r
+    else:
+        with manifest_writer as new_manifest, \
+                multiprocessing.Pool(processes=workers,
+                                     initializer=_init_worker,
+                                     initargs=(index_url, connection_counter, prepared.snapshot,
+                                               prepared.previous_manifest, prepared.validation_level)) as pool:
+            if on_started:
+                on_started()
+            dispatcher = AdaptiveDispatcher(pool, workers, chunksize=work_chunksize)
+
+            for r in dispatcher.imap_unordered(find_mismatches, prepared.work_items):
+                uri_count += 1
+
+                if checkpoint is not None:
+                    uri, r = r
+
+                if new_manifest is not None:
+                    entry, was_unchanged = r
+                    new_manifest.add(entry)
+                    unchanged_count += was_unchanged
+                    r = entry.mismatches
+
+                mismatch_count += len(r)
+                if checkpoint is not None:
+                    checkpoint.scanned(uri, len(r))
+                yield from r
+
+            pool.close()
+            pool.join()
+
+            if new_manifest is not None and checkpoint is not None:
+                # The uris skipped by the checkpoint weren't scanned: keep what we knew of them.
+                new_manifest.copy_previous(prepared.previous_manifest, checkpoint.previous_completed_uris())
+
+        dispatcher.log_summary(log)
+
+    log.info("scan.done",
+             uri_count=uri_count,
+             mismatch_count=mismatch_count,
+             checkpoint_skipped_count=checkpoint.skipped_count if checkpoint else 0,
+             unchanged_count=unchanged_count,
+             index_connections=connection_counter.value)
+    return dict(uri_count=uri_count, mismatch_count=mismatch_count)
+
+
+def _staged_mismatches(uris: Iterable[str],
+                       index_url: str,
+                       snapshot: Optional[IndexSnapshot],
+                       validation_level: ValidationLevel,
+                       sizes: StageSizes,
+                       connection_counter,
+                       log,
+                       on_started: Callable[[], None] = None) -> Iterable[Tuple[str, List[Mismatch]]]:
+    """
+    Compare the uris in stages, yielding each uri and its mismatches as they're completed.
 
+    - read: the dataset ids in the file (on a pool of threads: it's mostly waiting on the filesystem)
+    - validate: the data files, if the file is readable (on a pool of processes)
+    - index: compare with the index (on a few threads, each with its own connection, unless given a snapshot)
 
-def _find_uri_mismatches_eager(index_url: str, uri: str) -> List[Mismatch]:
-    return list(_find_uri_mismatches(index_url, uri))
+    on_started is called once the pools are started.
+    """
+    # Index connection of each index stage thread.
+    thread_state = threading.local()
+    opened_indexes = []  # type: List[_LazyIndex]
+
+    def index_lookups(uri: str):
+        if getattr(thread_state, 'index', None) is None:
+            thread_state.index = _LazyIndex(index_url, connection_counter)
+            opened_indexes.append(thread_state.index)
+        return _index_lookups(thread_state.index, uri, snapshot)
+
+    def compare(item: Tuple[str, Set[DatasetLite]]) -> Tuple[str, List[Mismatch]]:
+        uri, datasets_in_file = item
+        indexed_datasets, get_indexed_dataset = index_lookups(uri)
+        # (Already validated)
+        return uri, list(_compare_uri(uri, indexed_datasets, get_indexed_dataset,
+                                      validation_level=ValidationLevel.NONE,
+                                      datasets_in_file=datasets_in_file))
+
+    def failed(item: Tuple[str, Type[Mismatch]]) -> Tuple[str, List[Mismatch]]:
+        # An unreadable or invalid file, with its siblings attached (as _compare_uri does).
+        uri, mismatch_type = item
+        indexed_datasets, _ = index_lookups(uri)
+        return uri, [mismatch_type(None, uri, frozenset(indexed_datasets))]
+
+    with contextlib.ExitStack() as stack:
+        validate_stage = None
+        if validation_level > ValidationLevel.NONE:
+            # Started first: we want to fork before any threads exist.
+            pool = stack.enter_context(multiprocessing.Pool(processes=sizes.validate_processes,
+                                                            initializer=_init_validation_worker,
+                                                            initargs=(validation_level,)))
+            validate_stage = Stage.on_pool('validate', pool, sizes.validate_processes)
+        read_stage = Stage.on_executor('read', stack.enter_context(
+            ThreadPoolExecutor(sizes.read_threads, thread_name_prefix='sync-read')
+        ), sizes.read_threads)
+        index_stage = Stage.on_executor('index', stack.enter_context(
+            ThreadPoolExecutor(sizes.index_connections, thread_name_prefix='sync-index')
+        ), sizes.index_connections)
+        if on_started:
+            on_started()
+
+        def start(uri: str, done, fail):
+            def after_read(result):
+                uri_, datasets_in_file = result
+                if datasets_in_file is None:
+                    index_stage.submit(failed, (uri_, UnreadableDataset), done, fail)
+                elif datasets_in_file and validate_stage:
+                    validate_stage.submit(partial(_with_cache_flush, _validate_uri_eager), uri_,
+                                          partial(after_validate, datasets_in_file), fail)
+                else:
+                    index_stage.submit(compare, (uri_, datasets_in_file), done, fail)
+
+            def after_validate(datasets_in_file, result):
+                uri_, is_valid = result
+                if not is_valid:
+                    index_stage.submit(failed, (uri_, InvalidDataset), done, fail)
+                else:
+                    index_stage.submit(compare, (uri_, datasets_in_file), done, fail)
+
+            read_stage.submit(_read_uri, uri, after_read, fail)
+
+        stages = [stage for stage in (read_stage, validate_stage, index_stage) if stage]
+        start_time = time.time()
+        try:
+            yield from run_pipeline(uris, start, max_in_flight=2 * sum(stage.workers for stage in stages))
+        finally:
+            for stage in stages:
+                stage.log_summary(time.time() - start_time, log)
+            for index in opened_indexes:
+                index.close()
 
 
-def query_name(query: Mapping[str, Any]) -> str:
+def _read_uri(uri: str) -> Tuple[str, Optional[Set[DatasetLite]]]:
     """
-    Get a string name for the given query args.
+    Get the datasets in the file at the uri: none if there's no file, or None if it's unreadable.
+    """
+    path = uri_to_local_path(uri)
+    if not path.exists():
+        return uri, set()
+    try:
+        return uri, set(map(DatasetLite, paths.get_path_dataset_ids(path)))
+    except InvalidDocException as e:
+        _LOG.info("invalid_path", path=path, error_args=e.args)
+        return uri, None
+
+
+def _init_validation_worker(validation_level: ValidationLevel):
+    global _WORKER_VALIDATION_LEVEL  # pylint: disable=global-statement
+    _WORKER_VALIDATION_LEVEL = validation_level
+
+
+def _validate_uri_eager(uri: str) -> Tuple[str, bool]:
+    from digitalearthau.sync import validate
+
+    path = uri_to_local_path(uri)
+    return uri, validate.validate_dataset(path, log=_LOG.bind(path=path), level=_WORKER_VALIDATION_LEVEL)
+
 
-    >>> query_name({'product': 'ls8_level1_scene'})
-    'product_ls8_level1_scene'
-    >>> query_name({'metadata_type': 'telemetry'})
-    'metadata_type_telemetry'
-    >>> query_name({'a': '1', 'b': 2, 'c': '"3"'})
-    'a_1-b_2-c_3'
+def _with_cache_flush(function: Callable, item):
     """
-    return "-".join(
-        '{}_{}'.format(k, strutils.slugify(str(v)))
-        for k, v in sorted(query.items())
-    )
+    Run in a pool worker, writing any cached file values afterwards (the pool terminates its workers without
+    running their exit hooks).
+    """
+    try:
+        return function(item)
+    finally:
+        filecache.flush_all()
+
+
+def _work_item_uri(item) -> str:
+    # Work items are uris, or (uri, indexed datasets, on disk) for a sorted merge or an index-first scan.
+    return item if isinstance(item, str) else item[0]
+
+
+def _find_with_uri(find_mismatches: Callable, item) -> Tuple[str, Any]:
+    return _work_item_uri(item), find_mismatches(item)
+
+
+def _find_uri_mismatches_eager(uri: str) -> List[Mismatch]:
+    return list(_find_uri_mismatches(_WORKER_INDEX, uri,
+                                     validation_level=_WORKER_VALIDATION_LEVEL,
+                                     snapshot=_WORKER_SNAPSHOT))
+
+
+def _find_uri_mismatches_incremental_eager(uri: str) -> Tuple[ManifestEntry, bool]:
+    return _find_uri_mismatches_incremental(_WORKER_INDEX, uri, _WORKER_MANIFEST,
+                                            validation_level=_WORKER_VALIDATION_LEVEL,
+                                            snapshot=_WORKER_SNAPSHOT)
+
+
+def _find_merged_uri_mismatches_eager(item: Tuple[str, Set[DatasetLite], bool]) -> List[Mismatch]:
+    uri, indexed_datasets, on_disk = item
+
+    # Only in the index, and not on disk: no need to read anything.
+    if not on_disk and not uri_to_local_path(uri).exists():
+        siblings = frozenset(indexed_datasets)
+        return [LocationMissingOnDisk(dataset, uri, siblings) for dataset in indexed_datasets]
+
+    return list(_compare_uri(uri, indexed_datasets, partial(get_dataset, _WORKER_INDEX),
+                             validation_level=_WORKER_VALIDATION_LEVEL))
+
+
+def _find_index_first_mismatches_eager(item: indexfirst.WorkItem) -> List[Mismatch]:
+    # A file found on disk that isn't an indexed location.
+    if isinstance(item, str):
+        return _find_uri_mismatches_eager(item)
+
+    uri, indexed_datasets, on_disk = item
+    siblings = frozenset(indexed_datasets)
+    if not on_disk:
+        return [LocationMissingOnDisk(dataset, uri, siblings) for dataset in indexed_datasets]
+
+    if _WORKER_VALIDATION_LEVEL == ValidationLevel.NONE:
+        # The index is trusted for what the file holds, so it isn't opened.
+        return [ArchivedDatasetOnDisk(dataset, uri, siblings) for dataset in indexed_datasets if dataset.is_archived]
+
+    return list(_compare_uri(uri, indexed_datasets, partial(get_dataset, _WORKER_INDEX),
+                             validation_level=_WORKER_VALIDATION_LEVEL))
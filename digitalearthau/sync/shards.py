@@ -0,0 +1,102 @@
+"""
+Split the sync of a collection across many jobs (nodes), and merge their reports.
+
+Each uri belongs to exactly one of N shards, by a stable hash of the uri. Every job scans the whole path
+listing but only compares (and fixes) the uris of its own shard, writing its mismatches with ``-o``.
+The shard reports can then be merged into one with ``dea-sync-merge``.
+"""
+import sys
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple, Iterable, TextIO, Set
+
+import click
+
+from .differences import Mismatch, mismatches_from_file, mismatch_line, mismatch_writer
+
+
+class Shard(NamedTuple):
+    # Zero-based.
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Shard':
+        """
+        >>> Shard.parse('0/4')
+        Shard(index=0, count=4)
+        >>> Shard.parse('4/4')
+        Traceback (most recent call last):
+        ...
+        ValueError: Expected a shard 'i/N' (with 0 <= i < N), got '4/4'
+        """
+        try:
+            index, count = (int(s) for s in spec.split('/'))
+        except ValueError:
+            index = count = -1
+        if not 0 <= index < count:
+            raise ValueError("Expected a shard 'i/N' (with 0 <= i < N), got {!r}".format(spec))
+        return cls(index, count)
+
+    def contains(self, uri: str) -> bool:
+        """
+        Is the uri in this shard? (Every uri is in exactly one shard of a count)
+
+        >>> uri = 'file:///g/data/v10/reprocess/ls7/level1/2016/04/LS7_SCENE/ga-metadata.yaml'
+        >>> [Shard(i, 3).contains(uri) for i in range(3)].count(True)
+        1
+        """
+        # A stable hash: python's own differs per process.
+        return zlib.crc32(uri.encode('utf-8')) % self.count == self.index
+
+    def __str__(self):
+        return '{}/{}'.format(self.index, self.count)
+
+
+def merge_mismatch_files(inputs: Iterable[Path], writer) -> Counter:
+    """
+    Merge the mismatch reports of shards into one, sorted by uri.
+
+    Any duplicates (such as from a shard that was resumed) are removed.
+
+    Returns the number of mismatches of each type.
+    """
+    mismatches = set()  # type: Set[Mismatch]
+    for path in inputs:
+        mismatches.update(mismatches_from_file(path))
+
+    counts = Counter()  # type: Counter
+    for mismatch in sorted(mismatches, key=lambda m: (m.uri, m.type_name, str(m.dataset))):
+        writer.write(mismatch)
+        counts[mismatch.__class__.__name__] += 1
+    return counts
+
+
+class _StreamWriter:
+    def __init__(self, out_f: TextIO) -> None:
+        self._f = out_f
+
+    def write(self, mismatch: Mismatch):
+        self._f.write(mismatch_line(mismatch))
+
+
+@click.command()
+@click.option('-o', '--output', 'output_file',
+              type=click.Path(writable=True, dir_okay=False),
+              help="Output to file instead of stdout (in the columnar format if it ends with '.npz')")
+@click.argument('shard_files',
+                type=click.Path(exists=True, readable=True, dir_okay=False),
+                nargs=-1)
+def merge_cli(shard_files, output_file):
+    """
+    Merge the mismatch outputs (-o) of dea-sync shards into one report.
+    """
+    if output_file:
+        with mismatch_writer(Path(output_file)) as writer:
+            counts = merge_mismatch_files((Path(f) for f in shard_files), writer)
+    else:
+        counts = merge_mismatch_files((Path(f) for f in shard_files), _StreamWriter(sys.stdout))
+
+    for name, count in sorted(counts.items()):
+        click.echo('{:>10} {}'.format(count, name), err=True)
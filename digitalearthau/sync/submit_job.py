@@ -22,6 +22,7 @@ from digitalearthau import collections
 from digitalearthau.collections import Trust
 from digitalearthau.paths import get_dataset_paths
 from digitalearthau.sync import scan
+from digitalearthau.sync.shards import Shard
 
 SUBMIT_THROTTLE_SECS = 1
 
@@ -39,10 +40,11 @@ TASK_TIME = datetime.datetime.now()
 
 
 class Task:
-    # A task has a list of paths from a single collection.
-    def __init__(self, input_paths: List[Path], dataset_count: int) -> None:
+    # A task has a list of paths from a single collection (or one shard of their uris).
+    def __init__(self, input_paths: List[Path], dataset_count: int, shard: Optional[Shard] = None) -> None:
         self.input_paths = input_paths
         self.dataset_count = dataset_count
+        self.shard = shard
 
         if not input_paths:
             raise ValueError("Minimum of one input path in a task")
@@ -65,6 +67,13 @@ class Task:
         ))
 
     def __repr__(self) -> str:
+        if self.shard:
+            return '%s(%r, %r, %r)' % (
+                self.__class__.__name__,
+                self.input_paths,
+                self.dataset_count,
+                self.shard
+            )
         return '%s(%r, %r)' % (
             self.__class__.__name__,
             self.input_paths,
@@ -106,7 +115,9 @@ class SyncSubmission(object):
                output_file: Path,
                error_file: Path,
                job_name: str,
-               require_job_id: Optional[str]) -> Tuple[str, List]:
+               require_job_id: Optional[str],
+               checkpoint_file: Optional[Path] = None,
+               mismatch_file: Optional[Path] = None) -> Tuple[str, List]:
 
         # Output files readable by others.
         attributes = ['umask=33']
@@ -116,6 +127,13 @@ class SyncSubmission(object):
             attributes.extend(['depend=afterany:{}'.format(str(require_job_id).strip())])
         if self.verbose:
             sync_opts.append('-v')
+        if checkpoint_file:
+            # A rerun of the job (eg. after it was killed or preempted) resumes from its checkpoint.
+            sync_opts.extend(['--checkpoint', str(checkpoint_file)])
+        if mismatch_file:
+            sync_opts.extend(['-o', str(mismatch_file)])
+        if task.shard:
+            sync_opts.extend(['--shard', str(task.shard)])
         if not self.dry_run:
             # Defaults. Trash things archived a while ago, and update the index's locations to match disk.
             sync_opts.extend(['--trash-archived', '--update-locations'])
@@ -163,6 +181,8 @@ class SyncSubmission(object):
             '-l', 'wd',
             '-N', 'sync-{}'.format(job_name),
             '-m', 'ae',
+            # Rerunnable: it can resume from its checkpoint.
+            '-r', 'y' if checkpoint_file else 'n',
             *qsub_opts,
             '-e', str(error_file),
             '-o', str(output_file),
@@ -197,6 +217,10 @@ class SyncSubmission(object):
               type=int,
               default=50,
               help="Maximum number of PBS jobs to allow (paths will be grouped to get under this limit)")
+@click.option('--max-job-datasets',
+              type=int,
+              default=FILES_PER_JOB_CUTOFF,
+              help="Split jobs with more datasets than this into shards (by uri) that run as separate jobs")
 @click.option('--concurrent-jobs',
               type=int,
               default=12,
@@ -213,6 +237,7 @@ def main(folders: Iterable[str],
          work_folder: str,
          cache_folder: str,
          max_jobs: int,
+         max_job_datasets: int,
          concurrent_jobs: int,
          submit_limit: int):
     """
@@ -227,6 +252,9 @@ def main(folders: Iterable[str],
     if output files exist.
 
     A run folder is used (defaulting to `runs` in current dir) for storing output status.
+
+    Each job writes the mismatches it finds to `mismatches.jsonl` in its run folder: they can be combined
+    into one report with `dea-sync-merge`.
     """
     input_paths = [Path(folder).absolute() for folder in folders]
 
@@ -249,6 +277,7 @@ def main(folders: Iterable[str],
                 "Grouping (max_jobs={})".format(max_jobs)
             )
         tasks = group_tasks(tasks, maximum=max_jobs)
+        tasks = shard_tasks(tasks, max_datasets=max_job_datasets)
 
         total_datasets = sum(t.dataset_count for t in tasks)
         click.secho(
@@ -277,10 +306,13 @@ def _paths_to_tasks(input_paths: List[Path]) -> List[Task]:
 
         return base_path.parent
 
+    # All collections are crawled in one pass, as they often share folders.
+    collection_folders = [(collection, input_path)
+                          for input_path in normalised_input_paths
+                          for collection in collections.get_collections_in_path(input_path)]
     parent_folder_counts = uniq_counts(dataset_folder_path(dataset_path)
-                                       for input_path in normalised_input_paths
-                                       for collection in collections.get_collections_in_path(input_path)
-                                       for dataset_path in collection.iter_fs_paths_within(input_path))
+                                       for _, dataset_path in
+                                       collections.iter_fs_paths_by_collection(collection_folders))
 
     # Sanity check: Each of these parent folders should still be within an input path
     for path, count in parent_folder_counts:
@@ -319,6 +351,27 @@ def group_tasks(tasks: List[Task], maximum) -> List[Task]:
     return tasks
 
 
+def shard_tasks(tasks: List[Task], max_datasets: int) -> List[Task]:
+    """
+    Split tasks with too many datasets into shards of their uris.
+
+    >>> collections._add(collections.Collection('test', {}, ['/test/*'], ()))
+    >>> shard_tasks([Task(['/test/a'], 5), Task(['/test/b'], 2)], max_datasets=2)
+    [Task(['/test/a'], 2, Shard(index=0, count=3)), Task(['/test/a'], 2, Shard(index=1, count=3)), \
+Task(['/test/a'], 2, Shard(index=2, count=3)), Task(['/test/b'], 2)]
+    >>> del collections._COLLECTIONS['test']
+    """
+    out = []
+    for task in tasks:
+        shard_count = -(-task.dataset_count // max_datasets)
+        if shard_count <= 1:
+            out.append(task)
+            continue
+        for i in range(shard_count):
+            out.append(Task(task.input_paths, -(-task.dataset_count // shard_count), Shard(i, shard_count)))
+    return out
+
+
 T = typing.TypeVar('T')
 
 
@@ -370,6 +423,8 @@ def _find_and_submit(tasks: List[Task],
             error_file=run_path.joinpath('err.log'),
             job_name='{}-{:02}'.format(task.collection.name, submitted),
             require_job_id=require_job_id,
+            checkpoint_file=run_path.joinpath('checkpoint.db'),
+            mismatch_file=run_path.joinpath('mismatches.jsonl'),
         )
 
         if job_id:
@@ -381,7 +436,9 @@ def _find_and_submit(tasks: List[Task],
                         'pbs_job_id': job_id,
                         'input_paths': [str(p) for p in task.input_paths],
                         'file_dataset_count': task.dataset_count,
-                        'collection_name': task.collection.name
+                        'collection_name': task.collection.name,
+                        'shard_index': task.shard.index if task.shard else None,
+                        'shard_count': task.shard.count if task.shard else None,
                     },
                     default_flow_style=False,
                     indent=4
@@ -0,0 +1,85 @@
+from pathlib import Path
+from uuid import UUID
+
+from digitalearthau.index import DatasetLite
+from digitalearthau.sync import differences, fixes
+from digitalearthau.sync.checkpoint import Checkpoint
+from digitalearthau.sync.differences import LocationNotIndexed, LocationMissingOnDisk
+
+DATASET_A = DatasetLite(UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2'))
+DATASET_B = DatasetLite(UUID('582e9a74-d343-42d2-9105-a248b4b04f4a'))
+
+SETTINGS = dict(update_locations=True)
+
+
+def test_uri_complete_once_all_fixes_applied(tmpdir):
+    path = tmpdir.join('checkpoint.db')
+    uri = 'file:///tmp/a.nc'
+    add_a, remove_b = LocationNotIndexed(DATASET_A, uri), LocationMissingOnDisk(DATASET_B, uri)
+
+    with Checkpoint(path, SETTINGS) as checkpoint:
+        checkpoint.scanned('file:///tmp/clean.nc', 0)
+        checkpoint.scanned(uri, 2)
+        checkpoint.applied(add_a)
+        # Killed before the second fix.
+
+    with Checkpoint(path, SETTINGS) as resumed:
+        assert resumed.is_complete('file:///tmp/clean.nc')
+        assert not resumed.is_complete(uri)
+        assert resumed.was_applied(add_a)
+        assert not resumed.was_applied(remove_b)
+
+        resumed.scanned(uri, 1)
+        resumed.applied(remove_b)
+
+    with Checkpoint(path, SETTINGS) as resumed:
+        assert resumed.is_complete(uri)
+
+    # Other fixes chosen: the previous work doesn't count.
+    with Checkpoint(path, dict(update_locations=True, trash_archived=True)) as changed:
+        assert not changed.is_complete(uri)
+
+
+def test_batched_fixes_recorded_after_flush(tmpdir, monkeypatch):
+    monkeypatch.setattr(fixes, 'update_index_locations', lambda index, to_add, to_remove: (0, 0))
+    uris = ['file:///tmp/{}.nc'.format(i) for i in range(3)]
+
+    with Checkpoint(tmpdir.join('checkpoint.db'), SETTINGS) as checkpoint:
+        applied = []
+
+        def post_fix(mismatch):
+            applied.append(mismatch.uri)
+            checkpoint.applied(mismatch)
+
+        def mismatches():
+            for uri in uris:
+                checkpoint.scanned(uri, 1)
+                yield LocationNotIndexed(DATASET_A, uri)
+            # Only the fixes of the first (full) batch have been applied.
+            assert applied == uris[:1]
+            assert checkpoint.completed_count == 1
+
+        fixes.fix_mismatches(mismatches(), None, update_locations=True, batch_size=2, post_fix=post_fix)
+
+        assert applied == uris
+        assert checkpoint.completed_count == 3
+
+
+def test_report_flushed_before_progress_written(tmpdir):
+    report = tmpdir.join('mismatches.jsonl')
+    writer = differences.JsonLinesWriter(Path(str(report)))
+    mismatch = LocationNotIndexed(DATASET_A, 'file:///tmp/a.nc')
+    flushed = []
+
+    def flush():
+        writer.flush()
+        flushed.append(report.read())
+
+    with Checkpoint(tmpdir.join('checkpoint.db'), SETTINGS, write_interval_secs=0, before_write=flush) as checkpoint:
+        checkpoint.scanned(mismatch.uri, 1)
+        writer.write(mismatch)
+        checkpoint.applied(mismatch)
+
+    writer.close()
+    # The mismatch was on disk before its uri was recorded as complete.
+    assert flushed[-1] == differences.mismatch_line(mismatch)
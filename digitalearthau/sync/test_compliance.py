@@ -0,0 +1,51 @@
+import sys
+from pathlib import Path
+
+from digitalearthau.sync.compliance import CheckerProcess
+
+NC_PATH = Path('/tmp/LS8_TILE.nc')
+
+
+def _python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_checker_responses():
+    checker = CheckerProcess(command=_python(
+        'import sys, json\n'
+        'for line in sys.stdin:\n'
+        '    print(json.dumps(dict(was_success=True, errors_occurred=False)), flush=True)\n'
+    ))
+    try:
+        assert checker.check(NC_PATH) == (True, False)
+        # The same process is reused.
+        first_process = checker._process  # pylint: disable=protected-access
+        assert checker.check(NC_PATH) == (True, False)
+        assert checker._process is first_process  # pylint: disable=protected-access
+    finally:
+        checker.stop()
+
+
+def test_checker_timeout_fails_check():
+    checker = CheckerProcess(timeout_secs=0.5, command=_python('import time; time.sleep(60)'))
+    assert checker.check(NC_PATH) == (False, True)
+    # It was killed, not left running.
+    assert checker._process is None  # pylint: disable=protected-access
+
+
+def test_checker_death_fails_check():
+    checker = CheckerProcess(command=_python('import sys; sys.stdin.readline()'))
+    assert checker.check(NC_PATH) == (False, True)
+
+
+def test_checker_memory_limit_passed_to_child():
+    checker = CheckerProcess(memory_limit_mb=1234, command=_python(
+        'import sys, json, os\n'
+        'for line in sys.stdin:\n'
+        '    limit = os.environ["DEA_COMPLIANCE_MEMORY_LIMIT_MB"]\n'
+        '    print(json.dumps(dict(was_success=limit == "1234", errors_occurred=False)), flush=True)\n'
+    ))
+    try:
+        assert checker.check(NC_PATH) == (True, False)
+    finally:
+        checker.stop()
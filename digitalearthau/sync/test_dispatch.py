@@ -0,0 +1,61 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import pytest
+
+from digitalearthau.filecache import FileCache, file_key
+from digitalearthau.sync.dispatch import AdaptiveDispatcher
+
+
+def _square(x):
+    return x * x
+
+
+def _cache_size(path):
+    # A cache created in the worker, as the id and validation caches are on first use.
+    path = Path(path)
+    FileCache(path.parent.joinpath('cache.db'), table='sizes').put(path, file_key(path), str(path.stat().st_size))
+    return path
+
+
+def _fail_on_seven(x):
+    if x == 7:
+        raise ValueError("seven")
+    return x
+
+
+def test_chunks_grow_for_quick_items():
+    with ThreadPool(2) as pool:
+        dispatcher = AdaptiveDispatcher(pool, workers=2, target_chunk_secs=0.5)
+        results = list(dispatcher.imap_unordered(_square, range(5000)))
+
+    assert sorted(results) == [x * x for x in range(5000)]
+    assert dispatcher.item_count == 5000
+    # Started small to measure, then grew.
+    low, high = dispatcher.chunksize_range
+    assert low == 1
+    assert high > 100
+    assert dispatcher.chunk_count < 500
+    assert 0 <= dispatcher.utilisation() <= 1
+
+
+def test_worker_error_is_raised():
+    with ThreadPool(2) as pool:
+        dispatcher = AdaptiveDispatcher(pool, workers=2, chunksize=3)
+        with pytest.raises(ValueError, match='seven'):
+            list(dispatcher.imap_unordered(_fail_on_seven, range(20)))
+
+
+def test_worker_caches_written_before_terminate(tmpdir):
+    paths = [tmpdir.join('{}.txt'.format(i)) for i in range(5)]
+    for p in paths:
+        p.write('x' * 10)
+
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        dispatcher = AdaptiveDispatcher(pool, workers=2, chunksize=2)
+        done = list(dispatcher.imap_unordered(_cache_size, [str(p) for p in paths]))
+    # (The pool is terminated on exit, so the workers never ran their exit hooks)
+
+    cache = FileCache(Path(str(tmpdir.join('cache.db'))), table='sizes')
+    assert [cache.get(p, file_key(p)) for p in sorted(done)] == ['10'] * 5
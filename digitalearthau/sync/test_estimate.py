@@ -0,0 +1,40 @@
+import random
+
+from digitalearthau.sync.estimate import stratified_sample, stratifier
+
+PATTERN = '/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml'
+
+
+def _uris(month_sizes):
+    return [
+        'file:///g/data/v10/reprocess/ls8/level1/2016/{}/LS8_{:05d}/ga-metadata.yaml'.format(month, i)
+        for month, size in month_sizes.items()
+        for i in range(size)
+    ]
+
+
+def test_sample_allocated_by_stratum_size():
+    uris = _uris({'01': 900, '02': 100, '03': 1})
+
+    samples = stratified_sample(lambda: iter(uris), stratifier([PATTERN]), sample_size=100, rng=random.Random(1))
+
+    prefix = 'file:///g/data/v10/reprocess/ls8/level1/2016/'
+    assert {name[len(prefix):]: (population, len(sampled)) for name, (population, sampled) in samples.items()} == {
+        '01': (900, 90),
+        '02': (100, 10),
+        # At least two, where there are two.
+        '03': (1, 1),
+    }
+    for name, (_, sampled) in samples.items():
+        assert len(set(sampled)) == len(sampled)
+        assert all(uri.startswith(name + '/') for uri in sampled)
+
+
+def test_too_many_strata_merged_into_parents():
+    uris = _uris({'{:02d}'.format(month): 10 for month in range(1, 13)})
+
+    samples = stratified_sample(lambda: iter(uris), stratifier([PATTERN]), sample_size=10, rng=random.Random(1))
+
+    assert list(samples) == ['file:///g/data/v10/reprocess/ls8/level1/2016']
+    assert samples['file:///g/data/v10/reprocess/ls8/level1/2016'][0] == 120
+    assert len(samples['file:///g/data/v10/reprocess/ls8/level1/2016'][1]) == 10
@@ -0,0 +1,36 @@
+import random
+from pathlib import Path
+
+from digitalearthau.sync.extsort import merge_unique_files, sorted_unique, write_lines
+
+
+def test_spilled_runs_are_merged(tmpdir):
+    tmpdir = Path(str(tmpdir))
+    uris = ['file:///g/data/{}/ga-metadata.yaml'.format(i) for i in range(1000)]
+    # Duplicated (such as a uri both in the index and on disk), and shuffled.
+    items = uris + uris[::3]
+    random.shuffle(items)
+
+    result = sorted_unique(items, spool_folder=tmpdir, run_size=64)
+
+    assert next(result) == min(uris)
+    # The runs are spilled while it's read...
+    assert len(list(tmpdir.glob('sort-runs-*/run-*.txt'))) == len(items) // 64 + 1
+    assert [min(uris)] + list(result) == sorted(uris)
+    # ... and removed afterwards.
+    assert list(tmpdir.iterdir()) == []
+
+
+def test_many_files_merged_in_groups(tmpdir):
+    tmpdir = Path(str(tmpdir))
+    files = []
+    for i in range(10):
+        path = tmpdir.joinpath('{}.txt'.format(i))
+        with path.open('w', encoding='utf-8') as f:
+            write_lines(sorted({str(n) for n in range(i, 100, i + 1)}), f)
+        files.append(path)
+
+    expected = sorted({str(n) for i in range(10) for n in range(i, 100, i + 1)})
+    assert list(merge_unique_files(files, spool_folder=tmpdir, max_files=3)) == expected
+    # The intermediate merges are removed afterwards.
+    assert sorted(p.name for p in tmpdir.iterdir()) == sorted(p.name for p in files)
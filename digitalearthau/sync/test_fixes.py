@@ -0,0 +1,191 @@
+import threading
+import time
+from types import SimpleNamespace
+from uuid import UUID
+
+import pytest
+
+from digitalearthau.index import DatasetLite
+from digitalearthau.sync import fixes
+from digitalearthau.sync.differences import LocationNotIndexed, LocationMissingOnDisk, DatasetNotIndexed
+
+DATASET_A = DatasetLite(UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2'))
+DATASET_B = DatasetLite(UUID('582e9a74-d343-42d2-9105-a248b4b04f4a'))
+
+
+class _FakeIndex:
+    """Locations of datasets, updated by the (patched) bulk update"""
+
+    def __init__(self):
+        self.locations = set()
+        self.update_calls = []
+
+    def update_locations(self, index, to_add=(), to_remove=()):
+        self.update_calls.append((list(to_add), list(to_remove)))
+        self.locations.update(to_add)
+        self.locations.difference_update(to_remove)
+        return len(to_add), len(to_remove)
+
+    def get_datasets_for_uri(self, index, uri):
+        return [DatasetLite(id_) for id_, u in self.locations if u == uri]
+
+
+def test_batched_location_updates(monkeypatch):
+    fake = _FakeIndex()
+    monkeypatch.setattr(fixes, 'update_index_locations', fake.update_locations)
+
+    mismatches = [LocationNotIndexed(DATASET_A, 'file:///tmp/{}.nc'.format(i)) for i in range(5)] + [
+        LocationMissingOnDisk(DATASET_B, 'file:///tmp/gone.nc')
+    ]
+    fixes.fix_mismatches(mismatches, None, update_locations=True, batch_size=4)
+
+    # One call per batch of four, the rest at the end.
+    assert [(len(added), len(removed)) for added, removed in fake.update_calls] == [(4, 0), (1, 1)]
+
+
+def test_batch_applied_before_trashing(monkeypatch):
+    fake = _FakeIndex()
+    trashed = []
+    monkeypatch.setattr(fixes, 'update_index_locations', fake.update_locations)
+    monkeypatch.setattr(fixes, 'get_datasets_for_uri', fake.get_datasets_for_uri)
+    monkeypatch.setattr(fixes, 'trash_uri', trashed.append)
+
+    uri = 'file:///tmp/shared.nc'
+    # The file has a dataset whose location is being added: it's not safe to trash for its other dataset.
+    mismatches = [LocationNotIndexed(DATASET_A, uri), DatasetNotIndexed(DATASET_B, uri)]
+    fixes.fix_mismatches(mismatches, None, update_locations=True, trash_missing=True, batch_size=100)
+
+    assert fake.locations == {(DATASET_A.id, uri)}
+    assert trashed == []
+
+
+def test_trash_checked_against_current_siblings(monkeypatch):
+    fake = _FakeIndex()
+    queried = []
+    trashed = []
+
+    def get_datasets_for_uri(index, uri):
+        queried.append(uri)
+        return fake.get_datasets_for_uri(index, uri)
+
+    monkeypatch.setattr(fixes, 'update_index_locations', fake.update_locations)
+    monkeypatch.setattr(fixes, 'get_datasets_for_uri', get_datasets_for_uri)
+    monkeypatch.setattr(fixes, 'trash_uri', trashed.append)
+
+    alone, shared, added = 'file:///tmp/alone.nc', 'file:///tmp/shared.nc', 'file:///tmp/added.nc'
+    indexed_since = 'file:///tmp/indexed_since.nc'
+    # Indexed (by someone else) since the scan.
+    fake.locations.add((DATASET_A.id, indexed_since))
+    mismatches = [
+        DatasetNotIndexed(DATASET_B, alone, siblings=frozenset()),
+        DatasetNotIndexed(DATASET_B, shared, siblings=frozenset([DATASET_A])),
+        # Its location is added in this run, so the scan's (empty) siblings are out of date.
+        LocationNotIndexed(DATASET_A, added, siblings=frozenset()),
+        DatasetNotIndexed(DATASET_B, added, siblings=frozenset()),
+        DatasetNotIndexed(DATASET_B, indexed_since, siblings=frozenset()),
+    ]
+    fixes.fix_mismatches(mismatches, None, update_locations=True, trash_missing=True, batch_size=100)
+
+    assert trashed == [alone]
+    # The scan's siblings ruled out the shared location without a query; the others were checked before trashing.
+    assert queried == [alone, added, indexed_since]
+
+
+def test_failed_dataset_batch_resumes(monkeypatch):
+    added = []
+    failing = ['file:///tmp/1.nc']
+
+    def add_dataset(index, dataset_id, uri, ds_resolve=None):
+        if uri in failing:
+            raise ValueError("Unreadable")
+        added.append(uri)
+
+    monkeypatch.setattr(fixes, 'Doc2Dataset', lambda index: None)
+    monkeypatch.setattr(fixes, 'add_dataset', add_dataset)
+
+    batch = fixes._FixBatch(None, batch_size=100)
+    uris = ['file:///tmp/{}.nc'.format(i) for i in range(3)]
+    for uri in uris:
+        batch.add_dataset(DatasetNotIndexed(DATASET_A, uri))
+
+    with pytest.raises(ValueError):
+        batch.flush()
+    # The applied dataset is no longer queued or pending.
+    assert added == uris[:1]
+    assert batch.pending_uris == set(uris[1:])
+
+    failing.clear()
+    batch.flush()
+    assert added == uris
+    assert batch.datasets_to_add == []
+    assert batch.pending_uris == set()
+
+
+def test_concurrent_fixes_keep_location_order(monkeypatch):
+    fake = _FakeIndex()
+    applied = []
+
+    def record_add_location(mismatch, index):
+        applied.append(mismatch)
+
+    monkeypatch.setattr(fixes, 'do_update_locations', record_add_location)
+
+    mismatches = [LocationNotIndexed(dataset, 'file:///tmp/{}.nc'.format(i))
+                  for i in range(50)
+                  for dataset in (DATASET_A, DATASET_B)]
+    fixes.fix_mismatches_concurrently(iter(mismatches), fake, workers=4, queue_size=8, update_locations=True)
+
+    assert sorted(applied, key=mismatches.index) == mismatches
+    # Fixes of each location were applied in their original order.
+    for i in range(50):
+        uri = 'file:///tmp/{}.nc'.format(i)
+        assert [m.dataset for m in applied if m.uri == uri] == [DATASET_A, DATASET_B]
+
+
+def test_concurrent_fix_failure_stops_scan():
+    def fail_pre_fix(mismatch):
+        raise ValueError("Fix failed")
+
+    consumed = []
+
+    def scan():
+        for i in range(10000):
+            consumed.append(i)
+            yield LocationNotIndexed(DATASET_A, 'file:///tmp/{}.nc'.format(i))
+
+    with pytest.raises(ValueError):
+        fixes.fix_mismatches_concurrently(scan(), None, workers=2, queue_size=4, pre_fix=fail_pre_fix)
+    assert len(consumed) < 10000
+
+
+def test_partitioned_fixes_keep_datasets_together():
+    fixing = {}
+    overlaps = []
+    lock = threading.Lock()
+
+    def add_location(dataset_id, uri):
+        with lock:
+            if fixing.get(dataset_id, threading.get_ident()) != threading.get_ident():
+                overlaps.append(dataset_id)
+            fixing[dataset_id] = threading.get_ident()
+        time.sleep(0.001)
+
+    index = SimpleNamespace(datasets=SimpleNamespace(add_location=add_location))
+    mismatches = [LocationNotIndexed(DatasetLite(UUID(int=i % 7)), 'file:///tmp/{}.nc'.format(i)) for i in range(70)]
+
+    fixed = []
+    fixes.fix_mismatches_partitioned(mismatches, index, workers=4, update_locations=True, post_fix=fixed.append)
+
+    assert overlaps == []
+    assert sorted(fixed, key=mismatches.index) == mismatches
+
+
+def test_partitions_balanced_by_size():
+    # One dataset in five locations, then five single-location datasets.
+    big = [LocationNotIndexed(DATASET_A, 'file:///tmp/a{}.nc'.format(i)) for i in range(5)]
+    small = [LocationNotIndexed(DatasetLite(UUID(int=i)), 'file:///tmp/{}.nc'.format(i)) for i in range(5)]
+
+    partitions = fixes.partition_mismatches(big + small, 2)
+
+    assert sorted(len(p) for p in partitions) == [5, 5]
+    assert big in partitions
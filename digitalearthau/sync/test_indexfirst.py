@@ -0,0 +1,51 @@
+import os
+import time
+from datetime import datetime
+from uuid import UUID
+
+from dateutil import tz
+
+from digitalearthau.collections import Collection, Trust
+from digitalearthau.index import DatasetLite
+from digitalearthau.paths import write_files
+from digitalearthau.sync import indexfirst
+
+DATASET_A = DatasetLite(UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2'))
+DATASET_B = DatasetLite(UUID('582e9a74-d343-42d2-9105-a248b4b04f4a'))
+
+
+def test_only_suspect_directories_listed(monkeypatch):
+    root = write_files({
+        # Unchanged since indexed
+        'x1': {'a.nc': '', 'unseen.nc': ''},
+        # Written to since indexed
+        'x2': {'b.nc': '', 'new.nc': ''},
+        # Nothing indexed
+        'x3': {'c.nc': ''},
+    })
+    two_hours_ago = time.time() - 7200
+    os.utime(str(root / 'x1'), (two_hours_ago, two_hours_ago))
+    indexed_at = datetime.fromtimestamp(two_hours_ago + 3600, tz=tz.tzutc())
+
+    def uri(*parts):
+        return root.joinpath(*parts).as_uri()
+
+    locations = [
+        (uri('x1', 'a.nc'), {DATASET_A}, indexed_at),
+        (uri('x1', 'gone.nc'), {DATASET_B}, indexed_at),
+        (uri('x2', 'b.nc'), {DATASET_B}, datetime.fromtimestamp(two_hours_ago, tz=tz.tzutc())),
+    ]
+    monkeypatch.setattr(indexfirst, 'iter_grouped_locations', lambda index, query, uri_prefix: iter(locations))
+    monkeypatch.setattr(indexfirst, 'iter_location_uris',
+                        lambda index, query, uri_prefix: (u for u, _, _ in locations if u.startswith(uri_prefix)))
+
+    collection = Collection('tiles', {}, [str(root) + '/x*/*.nc'], trust=Trust.INDEX)
+    items = list(indexfirst.iter_work_items(collection, 'file:///', threads=2, batch_size=2))
+
+    assert items[:3] == [
+        (uri('x1', 'a.nc'), {DATASET_A}, True),
+        (uri('x1', 'gone.nc'), {DATASET_B}, False),
+        (uri('x2', 'b.nc'), {DATASET_B}, True),
+    ]
+    # Only the unindexed files of suspect directories are listed.
+    assert sorted(items[3:]) == [uri('x2', 'new.nc'), uri('x3', 'c.nc')]
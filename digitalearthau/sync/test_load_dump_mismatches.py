@@ -1,9 +1,10 @@
+from pathlib import Path
 from uuid import UUID
 
 from digitalearthau.index import DatasetLite
 from digitalearthau.paths import write_files
 from digitalearthau.sync.differences import DatasetNotIndexed, Mismatch, ArchivedDatasetOnDisk, UnreadableDataset, \
-    mismatches_from_file
+    mismatches_from_file, ColumnarWriter, mismatch_writer
 
 
 def test_load_dump_mismatch():
@@ -20,7 +21,7 @@ def test_load_dump_mismatch():
 
     deserialised_mismatch = Mismatch.from_dict(row)
     assert deserialised_mismatch == mismatch
-    assert deserialised_mismatch.__dict__ == mismatch.__dict__
+    assert (deserialised_mismatch.dataset, deserialised_mismatch.uri) == (mismatch.dataset, mismatch.uri)
 
 
 def test_load_from_file():
@@ -45,3 +46,21 @@ def test_load_from_file():
             'file:///g/data/fk4/datacube/002/LS5_TM_FC/0_-30/LS5_TM_FC_3577_0_-30_20080331005819500000.nc'
         )
     ]
+
+
+def test_columnar_report(tmpdir):
+    path = Path(str(tmpdir)).joinpath('mismatches.npz')
+    mismatches = [
+        DatasetNotIndexed(DatasetLite(UUID(int=i)), 'file:///g/data/test/{}/ga-metadata.yaml'.format(i % 3))
+        for i in range(1, 10)
+    ] + [UnreadableDataset(None, 'file:///g/data/test/unreadable.yaml')]
+
+    with ColumnarWriter(path, block_size=4) as writer:
+        for mismatch in mismatches[:6]:
+            writer.write(mismatch)
+    # A resumed run adds to it.
+    with mismatch_writer(path, append=True) as writer:
+        for mismatch in mismatches[6:]:
+            writer.write(mismatch)
+
+    assert list(mismatches_from_file(path)) == mismatches
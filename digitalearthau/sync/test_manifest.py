@@ -0,0 +1,140 @@
+import os
+from pathlib import Path
+from uuid import UUID
+
+from digitalearthau.collections import ValidationLevel
+from digitalearthau.index import DatasetLite, IndexSnapshot
+from digitalearthau.paths import write_files
+from digitalearthau.sync import scan
+from digitalearthau.sync.differences import DatasetNotIndexed, LocationNotIndexed, UnreadableDataset
+from digitalearthau.sync.manifest import Manifest, ManifestEntry, ManifestWriter, PathState
+
+# pylint: disable=protected-access
+
+DATASET_ID = UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2')
+
+
+def test_write_read_manifest():
+    manifest_path = write_files({}).joinpath('manifest.db')
+    uri = 'file:///g/data/fk4/datacube/002/LS5_TM_FC/-17_-31/LS5_TM_FC_3577_-17_-31_19920722013931500000.nc'
+    entry = ManifestEntry(
+        uri=uri,
+        path_state=PathState(size=1024, mtime_ns=1507582964903360000, inode=42),
+        index_state='',
+        dataset_ids=(DATASET_ID,),
+        mismatches=(DatasetNotIndexed(DatasetLite(DATASET_ID), uri),),
+    )
+    missing_entry = ManifestEntry('file:///tmp/missing.nc', None, '', (), ())
+
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(entry)
+        writer.add(missing_entry)
+
+    manifest = Manifest(manifest_path)
+    assert manifest.get(uri) == entry
+    assert manifest.get('file:///tmp/missing.nc') == missing_entry
+    assert manifest.get('file:///tmp/unknown.nc') is None
+
+
+def test_failed_write_keeps_old_manifest():
+    manifest_path = write_files({}).joinpath('manifest.db')
+    old_entry = ManifestEntry('file:///tmp/old.nc', None, '', (), ())
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(old_entry)
+
+    try:
+        with ManifestWriter(manifest_path) as writer:
+            writer.add(ManifestEntry('file:///tmp/new.nc', None, '', (), ()))
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+
+    manifest = Manifest(manifest_path)
+    assert manifest.get('file:///tmp/old.nc') == old_entry
+    assert manifest.get('file:///tmp/new.nc') is None
+
+
+def test_previous_entries_copied():
+    manifest_path = write_files({}).joinpath('manifest.db')
+    old_skipped = ManifestEntry('file:///tmp/skipped.nc', None, 'old', (), ())
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(old_skipped)
+        writer.add(ManifestEntry('file:///tmp/rescanned.nc', None, 'old', (), ()))
+        writer.add(ManifestEntry('file:///tmp/other.nc', None, 'old', (), ()))
+
+    new_rescanned = ManifestEntry('file:///tmp/rescanned.nc', None, 'new', (), ())
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(new_rescanned)
+        writer.copy_previous(Manifest(manifest_path), ['file:///tmp/skipped.nc', 'file:///tmp/rescanned.nc'])
+
+    manifest = Manifest(manifest_path)
+    assert manifest.get('file:///tmp/skipped.nc') == old_skipped
+    # Newer entries are kept.
+    assert manifest.get('file:///tmp/rescanned.nc') == new_rescanned
+    assert manifest.get('file:///tmp/other.nc') is None
+
+
+def test_unchanged_path_is_not_reread(monkeypatch):
+    # Nothing indexed outside of the snapshot either.
+    monkeypatch.setattr(scan, 'get_dataset', lambda index, id_: None)
+    d = write_files({'ga-metadata.yaml': 'id: {}\n'.format(DATASET_ID)})
+    metadata_path = d.joinpath('ga-metadata.yaml')
+    uri = metadata_path.as_uri()
+    manifest_path = d.joinpath('manifest.db')
+    snapshot = IndexSnapshot({}, {})
+
+    def scan_uri():
+        return scan._find_uri_mismatches_incremental(None, uri, Manifest(manifest_path),
+                                                     validation_level=ValidationLevel.NONE, snapshot=snapshot)
+
+    entry, was_unchanged = scan_uri()
+    assert not was_unchanged
+    assert entry.dataset_ids == (DATASET_ID,)
+    assert entry.mismatches == (DatasetNotIndexed(DatasetLite(DATASET_ID), uri),)
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(entry)
+
+    # Unchanged: the previous result is reused.
+    assert scan_uri() == (entry, True)
+
+    # Corrupt the file, but keep the same size & times: it isn't read again.
+    st = metadata_path.stat()
+    _overwrite(metadata_path, 'x' * st.st_size)
+    os.utime(str(metadata_path), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert scan_uri() == (entry, True)
+
+    # Any modification time change will be noticed.
+    os.utime(str(metadata_path), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    entry, was_unchanged = scan_uri()
+    assert not was_unchanged
+    assert entry.mismatches == (UnreadableDataset(None, uri),)
+
+
+def test_dataset_indexed_elsewhere_is_rescanned(monkeypatch):
+    indexed_elsewhere = {}
+    monkeypatch.setattr(scan, 'get_dataset', lambda index, id_: indexed_elsewhere.get(id_))
+    d = write_files({'ga-metadata.yaml': 'id: {}\n'.format(DATASET_ID)})
+    uri = d.joinpath('ga-metadata.yaml').as_uri()
+    manifest_path = d.joinpath('manifest.db')
+
+    def scan_uri():
+        return scan._find_uri_mismatches_incremental(None, uri, Manifest(manifest_path),
+                                                     validation_level=ValidationLevel.NONE,
+                                                     snapshot=IndexSnapshot({}, {}))
+
+    entry, _ = scan_uri()
+    with ManifestWriter(manifest_path) as writer:
+        writer.add(entry)
+    assert scan_uri() == (entry, True)
+
+    # Indexed at another location since: the previous verdict (not indexed) no longer holds.
+    indexed_elsewhere[DATASET_ID] = DatasetLite(DATASET_ID)
+    entry, was_unchanged = scan_uri()
+    assert not was_unchanged
+    assert entry.mismatches == (LocationNotIndexed(DatasetLite(DATASET_ID), uri),)
+
+
+def _overwrite(path: Path, text: str):
+    # Write in-place, keeping the same inode.
+    with path.open('r+') as f:
+        f.write(text)
@@ -0,0 +1,46 @@
+from datetime import datetime
+from pathlib import Path
+
+from dateutil import tz
+
+from digitalearthau.collections import Collection
+from digitalearthau.paths import write_files
+from digitalearthau.sync import pathsets
+
+# pylint: disable=protected-access
+
+
+def test_only_changed_pieces_rebuilt(tmpdir, monkeypatch):
+    root = write_files({
+        '2016': {'LS8_A': {'ga-metadata.yaml': ''}},
+        '2017': {'LS8_B': {'ga-metadata.yaml': ''}},
+    })
+    collection = Collection('c', {}, [str(root) + '/[0-9]*/LS*/ga-metadata.yaml'])
+    indexed_uri = root.joinpath('2016', 'LS8_INDEXED', 'ga-metadata.yaml').as_uri()
+    index_locations = []
+
+    monkeypatch.setattr(pathsets, 'iter_location_uris',
+                        lambda index, query, uri_prefix: (u for u, _ in index_locations if u.startswith(uri_prefix)))
+    monkeypatch.setattr(pathsets, 'iter_locations_added_since',
+                        lambda index, query, since, uri_prefix: iter(index_locations))
+    monkeypatch.setattr(Collection, 'iter_index_uris', lambda self, uri_prefix=None: iter([]))
+
+    def build():
+        cache = pathsets.PathsetCache(collection, Path(str(tmpdir)))
+        checked = cache.check()
+        stale = sorted(name.split('-')[0] for name in checked.stale)
+        path_set = cache.build(checked=checked)
+        return stale, sorted(uri[len(root.as_uri()):] for uri in path_set.keys())
+
+    assert build() == (['2016', '2017', 'rest'], ['/2016/LS8_A/ga-metadata.yaml', '/2017/LS8_B/ga-metadata.yaml'])
+    assert build()[0] == []
+
+    write_files({'LS8_C': {'ga-metadata.yaml': ''}}, containing_dir=root.joinpath('2017'))
+    stale, uris = build()
+    assert stale == ['2017']
+    assert '/2017/LS8_C/ga-metadata.yaml' in uris
+
+    index_locations.append((indexed_uri, datetime.now(tz=tz.tzutc())))
+    stale, uris = build()
+    assert stale == ['2016']
+    assert '/2016/LS8_INDEXED/ga-metadata.yaml' in uris
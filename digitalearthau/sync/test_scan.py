@@ -0,0 +1,176 @@
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from uuid import UUID
+
+from digitalearthau.collections import Collection, ValidationLevel
+
+from digitalearthau.index import DatasetLite, IndexSnapshot
+from digitalearthau.paths import write_files
+from digitalearthau.sync import scan
+from digitalearthau.sync.differences import DatasetNotIndexed, LocationNotIndexed, LocationMissingOnDisk, \
+    ArchivedDatasetOnDisk, UnreadableDataset
+from digitalearthau.sync.pipeline import StageSizes
+
+# pylint: disable=protected-access
+
+ON_DISK_ID = UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2')
+OTHER_ID = UUID('582e9a74-d343-42d2-9105-a248b4b04f4a')
+
+
+def _dataset_uri():
+    root = write_files({
+        'LS8_SOME_SCENE': {
+            'ga-metadata.yaml': 'id: {}\n'.format(ON_DISK_ID),
+        }
+    })
+    return root.joinpath('LS8_SOME_SCENE', 'ga-metadata.yaml').as_uri()
+
+
+class _Datasets:
+    """
+    The dataset lookups of an index (of datasets outside of a snapshot).
+    """
+
+    def __init__(self, datasets=()):
+        self._datasets = {d.id: d for d in datasets}
+
+    def get(self, id_):
+        return self._datasets.get(id_)
+
+
+class _Index:
+    def __init__(self, datasets=()):
+        self.datasets = _Datasets(datasets)
+
+    def close(self):
+        pass
+
+
+def _mismatches(uri, snapshot, index=None):
+    return set(scan._find_uri_mismatches(index or _Index(), uri, validation_level=ValidationLevel.NONE,
+                                         snapshot=snapshot))
+
+
+def test_snapshot_dataset_not_indexed():
+    uri = _dataset_uri()
+    assert _mismatches(uri, IndexSnapshot({}, {})) == {
+        DatasetNotIndexed(DatasetLite(ON_DISK_ID), uri)
+    }
+
+
+def test_snapshot_location_not_indexed():
+    uri = _dataset_uri()
+    on_disk = DatasetLite(ON_DISK_ID)
+    assert _mismatches(uri, IndexSnapshot({}, {ON_DISK_ID: on_disk})) == {
+        LocationNotIndexed(on_disk, uri)
+    }
+
+
+def test_snapshot_location_not_indexed_for_other_product():
+    uri = _dataset_uri()
+    # Indexed, but as a product outside of the snapshot's collection.
+    on_disk = DatasetLite(ON_DISK_ID)
+    assert _mismatches(uri, IndexSnapshot({}, {}), index=_Index([on_disk])) == {
+        LocationNotIndexed(on_disk, uri)
+    }
+
+
+def test_snapshot_replaced_on_disk():
+    uri = _dataset_uri()
+    other = DatasetLite(OTHER_ID)
+    snapshot = IndexSnapshot({uri: {other}}, {OTHER_ID: other})
+    assert _mismatches(uri, snapshot) == {
+        LocationMissingOnDisk(other, uri),
+        DatasetNotIndexed(DatasetLite(ON_DISK_ID), uri),
+    }
+
+
+def test_snapshot_archived_on_disk():
+    uri = _dataset_uri()
+    archived = DatasetLite(ON_DISK_ID, archived_time=datetime(2017, 1, 1))
+    snapshot = IndexSnapshot({uri: {archived}}, {ON_DISK_ID: archived})
+    assert _mismatches(uri, snapshot) == {
+        ArchivedDatasetOnDisk(archived, uri)
+    }
+
+
+def test_merged_location_missing_on_disk():
+    uri = _dataset_uri().replace('LS8_SOME_SCENE', 'LS8_MISSING_SCENE')
+    other = DatasetLite(OTHER_ID)
+    # Not found on disk: no index lookups needed.
+    assert scan._find_merged_uri_mismatches_eager((uri, {other}, False)) == [
+        LocationMissingOnDisk(other, uri)
+    ]
+
+
+def test_shared_crawl_routes_paths_to_collections(tmpdir):
+    root = write_files({
+        '2016': {
+            'nbar': {'LS8_A': {'ga-metadata.yaml': ''}},
+            'nbart': {'LS8_A': {'ga-metadata.yaml': ''}, 'LS8_B': {'ga-metadata.yaml': ''}},
+        }
+    })
+    nbar = Collection('nbar', {}, [str(root) + '/[0-9]*/nbar/LS*/ga-metadata.yaml'])
+    nbart = Collection('nbart', {}, [str(root) + '/[0-9]*/nbart/LS*/ga-metadata.yaml'])
+    nbart_b = root.joinpath('2016', 'nbart', 'LS8_B').as_uri()
+
+    spool_files = scan.spool_fs_uris([(nbar, scan.ROOT_URI), (nbart, scan.ROOT_URI), (nbart, nbart_b)],
+                                     Path(str(tmpdir)))
+
+    def spooled(key):
+        return sorted(uri[len(root.as_uri()):] for uri in scan.read_spool(spool_files[key]))
+
+    assert spooled((nbar, scan.ROOT_URI)) == ['/2016/nbar/LS8_A/ga-metadata.yaml']
+    assert spooled((nbart, scan.ROOT_URI)) == ['/2016/nbart/LS8_A/ga-metadata.yaml',
+                                               '/2016/nbart/LS8_B/ga-metadata.yaml']
+    assert spooled((nbart, nbart_b)) == ['/2016/nbart/LS8_B/ga-metadata.yaml']
+
+
+def test_staged_scan(monkeypatch):
+    monkeypatch.setattr(scan, '_LazyIndex', lambda index_url, connection_counter: _Index())
+    root = write_files({
+        'LS8_SOME_SCENE': {'ga-metadata.yaml': 'id: {}\n'.format(ON_DISK_ID)},
+        'LS8_BROKEN_SCENE': {'ga-metadata.yaml': 'lineage: {}\n'},
+    })
+    scene_uri = root.joinpath('LS8_SOME_SCENE', 'ga-metadata.yaml').as_uri()
+    broken_uri = root.joinpath('LS8_BROKEN_SCENE', 'ga-metadata.yaml').as_uri()
+    gone_uri = root.joinpath('LS8_GONE_SCENE', 'ga-metadata.yaml').as_uri()
+
+    other = DatasetLite(OTHER_ID)
+    snapshot = IndexSnapshot({gone_uri: {other}, broken_uri: {other}}, {OTHER_ID: other})
+
+    results = dict(scan._staged_mismatches([scene_uri, broken_uri, gone_uri], None, snapshot, ValidationLevel.NONE,
+                                           StageSizes(read_threads=2, validate_processes=1, index_connections=1),
+                                           multiprocessing.Value('i', 0), scan._LOG))
+    assert results == {
+        scene_uri: [DatasetNotIndexed(DatasetLite(ON_DISK_ID), scene_uri)],
+        broken_uri: [UnreadableDataset(None, broken_uri)],
+        gone_uri: [LocationMissingOnDisk(other, gone_uri)],
+    }
+    # As in the default path, the datasets indexed at the uri are attached for the fixes.
+    assert results[broken_uri][0].siblings == frozenset([other])
+
+
+def test_next_collection_prepared_during_scan(monkeypatch):
+    events = []
+
+    def prepare(collection, cache_folder, **kwargs):
+        events.append(('prepare', collection.name))
+        return scan._PreparedScan(None, [collection.name], None, ValidationLevel.NONE, None, None, None, 0.0)
+
+    def run_scan(collection, prepared, on_started=None, **kwargs):
+        events.append(('start', collection.name))
+        on_started()
+        yield from prepared.work_items
+        return dict(uri_count=1, mismatch_count=1)
+
+    monkeypatch.setattr(scan, '_prepare_scan', prepare)
+    monkeypatch.setattr(scan, '_run_scan', run_scan)
+
+    collections = [(Collection(name, {}, []), scan.ROOT_URI) for name in 'abc']
+    assert list(scan.mismatches_for_collections(collections, None)) == ['a', 'b', 'c']
+
+    # Each collection is prepared once the previous one's workers have started (forked).
+    for this, next_ in ('ab', 'bc'):
+        assert events.index(('start', this)) < events.index(('prepare', next_)) < events.index(('start', next_))
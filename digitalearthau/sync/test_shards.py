@@ -0,0 +1,43 @@
+import io
+from pathlib import Path
+from uuid import UUID
+
+from digitalearthau.index import DatasetLite
+from digitalearthau.sync.differences import LocationMissingOnDisk, DatasetNotIndexed, mismatches_from_file, \
+    mismatch_line
+from digitalearthau.sync.shards import Shard, merge_mismatch_files, _StreamWriter
+
+DATASET_A = DatasetLite(UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2'))
+
+
+def test_shards_partition_uris():
+    uris = ['file:///g/data/test/{}/ga-metadata.yaml'.format(i) for i in range(1000)]
+    shards = [Shard(i, 4) for i in range(4)]
+
+    per_shard = [[uri for uri in uris if shard.contains(uri)] for shard in shards]
+
+    # Every uri in exactly one shard, and roughly balanced.
+    assert sorted(sum(per_shard, [])) == sorted(uris)
+    assert all(150 < len(s) < 350 for s in per_shard)
+
+
+def test_merge_shard_outputs(tmpdir):
+    tmpdir = Path(str(tmpdir))
+    mismatches = [
+        LocationMissingOnDisk(DATASET_A, 'file:///tmp/b.nc'),
+        DatasetNotIndexed(DATASET_A, 'file:///tmp/a.nc'),
+        DatasetNotIndexed(None, 'file:///tmp/c.nc'),
+    ]
+    shard_0 = tmpdir.joinpath('0.jsonl')
+    shard_0.write_text(mismatch_line(mismatches[0]) + mismatch_line(mismatches[1]))
+    # Resumed: it repeats a mismatch
+    shard_1 = tmpdir.joinpath('1.jsonl')
+    shard_1.write_text(mismatch_line(mismatches[2]) + mismatch_line(mismatches[2]))
+
+    out = io.StringIO()
+    counts = merge_mismatch_files([shard_0, shard_1], _StreamWriter(out))
+
+    assert counts == {'DatasetNotIndexed': 2, 'LocationMissingOnDisk': 1}
+    merged = tmpdir.joinpath('merged.jsonl')
+    merged.write_text(out.getvalue())
+    assert list(mismatches_from_file(merged)) == [mismatches[1], mismatches[0], mismatches[2]]
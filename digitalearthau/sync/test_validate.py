@@ -0,0 +1,112 @@
+import time
+from pathlib import Path
+
+import structlog
+
+from digitalearthau.collections import ValidationLevel
+from digitalearthau.filecache import FileCache
+from digitalearthau.paths import write_files
+from digitalearthau.sync import validate
+
+# pylint: disable=protected-access
+
+
+def test_passed_files_not_revalidated(tmpdir, monkeypatch):
+    monkeypatch.setattr(validate, '_CACHE', FileCache(Path(str(tmpdir)).joinpath('validation.db'),
+                                                      table='passed_validation'))
+    checked = []
+
+    def fake_validate_files(files, log, level):
+        checked.extend((file.name, level) for file in files)
+        return True
+
+    monkeypatch.setattr(validate, '_validate_files', fake_validate_files)
+    dataset = write_files({'LS8_TILE.nc': 'not really a netcdf'}).joinpath('LS8_TILE.nc')
+    log = structlog.get_logger()
+
+    assert validate.validate_dataset(dataset, log, level=ValidationLevel.STATISTICS)
+    # Already passed at a higher level.
+    assert validate.validate_dataset(dataset, log, level=ValidationLevel.SAMPLE)
+    assert checked == [('LS8_TILE.nc', ValidationLevel.STATISTICS)]
+
+    # A higher level needs checking again.
+    assert validate.validate_dataset(dataset, log, level=ValidationLevel.COMPLIANCE)
+    assert checked[-1] == ('LS8_TILE.nc', ValidationLevel.COMPLIANCE)
+
+    # As does a modified file.
+    dataset.write_text('a modified netcdf')
+    assert validate.validate_dataset(dataset, log, level=ValidationLevel.SAMPLE)
+    assert checked[-1] == ('LS8_TILE.nc', ValidationLevel.SAMPLE)
+
+
+def test_band_failure_cancels_remaining_checks(monkeypatch):
+    checked = []
+
+    def fake_check_band(band, level):
+        checked.append(band)
+        if band == ('band_0', 1):
+            raise ValueError("Unreadable block")
+        time.sleep(0.05)
+
+    monkeypatch.setattr(validate, '_check_band', fake_check_band)
+    bands = [(Path('/tmp/LS8_TILE.nc'), ('band_{}'.format(i), 1)) for i in range(20)]
+
+    assert not validate._check_bands(bands, structlog.get_logger(), ValidationLevel.STATISTICS, threads=2)
+    assert ('band_0', 1) in checked
+    assert len(checked) < len(bands)
+
+
+class _FakeDriver:
+    def __init__(self, short_name):
+        self.ShortName = short_name
+
+
+class _FakeStorageUnit:
+    def __init__(self, driver, subdatasets, raster_count):
+        self._driver = _FakeDriver(driver)
+        self._subdatasets = subdatasets
+        self.RasterCount = raster_count
+
+    def GetDriver(self):
+        return self._driver
+
+    def GetSubDatasets(self):
+        return self._subdatasets
+
+
+def test_bands_of_files_without_subdatasets_checked(monkeypatch):
+    opened = {
+        '/tmp/LS8_TILE.nc': _FakeStorageUnit('netCDF', [('NETCDF:"/tmp/LS8_TILE.nc":blue', ''),
+                                              ('NETCDF:"/tmp/LS8_TILE.nc":dataset', '')], 1),
+        '/tmp/LS8_SCENE_B1.tif': _FakeStorageUnit('GTiff', [], 2),
+    }
+    monkeypatch.setattr(validate.gdal, 'Open', lambda name, access: opened[name])
+    log = structlog.get_logger()
+
+    assert validate._open_file(Path('/tmp/LS8_TILE.nc'), log, ValidationLevel.SAMPLE) == ('netCDF', [
+        ('NETCDF:"/tmp/LS8_TILE.nc":blue', 1)
+    ])
+    # A plain GeoTIFF's own bands.
+    assert validate._open_file(Path('/tmp/LS8_SCENE_B1.tif'), log, ValidationLevel.SAMPLE) == ('GTiff', [
+        ('/tmp/LS8_SCENE_B1.tif', 1),
+        ('/tmp/LS8_SCENE_B1.tif', 2),
+    ])
+
+
+def test_bands_only_threaded_for_thread_safe_drivers(monkeypatch):
+    drivers = {'LS8_TILE.nc': 'netCDF', 'LS8_SCENE_B1.tif': 'GTiff', 'LS8_SCENE_B2.tif': 'GTiff'}
+    monkeypatch.setattr(validate, '_open_file',
+                        lambda file, log, level: (drivers[file.name], [(str(file), 1), (str(file), 2)]))
+    used_threads = []
+    monkeypatch.setattr(validate, '_check_bands',
+                        lambda bands, log, level, threads: used_threads.append(threads) or True)
+    log = structlog.get_logger()
+
+    def threads_used(*names):
+        assert validate._validate_files([Path('/tmp', name) for name in names], log, ValidationLevel.SAMPLE,
+                                        threads=4)
+        return used_threads.pop()
+
+    assert threads_used('LS8_SCENE_B1.tif', 'LS8_SCENE_B2.tif') == 4
+    assert threads_used('LS8_TILE.nc') == 1
+    assert threads_used('LS8_TILE.nc', 'LS8_SCENE_B1.tif') == 1
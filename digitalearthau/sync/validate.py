@@ -1,81 +1,248 @@
+"""
+Check that the data files of datasets are readable.
+
+Checks range in thoroughness (see :class:`ValidationLevel`): from just opening the files, to reading every
+pixel. Files that pass can be remembered (keyed on their size, mtime and inode), so that unchanged files
+aren't checked again at the same level. The cache is off unless a path is set: dea-sync keeps it in its cache folder.
+"""
 import logging
 import os
-import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 from osgeo import gdal
-from compliance_checker.runner import ComplianceChecker, CheckSuite
 
 from digitalearthau import paths
+from digitalearthau.collections import ValidationLevel
+from digitalearthau.filecache import FileCache, file_key
+from digitalearthau.sync import compliance
 
 # prevent aux.xml write
 os.environ["GDAL_PAM_ENABLED"] = "NO"
 
-# The 'load' method actually loads it globally, not on the specific instance.
-CHECK_SUITE = CheckSuite()
-CHECK_SUITE.load_all_available_checkers()
+# Number of bands to check at once (when their files' drivers allow it).
+BAND_THREADS = int(os.environ.get('DEA_VALIDATE_THREADS') or 4)
+
+# GDAL drivers that can read from separate threads at once. (Others, such as netCDF, serialise all access
+# behind a global lock, so threads would only contend for it)
+THREAD_SAFE_DRIVERS = ('GTiff',)
+
+# A band to check: the name GDAL opens (a file, or a subdataset of one), and its band number.
+Band = Tuple[str, int]
+
+# Location of the cache of passed validations, if any. (Empty: no caching)
+CACHE_PATH = os.environ.get('DEA_VALIDATION_CACHE', '')
+
+_CACHE = None  # type: FileCache
+
+
+def set_cache_path(path: Optional[Path]):
+    """
+    Change where passed validations are cached (eg. to a sync cache folder). None disables the cache.
+    """
+    global CACHE_PATH, _CACHE  # pylint: disable=global-statement
+    if _CACHE is not None:
+        _CACHE.flush()
+    CACHE_PATH = str(path) if path else ''
+    _CACHE = None
 
 
-def validate_dataset(md_path: Path, log: logging.Logger):
+def _get_cache() -> Optional[FileCache]:
+    global _CACHE  # pylint: disable=global-statement
+    if _CACHE is None and CACHE_PATH:
+        _CACHE = FileCache(Path(CACHE_PATH), table='passed_validation')
+    return _CACHE
+
+
+def _cached_level(cached_value: Optional[str]) -> ValidationLevel:
+    """
+    The level a file previously passed at, according to the cache.
+
+    >>> _cached_level('SAMPLE')
+    <ValidationLevel.SAMPLE: 2>
+    >>> _cached_level(None)
+    <ValidationLevel.NONE: 0>
+    """
+    if cached_value is None:
+        return ValidationLevel.NONE
+    return ValidationLevel[cached_value]
+
+
+def validate_dataset(md_path: Path, log: logging.Logger, level: ValidationLevel = ValidationLevel.STATISTICS):
+    """
+    Check the data files of the dataset, to the given level of thoroughness.
+
+    Files that already passed at the same level or higher (and haven't changed since) are not checked again.
+    """
+    if level == ValidationLevel.NONE:
+        return True
+
     base_path, all_files = paths.get_dataset_paths(md_path)
+    cache = _get_cache()
 
+    to_check = []
     for file in all_files:
         if file.suffix.lower() in ('.nc', '.tif'):
-            if not validate_image(file, log):
-                return False
+            file = file.absolute()
+            # Taken before checking, so that changes made during the check will invalidate the entry.
+            key = file_key(file) if cache else None
+            if key is not None and _cached_level(cache.get(file, key)) >= level:
+                log.debug("validate.cached", path=file, level=level.name)
+                continue
+            to_check.append((file, key))
+
+    if not _validate_files([file for file, _ in to_check], log, level):
+        return False
+
+    for file, key in to_check:
+        if key is not None:
+            cache.put(file, key, level.name)
     return True
 
 
-def validate_image(file: Path, log: logging.Logger, compliance_check=False):
+def validate_image(file: Path,
+                   log: logging.Logger,
+                   compliance_check=False,
+                   level: ValidationLevel = ValidationLevel.STATISTICS,
+                   threads: int = BAND_THREADS):
+    if compliance_check:
+        level = max(level, ValidationLevel.COMPLIANCE)
+    return _validate_files([file], log, level, threads=threads)
+
+
+def _validate_files(files: List[Path],
+                    log: logging.Logger,
+                    level: ValidationLevel,
+                    threads: int = BAND_THREADS) -> bool:
+    """
+    Check the given files, with the bands of all of them checked concurrently if their drivers allow it.
+    """
+    bands = []
+    thread_safe = True
+    for file in files:
+        opened = _open_file(file, log, level)
+        if opened is None:
+            return False
+        driver, file_bands = opened
+        thread_safe = thread_safe and driver in THREAD_SAFE_DRIVERS
+        bands.extend((file, band) for band in file_bands)
+
+    return _check_bands(bands, log, level, threads if thread_safe else 1)
+
+
+def _open_file(file: Path, log: logging.Logger, level: ValidationLevel) -> Optional[Tuple[str, List[Band]]]:
+    """
+    Open the file (and check its compliance, if asked), returning its driver name and the bands to check.
+
+    Those of a NetCDF are its subdatasets (other than the dataset documents); a plain GeoTIFF has no subdatasets,
+    so its own bands are checked.
+
+    Returns None if it fails.
+    """
     try:
         storage_unit = gdal.Open(str(file), gdal.gdalconst.GA_ReadOnly)
+        if storage_unit is None:
+            raise ValueError("Unable to open file", gdal.GetLastErrorMsg())
 
-        if compliance_check and storage_unit.GetDriver().ShortName == 'netCDF':
-            is_compliant, errors_occurred = _compliance_check(file)
+        driver = storage_unit.GetDriver().ShortName
+        if level >= ValidationLevel.COMPLIANCE and driver == 'netCDF':
+            is_compliant, errors_occurred = compliance.check_compliance(file)
 
             if (not is_compliant) or errors_occurred:
                 log.info("validate.compliance.fail", path=file)
-                return False
+                return None
 
-        for subdataset in storage_unit.GetSubDatasets():
-            if 'dataset' not in subdataset[0]:
-                band = gdal.Open(subdataset[0], gdal.gdalconst.GA_ReadOnly)
-                try:
-                    band.GetRasterBand(1).GetStatistics(0, 1)
-                    log.info("validate.band.pass", path=file)
-                except ValueError as v:
-                    # Only show stack trace at debug-level logging. We get the message at info.
-                    log.debug("validate.band.exception", exc_info=True)
-                    log.info("validate.band.fail", path=file, error_args=v.args)
-                    return False
+        subdatasets = storage_unit.GetSubDatasets()
+        if not subdatasets:
+            return driver, [(str(file), band_number) for band_number in range(1, storage_unit.RasterCount + 1)]
+        return driver, [(name, 1) for name, _ in subdatasets if 'dataset' not in name]
     except ValueError as v:
         # Only show stack trace at debug-level logging. We get the message at info.
         log.debug("validate.band.exception", exc_info=True)
         log.info("validate.open.fail", path=file, error_args=v.args)
-        return False
+        return None
 
-    return True
 
+def _check_bands(bands: List[Tuple[Path, Band]], log: logging.Logger, level: ValidationLevel, threads: int) -> bool:
+    """
+    Check the given (file, band) bands on a pool of threads (GDAL releases the GIL while reading).
 
-def _compliance_check(nc_path: Path, results_path: Path = None):
+    The first failure cancels the checks that haven't started yet.
     """
-    Run cf and adcc checks with normal strictness, verbose text format to stdout
+    failed = threading.Event()
+
+    def check(file: Path, band: Band) -> Optional[bool]:
+        if failed.is_set():
+            return None
+
+        start_time = time.time()
+        try:
+            _check_band(band, level)
+        except ValueError as v:
+            failed.set()
+            # Only show stack trace at debug-level logging. We get the message at info.
+            log.debug("validate.band.exception", exc_info=True)
+            log.info("validate.band.fail", path=file, band=band, error_args=v.args,
+                     secs=round(time.time() - start_time, 3))
+            return False
+
+        log.info("validate.band.pass", path=file, band=band, level=level.name,
+                 secs=round(time.time() - start_time, 3))
+        return True
+
+    if threads <= 1 or len(bands) <= 1:
+        return all(check(file, band) for file, band in bands)
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(bands))) as executor:
+        futures = [executor.submit(check, file, band) for file, band in bands]
+        for future in as_completed(futures):
+            if future.result() is False:
+                for f in futures:
+                    f.cancel()
+                return False
+    return True
+
+
+def _check_band(band: Band, level: ValidationLevel):
     """
-    # Specify a tempfile as a sink, as otherwise it will spew results into stdout.
-    out_file = str(results_path) if results_path else tempfile.mktemp(prefix='compliance-log-')
+    Check a band of a file (or subdataset)
 
-    try:
-        was_success, errors_occurred = ComplianceChecker.run_checker(
-            ds_loc=str(nc_path),
-            checker_names=['cf'],
-            verbose=0,
-            criteria='lenient',
-            skip_checks=['check_dimension_order'],
-            output_filename=out_file,
-            output_format='text'
-        )
-    finally:
-        if not results_path and os.path.exists(out_file):
-            os.remove(out_file)
-
-    return was_success, errors_occurred
+    :raises ValueError: if it couldn't be read.
+    """
+    name, band_number = band
+    dataset = gdal.Open(name, gdal.gdalconst.GA_ReadOnly)
+    if dataset is None:
+        raise ValueError("Unable to open band", name, gdal.GetLastErrorMsg())
+    raster_band = dataset.GetRasterBand(band_number)
+    if raster_band is None:
+        raise ValueError("Unable to open band", name, band_number, gdal.GetLastErrorMsg())
+
+    if level >= ValidationLevel.STATISTICS:
+        # Reads every pixel.
+        raster_band.GetStatistics(0, 1)
+    elif level >= ValidationLevel.SAMPLE:
+        _read_sample(raster_band, name)
+
+
+def _read_sample(raster_band, name: str):
+    """
+    Read a small part of a band: its smallest overview if it has any, otherwise its first and last blocks.
+    """
+    overview_count = raster_band.GetOverviewCount()
+    if overview_count:
+        overview = raster_band.GetOverview(overview_count - 1)
+        windows = [(overview, 0, 0, overview.XSize, overview.YSize)]
+    else:
+        block_x, block_y = raster_band.GetBlockSize()
+        width, height = min(block_x, raster_band.XSize), min(block_y, raster_band.YSize)
+        windows = [
+            (raster_band, 0, 0, width, height),
+            (raster_band, raster_band.XSize - width, raster_band.YSize - height, width, height),
+        ]
+
+    for band, x_off, y_off, width, height in windows:
+        if band.ReadRaster(x_off, y_off, width, height) is None:
+            raise ValueError("Unable to read band sample", name, gdal.GetLastErrorMsg())
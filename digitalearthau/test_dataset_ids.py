@@ -0,0 +1,56 @@
+import os
+import uuid
+from pathlib import Path
+
+from digitalearthau import dataset_ids
+from digitalearthau.filecache import FileCache
+from digitalearthau.paths import write_files
+
+# pylint: disable=protected-access
+
+FIRST_ID = uuid.UUID('c98c3f2e-add7-4b34-9c9f-2cb8c7f806d2')
+SECOND_ID = uuid.UUID('582e9a74-d343-42d2-9105-a248b4b04f4a')
+
+LINEAGE_DOC = """
+product_type: nbar
+lineage:
+  source_datasets:
+    level1:
+      id: 00000000-0000-0000-0000-000000000001
+      lineage: {{source_datasets: {{}}}}
+id: {}
+"""
+
+
+def test_scan_matches_full_parse():
+    d = write_files({
+        'ga-metadata.yaml': LINEAGE_DOC.format(FIRST_ID) + '---\n' + LINEAGE_DOC.format(SECOND_ID),
+        'anchored.yaml': 'other: &the_id {}\nid: *the_id\n'.format(FIRST_ID),
+        'ga-metadata.json': '{{"lineage": {{"source_datasets": {{}}}}, "id": "{}"}}'.format(FIRST_ID),
+    })
+    for name in ('ga-metadata.yaml', 'anchored.yaml', 'ga-metadata.json'):
+        path = d.joinpath(name)
+        assert dataset_ids.read_dataset_ids(path) == list(dataset_ids._read_ids_fully(path))
+
+    assert dataset_ids.read_dataset_ids(d.joinpath('ga-metadata.yaml')) == [FIRST_ID, SECOND_ID]
+
+
+def test_cache_skips_unchanged_files(tmpdir, monkeypatch):
+    cache = FileCache(Path(str(tmpdir)).joinpath('ids.db'), table='dataset_ids')
+    monkeypatch.setattr(dataset_ids, '_CACHE', cache)
+
+    path = write_files({'ga-metadata.yaml': LINEAGE_DOC.format(FIRST_ID)}).joinpath('ga-metadata.yaml')
+    assert dataset_ids.get_dataset_ids(path) == [FIRST_ID]
+
+    def fail_read(path):
+        raise AssertionError("Unchanged file shouldn't be read again: {}".format(path))
+
+    with monkeypatch.context() as m:
+        m.setattr(dataset_ids, 'read_dataset_ids', fail_read)
+        assert dataset_ids.get_dataset_ids(path) == [FIRST_ID]
+
+    # A modified file is read again.
+    path.write_text(LINEAGE_DOC.format(SECOND_ID))
+    st = path.stat()
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert dataset_ids.get_dataset_ids(path) == [SECOND_ID]
@@ -0,0 +1,15 @@
+from sqlalchemy.dialects import postgresql
+
+from digitalearthau import index
+
+
+def _sql(query):
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+def test_location_prefix_is_escaped():
+    # Unescaped, the '_' and '%' would match other directories, such as 'ls8xnbar'.
+    sql = _sql(index._locations_query([1], 'file:///g/data/ls8_nbar%/'))
+
+    assert sql.count("/_nbar/%%//' || '%%' ESCAPE '/'") == 2
+    assert "ls8_nbar" not in sql
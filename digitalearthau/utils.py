@@ -5,7 +5,8 @@ import numpy
 
 def simple_object_repr(o):
     """
-    Calculate a possible repr() for the given object using the class name and all __dict__ properties.
+    Calculate a possible repr() for the given object using the class name and all __dict__ (or __slots__)
+    properties.
 
     eg. MyClass(prop1='val1')
 
@@ -13,10 +14,21 @@ def simple_object_repr(o):
     """
     return "%s(%s)" % (
         o.__class__.__name__,
-        ", ".join("%s=%r" % (k, v) for k, v in sorted(o.__dict__.items()))
+        ", ".join("%s=%r" % (k, v) for k, v in sorted(_object_properties(o).items()))
     )
 
 
+def _object_properties(o) -> dict:
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    return {
+        name: getattr(o, name)
+        for cls in type(o).__mro__
+        for name in getattr(cls, '__slots__', ())
+        if hasattr(o, name)
+    }
+
+
 def wofs_fuser(dest, src):
     """
     Fuse two WOfS water measurements represented as `ndarray`s.
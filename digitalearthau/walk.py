@@ -0,0 +1,315 @@
+# coding=utf-8
+"""
+Walk the filesystem for paths matching glob patterns, one directory level at a time.
+
+Patterns are split into per-level matchers, so that directories are pruned as early as possible. Directory
+listings use :func:`os.scandir`, so no extra stat() calls are needed to tell directories from files, and
+the listings can be spread over a thread pool (on Lustre, listing is bound by metadata latency, not cpu).
+
+Matches are the same as :func:`glob.iglob` (without recursive '**' support).
+"""
+import collections
+import fnmatch
+import glob
+import heapq
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import quote_from_bytes
+
+# Default number of threads listing directories concurrently.
+DEFAULT_THREADS = int(os.environ.get('DEA_WALK_THREADS') or 8)
+
+
+class _LevelMatcher:
+    """
+    Matcher of the names at one level (directory depth) of a glob pattern.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.is_literal = not glob.has_magic(pattern)
+        self._regex = re.compile(fnmatch.translate(pattern))
+        # Like glob, hidden files are only matched by a pattern that starts with a dot.
+        self._include_hidden = pattern.startswith('.')
+
+    def matches(self, name: str) -> bool:
+        if name.startswith('.') and not self._include_hidden:
+            return False
+        return self._regex.match(name) is not None
+
+    def __repr__(self) -> str:
+        return '{}({!r})'.format(self.__class__.__name__, self.pattern)
+
+
+def split_pattern(pattern: str) -> Tuple[str, List[_LevelMatcher]]:
+    """
+    Split an absolute glob pattern into its literal base directory and a matcher for each remaining level.
+
+    >>> split_pattern('/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml')
+    ('/g/data/v10/reprocess/ls8/level1', [_LevelMatcher('[0-9][0-9][0-9][0-9]'), _LevelMatcher('[0-9][0-9]'), \
+_LevelMatcher('LS*'), _LevelMatcher('ga-metadata.yaml')])
+    >>> split_pattern('/tmp/some/file.txt')
+    ('/tmp/some', [_LevelMatcher('file.txt')])
+    >>> split_pattern('relative/*.nc')
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected an absolute pattern: 'relative/*.nc'
+    """
+    if not pattern.startswith('/'):
+        raise ValueError('Expected an absolute pattern: {!r}'.format(pattern))
+
+    parts = [p for p in pattern.split('/') if p]
+    base_parts = []
+    # Keep at least one level to match against.
+    while len(parts) > 1 and not glob.has_magic(parts[0]):
+        base_parts.append(parts.pop(0))
+
+    return '/' + '/'.join(base_parts), [_LevelMatcher(p) for p in parts]
+
+
+def entry_depth(matchers: Sequence[_LevelMatcher]) -> Optional[int]:
+    """
+    The level of a split pattern that its entries are listed at: the last with wildcards. (None if none have any)
+
+    Directories above it are only changed (their mtime) when entries are added or removed at that level.
+
+    >>> entry_depth(split_pattern('/g/data/v10/reprocess/ls8/level1/[0-9]*/[0-9][0-9]/LS*/ga-metadata.yaml')[1])
+    2
+    >>> entry_depth(split_pattern('/g/data/fk4/datacube/002/LS5_TM_FC/*_*/LS5*FC*.nc')[1])
+    1
+    >>> entry_depth(split_pattern('/tmp/LS8_SCENE/ga-metadata.yaml')[1]) is None
+    True
+    """
+    wildcard_levels = [i for i, matcher in enumerate(matchers) if not matcher.is_literal]
+    return wildcard_levels[-1] if wildcard_levels else None
+
+
+def _uri_name_key(name: str) -> str:
+    """
+    The sort key of a directory entry name, as it will appear in a file:// uri
+    """
+    return quote_from_bytes(os.fsencode(name))
+
+
+def _list_matches(directory: str, matcher: _LevelMatcher, dirs_only: bool) -> List[str]:
+    """
+    List the entries in the directory that match the given level matcher.
+    """
+    if matcher.is_literal:
+        path = os.path.join(directory, matcher.pattern)
+        exists = os.path.isdir(path) if dirs_only else os.path.lexists(path)
+        return [matcher.pattern] if exists else []
+
+    try:
+        with os.scandir(directory) as it:
+            return [
+                entry.name for entry in it
+                if matcher.matches(entry.name) and (not dirs_only or entry.is_dir())
+            ]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _walk_sorted(directory: str, matchers: Sequence[_LevelMatcher]) -> Iterable[str]:
+    last_level = len(matchers) == 1
+    names = _list_matches(directory, matchers[0], dirs_only=not last_level)
+
+    if last_level:
+        for name in sorted(names, key=_uri_name_key):
+            yield os.path.join(directory, name)
+    else:
+        # A trailing separator in the key, so that a directory's contents sort where they will in the full uri.
+        # (eg. "a/x" sorts after "a-b/x")
+        for name in sorted(names, key=lambda n: _uri_name_key(n) + '/'):
+            yield from _walk_sorted(os.path.join(directory, name), matchers[1:])
+
+
+def iter_sorted_uris(patterns: Iterable[str]) -> Iterable[str]:
+    """
+    Iterate over file:// uris of all paths matching any of the glob patterns, in sorted order.
+
+    Only one directory listing is held in memory per directory level, regardless of the number of matches.
+
+    >>> from digitalearthau.paths import write_files
+    >>> d = write_files({'a': {'x.nc': ''}, 'a-b': {'x.nc': '', 'y.txt': ''}, 'b': {'z.nc': '', '.hidden.nc': ''}})
+    >>> uris = list(iter_sorted_uris([str(d) + '/*/*.nc', str(d) + '/a/*.nc']))
+    >>> [u[len(d.as_uri()):] for u in uris]
+    ['/a-b/x.nc', '/a/x.nc', '/b/z.nc']
+    >>> uris == sorted(Path(p).as_uri() for p in glob.iglob(str(d) + '/*/*.nc'))
+    True
+    """
+    def pattern_uris(pattern):
+        base, matchers = split_pattern(pattern)
+        for path in _walk_sorted(base, matchers):
+            yield Path(path).as_uri()
+
+    last_uri = None
+    # The same path can be matched by multiple patterns.
+    for uri in heapq.merge(*(pattern_uris(p) for p in patterns)):
+        if uri != last_uri:
+            yield uri
+        last_uri = uri
+
+
+def iter_paths(patterns: Iterable[str], threads: int = DEFAULT_THREADS) -> Iterable[str]:
+    """
+    Iterate over all paths matching the glob patterns, in no particular order.
+
+    This matches the same paths as calling :func:`glob.iglob` for each pattern, but directories are listed
+    concurrently by the given number of threads.
+
+    >>> from digitalearthau.paths import write_files
+    >>> d = write_files({'2016': {'01': {'LS8_A': {'ga-metadata.yaml': ''}, 'LS8_B': {}}, 'notes.txt': ''}})
+    >>> sorted(p[len(str(d)):] for p in iter_paths([str(d) + '/[0-9]*/[0-9][0-9]/LS*/ga-metadata.yaml']))
+    ['/2016/01/LS8_A/ga-metadata.yaml']
+    >>> sorted(p[len(str(d)):] for p in iter_paths([str(d) + '/*/*'], threads=1))
+    ['/2016/01', '/2016/notes.txt']
+    """
+    for _, path in iter_matches(patterns, threads=threads):
+        yield path
+
+
+def iter_matches(patterns: Sequence[str], threads: int = DEFAULT_THREADS) -> Iterable[Tuple[int, str]]:
+    """
+    Iterate over all paths matching the glob patterns, as (pattern index, path) tuples, in no particular order.
+
+    Patterns that share directories are walked together: each directory is listed once and its entries
+    are matched against every pattern at the same time. A path that matches several patterns is returned once
+    for each.
+
+    >>> from digitalearthau.paths import write_files
+    >>> d = write_files({'2016': {'nbar': {'LS8_A': {'ga-metadata.yaml': ''}},
+    ...                           'nbart': {'LS8_A': {'ga-metadata.yaml': ''}}}})
+    >>> sorted((i, p[len(str(d)):]) for i, p in iter_matches([str(d) + '/*/nbar/LS*/ga-metadata.yaml',
+    ...                                                       str(d) + '/*/nbart/LS*/ga-metadata.yaml',
+    ...                                                       str(d) + '/2016/*/LS8_A']))
+    [(0, '/2016/nbar/LS8_A/ga-metadata.yaml'), (1, '/2016/nbart/LS8_A/ga-metadata.yaml'), \
+(2, '/2016/nbar/LS8_A'), (2, '/2016/nbart/LS8_A')]
+    """
+    roots = _walk_roots(patterns)
+
+    if threads <= 1:
+        for directory, states in roots:
+            yield from _walk(directory, states)
+    else:
+        yield from _walk_concurrently(roots, threads)
+
+
+# The walk of one pattern at a directory: the pattern's index, and the matchers of its remaining levels.
+_PatternState = Tuple[int, Sequence[_LevelMatcher]]
+
+
+def _is_within(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
+def _walk_roots(patterns: Sequence[str]) -> List[Tuple[str, List[_PatternState]]]:
+    """
+    Group the patterns by the directory to start walking them from.
+
+    Patterns with the same base directory, or with a base inside another pattern's base, are walked together
+    from the outermost one.
+
+    >>> [(d, [(i, len(m)) for i, m in s])
+    ...  for d, s in _walk_roots(['/a/b/*/x', '/a/b/c/*.nc', '/a/bb/*', '/a/b/*/y'])]
+    [('/a/b', [(0, 2), (1, 2), (3, 2)]), ('/a/bb', [(2, 1)])]
+    """
+    split = [split_pattern(pattern) for pattern in patterns]
+    # Ancestors sort before the directories within them.
+    bases = sorted(set(base for base, _ in split))
+
+    roots = collections.OrderedDict()  # type: Dict[str, List[_PatternState]]
+    for i, (base, matchers) in enumerate(split):
+        root = next(b for b in bases if _is_within(base, b))
+        literal_levels = [_LevelMatcher(part) for part in base[len(root):].split('/') if part]
+        roots.setdefault(root, []).append((i, literal_levels + matchers))
+    return list(roots.items())
+
+
+def _list_level(directory: str,
+                states: Sequence[_PatternState]) -> Tuple[List[Tuple[int, str]],
+                                                          List[Tuple[str, List[_PatternState]]]]:
+    """
+    List one directory for all patterns walking it.
+
+    Returns the (pattern index, path) of final matches, and the subdirectories still to walk with the patterns
+    that matched them.
+    """
+    found = []  # type: List[Tuple[int, str]]
+    subdirectories = collections.OrderedDict()  # type: Dict[str, List[_PatternState]]
+
+    def route(path: str, is_dir: bool, matching_states: Sequence[_PatternState]):
+        for i, matchers in matching_states:
+            if len(matchers) == 1:
+                found.append((i, path))
+            elif is_dir:
+                subdirectories.setdefault(path, []).append((i, matchers[1:]))
+
+    if all(matchers[0].is_literal for _, matchers in states):
+        # Only existence checks are needed (eg. 'ga-metadata.yaml'), not a listing.
+        by_name = collections.OrderedDict()  # type: Dict[str, List[_PatternState]]
+        for state in states:
+            by_name.setdefault(state[1][0].pattern, []).append(state)
+
+        for name, name_states in by_name.items():
+            path = os.path.join(directory, name)
+            is_dir = any(len(m) > 1 for _, m in name_states) and os.path.isdir(path)
+            if is_dir or (any(len(m) == 1 for _, m in name_states) and os.path.lexists(path)):
+                route(path, is_dir, name_states)
+    else:
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    matching_states = [s for s in states if s[1][0].matches(entry.name)]
+                    if matching_states:
+                        is_dir = any(len(m) > 1 for _, m in matching_states) and entry.is_dir()
+                        route(os.path.join(directory, entry.name), is_dir, matching_states)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+
+    return found, list(subdirectories.items())
+
+
+def _walk(directory: str, states: Sequence[_PatternState]) -> Iterable[Tuple[int, str]]:
+    found, subdirectories = _list_level(directory, states)
+    yield from found
+    for subdirectory, sub_states in subdirectories:
+        yield from _walk(subdirectory, sub_states)
+
+
+def _walk_concurrently(roots: Iterable[Tuple[str, Sequence[_PatternState]]],
+                       threads: int) -> Iterable[Tuple[int, str]]:
+    """
+    Walk the given (directory, pattern states) roots, listing directories on a pool of threads.
+    """
+
+    def list_level(directory, states):
+        """List one directory: returning any final matched paths, and subdirectories still to walk"""
+        found, subdirectories = _list_level(directory, states)
+        to_walk = []
+        for subdirectory, sub_states in subdirectories:
+            # Remaining levels are just existence checks (eg. 'ga-metadata.yaml'): finish them in this thread,
+            # rather than queueing a task for each.
+            if all(m.is_literal for _, matchers in sub_states for m in matchers):
+                found.extend(_walk(subdirectory, sub_states))
+            else:
+                to_walk.append((subdirectory, sub_states))
+        return found, to_walk
+
+    pending = collections.deque(roots)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = set()
+        while pending or in_flight:
+            # Keep a few listings queued for each thread. The rest wait in 'pending' as plain paths.
+            while pending and len(in_flight) < threads * 2:
+                in_flight.add(executor.submit(list_level, *pending.popleft()))
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                found_paths, subdirectories = future.result()
+                yield from found_paths
+                # Depth-first, so that the pending list doesn't grow to a whole level of the tree.
+                pending.extendleft(subdirectories)
@@ -61,6 +61,7 @@ setup(
             'dea-submit-ncmler = digitalearthau.submit.ncmler:cli',
             'dea-submit-sync = digitalearthau.sync.submit_job:main',
             'dea-sync = digitalearthau.sync:cli',
+            'dea-sync-merge = digitalearthau.sync.shards:merge_cli',
             'dea-stacker = digitalearthau.stacker:cli',
             'dea-system = digitalearthau.system:cli',
             'dea-test-env = digitalearthau.test_env:cli',